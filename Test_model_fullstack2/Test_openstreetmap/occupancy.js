@@ -15,22 +15,67 @@ async function fetchAccessPoints(building, date, time, granularity = 'minute', l
     }
 }
 
+// every building with its coordinates, asked once: the compact campus
+// responses refer to buildings by their position in it
+async function fetchBuildingTable() {
+    const url = `http://127.0.0.1:8000/api/v1/campus/buildings/`;
+    try {
+        const response = await fetch(url);
+        if (!response.ok) {
+            throw new Error(`HTTP error! Status: ${response.status}`);
+        }
+        const result = await response.json();
+        return result.data || null;
+    } catch (error) {
+        console.error('Error fetching building table:', error);
+        return null;
+    }
+}
+
 async function fetchOccupancyData(date, time, granularity = 'minute') {
     try {
-        const url = `http://127.0.0.1:8000/api/v1/campus/datetime/${date}T${time}/?granularity=${granularity}`;
+        if (!buildingTable) {
+            buildingTable = await fetchBuildingTable();
+            if (!buildingTable) return [];
+        }
+        const url = `http://127.0.0.1:8000/api/v1/campus/datetime/${date}T${time}/?granularity=${granularity}&format=compact`;
         const response = await fetch(url);
         if (!response.ok) {
             throw new Error(`HTTP error! Status: ${response.status}`);
         }
         const result = await response.json();
         //console.log('Received occupancy data:', result);
-        return result.data || [];
+        const data = result.data;
+        if (!data || !data.building) return [];
+        // parallel arrays back to one entry per building
+        return data.building.map((b, i) => ({
+            date: data.dates[data.date[i]],
+            building: buildingTable.building[b],
+            building_lat: buildingTable.building_lat[b],
+            building_long: buildingTable.building_long[b],
+            connection_count: data.connection_count[i]
+        }));
     } catch (error) {
         console.error('Error fetching occupancy data:', error);
         return [];
     }
 }
 
+async function fetchTimeline(date) {
+    const url = `http://127.0.0.1:8000/api/v1/campus/date/${date}/timeline/`;
+    try {
+        const response = await fetch(url);
+        if (!response.ok) {
+            throw new Error(`HTTP error! Status: ${response.status}`);
+        }
+        const result = await response.json();
+        return result.data || null;
+    } catch (error) {
+        console.error('Error fetching timeline data:', error);
+        return null;
+    }
+}
+
 async function fetchBuildingData(building, date, time, granularity = 'minute') {
     const url = `http://127.0.0.1:8000/api/v1/building/${building}/datetime/${date}T${time}/?granularity=${granularity}`;
     try {
@@ -47,8 +92,49 @@ async function fetchBuildingData(building, date, time, granularity = 'minute') {
     }
 }
 
+// floors of a building that have access points, asked once per building click
+async function fetchFloors(building, date) {
+    const url = `http://127.0.0.1:8000/api/v1/building/${building}/floors/?date=${date}`;
+    try {
+        const response = await fetch(url);
+        if (!response.ok) {
+            throw new Error(`HTTP error! Status: ${response.status}`);
+        }
+        const result = await response.json();
+        return result.data.floors.map(entry => entry.floor);
+    } catch (error) {
+        console.error(`Error fetching floors for ${building}:`, error);
+        return [];
+    }
+}
+
+// dates that have data, per dataset (campus, trajectory, buildings)
+async function fetchDatasets() {
+    const url = `http://127.0.0.1:8000/api/v1/datasets/`;
+    try {
+        const response = await fetch(url);
+        if (!response.ok) {
+            throw new Error(`HTTP error! Status: ${response.status}`);
+        }
+        const result = await response.json();
+        return result.data || null;
+    } catch (error) {
+        console.error('Error fetching datasets:', error);
+        return null;
+    }
+}
+
+// the selected date when it has trajectories, otherwise the latest day that does
+function getTrajectoryDate() {
+    const date = getDateInput();
+    if (!datasets || datasets.trajectory.length === 0) {
+        return '2013-11-29';
+    }
+    return datasets.trajectory.includes(date) ? date : datasets.trajectory[datasets.trajectory.length - 1];
+}
+
 async function fetchTrajectoryData(deviceID) {
-    const url = `http://127.0.0.1:8000/api/v1/trajectory/${deviceID}/date/2013-11-29/`;
+    const url = `http://127.0.0.1:8000/api/v1/trajectory/${deviceID}/date/${getTrajectoryDate()}/`;
     try {
         const response = await fetch(url);
         if (!response.ok) {
@@ -229,6 +315,12 @@ let selectedFloor = null;
 let accessPoints = [];
 let accessPointLayers = [];
 let isTrajectoryView = false;
+let timeline = null;
+let datasets = null;
+let liveStream = null;
+let liveKey = null;
+let liveOccupancy = new Map();
+let buildingTable = null;
 
 function init() {
     map = L.map('mapid').setView([42.392, -72.527], 16);
@@ -270,9 +362,7 @@ function init() {
         plotRouteWithOccupancyAndHeatmap(deviceID);
     });
 
-    initializeBuildings();
-
-    setInterval(updateHeatmapData, 10000);
+    initializeDatasets().then(initializeBuildings);
 }
 
 
@@ -295,6 +385,21 @@ function toggleViewMode() {
     updateHeatmapData(getDateInput());
 }
 
+// limit the date picker to the days the API has data for
+async function initializeDatasets() {
+    datasets = await fetchDatasets();
+    if (!datasets || datasets.campus.length === 0) {
+        return;
+    }
+
+    const dateInput = document.getElementById('date-input');
+    dateInput.min = datasets.campus[0];
+    dateInput.max = datasets.campus[datasets.campus.length - 1];
+    if (!datasets.campus.includes(dateInput.value)) {
+        dateInput.value = dateInput.max;
+    }
+}
+
 async function initializeBuildings() {
     const date = getDateInput();
     const time = '13:00';
@@ -368,6 +473,7 @@ function addBuildingLayers(buildings) {
             map.setView([building.lat, building.long], 19);
             selectedBuilding = building;
             selectedFloor = 1; // Reset the selected floor
+            createFloorButtons(await fetchFloors(building.name, getDateInput()));
             const time = viewByHour ? parseInt(document.getElementById('timebar').value) * 60 : document.getElementById('timebar').value;
             await initializeAccessPointsAndUpdateHeatmap(building.name, getDateInput(), formatTime(time));
             await updateHeatmapData(getDateInput());
@@ -432,6 +538,7 @@ async function updateHeatmapData(date = '2021-03-01') {
 
     const occupancyData = await fetchOccupancyData(date, formattedTime, viewByHour ? 'hour' : 'minute');
     if (!occupancyData) return;
+    openLiveStream(date, formattedTime, viewByHour ? 'hour' : 'minute');
 
     let filteredData = [];
     let totalCount = 0;
@@ -522,8 +629,38 @@ async function updateBuildingStats(building, date, time) {
             <br>Current Occupancy: ${buildingData.connection_count}
         `;
     }
-    
-    createFloorButtons(buildingData.no_floors);
+}
+
+// the server pushes the campus view again when its counts change (new
+// syslog data), one stream for the date and time on screen
+function openLiveStream(date, time, granularity) {
+    const key = `${date}T${time}/${granularity}`;
+    if (key === liveKey) return;
+    if (liveStream) liveStream.close();
+    liveKey = key;
+    liveStream = new EventSource(`http://127.0.0.1:8000/api/v1/campus/live/?datetime=${date}T${time}&granularity=${granularity}`);
+    liveStream.addEventListener('snapshot', event => {
+        // same data as the fetch that opened the stream, nothing to redraw
+        liveOccupancy = new Map(JSON.parse(event.data).data.map(entry => [entry.building, entry]));
+    });
+    liveStream.addEventListener('delta', event => {
+        const delta = JSON.parse(event.data);
+        delta.changed.forEach(entry => liveOccupancy.set(entry.building, entry));
+        delta.removed.forEach(building => liveOccupancy.delete(building));
+        showLiveOccupancy();
+    });
+}
+
+function showLiveOccupancy() {
+    if (selectedBuilding || map.getZoom() > 18) {
+        // building and access point views are fetched again
+        updateHeatmapData(getDateInput());
+        return;
+    }
+    const data = [...liveOccupancy.values()].map(entry => [entry.building_lat, entry.building_long, entry.connection_count]);
+    updateHeatmap(data);
+    const totalCount = data.reduce((acc, entry) => acc + entry[2], 0);
+    document.getElementById('occupancy-counter').innerText = `Campus current occupancy: ${totalCount}`;
 }
 
 function clearBuildingStats() {
@@ -575,8 +712,8 @@ function plotAccessPoints(map, accessPoints) {
     });
 }
 
-function createFloorButtons(noFloors) {
-    //console.log('Creating floor buttons:', noFloors); // Debugging information
+function createFloorButtons(floors) {
+    //console.log('Creating floor buttons:', floors); // Debugging information
     const floorContainer = document.getElementById('floor-buttons-container');
     
     if (!floorContainer) {
@@ -586,7 +723,7 @@ function createFloorButtons(noFloors) {
 
     floorContainer.innerHTML = ''; // Clear existing buttons
 
-    for (let floor = 1; floor <= noFloors; floor++) {
+    for (const floor of floors) {
         const floorButton = document.createElement('button');
         floorButton.className = 'floor-button';
         floorButton.innerText = `Floor ${floor}`;
@@ -611,16 +748,53 @@ function clearFloorButtons() {
     }
 }
 
-function startAnimation() {
+async function startAnimation() {
     if (intervalId) return;
+    intervalId = -1;
+
+    // prefetch the whole day once, the campus minute view plays back from it
+    const date = getDateInput();
+    if (!viewByHour && (!timeline || timeline.date !== date)) {
+        timeline = await fetchTimeline(date);
+    }
+    if (intervalId !== -1) return; // stopped while fetching
 
     intervalId = setInterval(() => {
         const timebar = document.getElementById('timebar');
         timebar.value = viewByHour ? (parseInt(timebar.value, 10) + 1) % 24 : (parseInt(timebar.value, 10) + 1) % 1440;
-        updateHeatmapData(getDateInput());
+        const minutes = parseInt(timebar.value, 10);
+        if (!viewByHour && !selectedBuilding && timeline && timeline.date === getDateInput() && timeline.times.includes(minutes)) {
+            showTimelineFrame(minutes);
+        } else {
+            updateHeatmapData(getDateInput());
+        }
     }, 1000);
 }
 
+// draw one minute of the prefetched timeline without asking the server
+function showTimelineFrame(minutes) {
+    const counts = timeline.connection_count[timeline.times.indexOf(minutes)];
+    const filteredData = [];
+    let totalCount = 0;
+
+    counts.forEach((count, i) => {
+        if (count > 0) {
+            filteredData.push([timeline.building_lat[i], timeline.building_long[i], count]);
+            totalCount += count;
+        }
+    });
+
+    document.getElementById('time-display').innerText = `${formatTime(minutes)}:00`;
+
+    if (map.getZoom() > 18) {
+        updateHeatmapAtBuildingLevel(filteredData);
+    } else {
+        updateHeatmap(filteredData);
+    }
+
+    document.getElementById('occupancy-counter').innerText = `Campus current occupancy: ${totalCount}`;
+}
+
 function stopAnimation() {
     clearInterval(intervalId);
     intervalId = null;
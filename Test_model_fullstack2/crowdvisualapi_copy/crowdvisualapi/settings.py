@@ -46,6 +46,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",
+    # before the middleware that read or change the body, so it compresses last
+    "crowdvisualrestapi.middleware.CompressionMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -128,3 +130,91 @@ STATICFILES_DIRS = [BASE_DIR / 'crowdvisualrestapi/static/crowdvisualrestapi',]
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Folder holding the Sessions_* and Trajectory CSV folders
+CSV_DATA_DIR = BASE_DIR / "csv_data"
+
+# Build a day's occupancy cube in the background the first time a converted
+# day is requested without one (see "python manage.py build_store")
+OCCUPANCY_CUBE_AUTOBUILD = True
+
+# Build a day's trajectory index (device id -> stays, next to its
+# *_finaltraj.csv) in the background the first time the day is requested;
+# until it exists RouteAPI scans the CSV
+TRAJECTORY_INDEX_AUTOBUILD = True
+
+# Build the missing rollups (hourly and daily stats per building, next to
+# each Sessions_Total CSV) of converted days in the background when an
+# aggregate covers them; until then the aggregates list them as missing
+ROLLUP_AUTOBUILD = True
+
+# Threads reading the per-day trajectory files of date range queries, shared
+# by all requests of a process; also how many days are read ahead of the
+# response stream
+TRAJECTORY_WORKERS = 4
+
+# Longest date range (days, both ends included) a trajectory range query
+# may ask for, longer ones get a 400
+TRAJECTORY_MAX_DAYS = 366
+
+# Seconds between two computations of the campus occupancy pushed to
+# /api/v1/campus/live/ streams, one per distinct date and time shown
+LIVE_OCCUPANCY_INTERVAL = 10
+
+# Cache-Control max-age (seconds) of the campus, building, access point and
+# route responses: days before today never change once exported, today's
+# file can still grow (see ingest_syslog). Responses also carry an ETag and
+# Last-Modified from the day's file, so expired ones are revalidated with a
+# 304 instead of being sent again
+HTTP_CACHE = {
+    "PAST_MAX_AGE": 604800,
+    "TODAY_MAX_AGE": 10,
+}
+
+# Request metrics (crowdvisualrestapi/metrics.py): /metrics serves latency
+# per endpoint, rows scanned, CSV bytes read, cache lookups and model time in
+# the Prometheus text format, and SERVER_TIMING adds a Server-Timing header
+# to every response. With PROFILE_TOKEN set, a request sent with the header
+# "X-Profile: <token>" runs under cProfile and its stats are written to
+# PROFILE_DIR (the temporary folder when None); keep the token secret
+METRICS = {
+    "SERVER_TIMING": True,
+    "PROFILE_TOKEN": None,
+    "PROFILE_DIR": None,
+}
+
+# Pools the occupancy and prediction views hand their work to (see
+# crowdvisualrestapi/pools.py); concurrent requests for the same data share
+# one run. OCCUPANCY_POOL = "process" reads files in worker processes,
+# which helps on days still served from the CSV (parsing holds the GIL)
+OCCUPANCY_POOL = "thread"
+OCCUPANCY_WORKERS = 4
+PREDICTION_WORKERS = 2
+
+# Prediction model and scaler, loaded on first use by crowdvisualrestapi.registry
+PREDICTION_MODEL_PATH = BASE_DIR.parent / "occupancy_model2.pth"
+PREDICTION_SCALER_PATH = BASE_DIR.parent / "scaler.pkl"
+
+# Load the model and scaler when the app starts instead of on the first
+# prediction request; turn on for servers that serve the prediction endpoints
+PREDICTION_WARMUP = False
+
+# Inference engine for the prediction views: "eager" runs the model as
+# loaded, "torchscript" compiles it, "quantized" also stores the LSTM and
+# Linear weights as int8 (faster on CPU, check the deviation with
+# manage.py check_engine before turning it on)
+PREDICTION_ENGINE = "eager"
+
+# torch intra-op threads per process, None keeps torch's default (all cores);
+# set it to cores / workers when several workers share a machine
+PREDICTION_NUM_THREADS = None
+
+# Prediction results cache shared by the prediction views: SIZE entries are
+# kept per process (least recently used are evicted first), BACKEND names a
+# cache from CACHES to also share results between workers (None to keep them
+# per process), TIMEOUT is how long shared entries live in seconds
+PREDICTION_CACHE = {
+    "SIZE": 100000,
+    "BACKEND": None,
+    "TIMEOUT": 86400,
+}
@@ -23,5 +23,6 @@ schema_view = get_schema_view(
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/v1/", include("crowdvisualrestapi.urls")),
+    path("metrics", views.prometheus_metrics, name="metrics"),
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
 ]
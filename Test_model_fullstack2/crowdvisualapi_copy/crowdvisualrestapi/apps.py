@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class CrowdvisualrestapiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "crowdvisualrestapi"
+
+    def ready(self):
+        from django.conf import settings
+
+        if getattr(settings, "PREDICTION_WARMUP", False):
+            from .registry import registry
+            registry.warm_up()
@@ -0,0 +1,136 @@
+import os
+import threading
+from .store import data_root
+
+
+# datasets are named after their folder: Sessions_Total -> Total,
+# Sessions_LGRC -> LGRC, Trajectory -> Trajectory
+SESSIONS_PREFIX = "Sessions_"
+SESSIONS_SUFFIX = "_sessions_final.csv"
+TRAJECTORY = "Trajectory"
+TRAJECTORY_SUFFIX = "_finaltraj.csv"
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+class DatasetCatalog:
+    '''
+    Map of date (YYYYMMDD) -> CSV file for every dataset under csv_data
+
+    Folders are listed once; afterwards a lookup only stats the folder it
+    needs and lists it again when its mtime changed (a file was added,
+    removed or renamed). The root is re-listed the same way, so new
+    Sessions_* folders show up too.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self._root_mtime = None
+        self._folders = {}
+        self._lock = threading.Lock()
+
+    # dataset name -> (folder, file suffix)
+    def _scan_root(self):
+        folders = {}
+        for folder in sorted(os.listdir(self.root)):
+            if folder.startswith(SESSIONS_PREFIX):
+                folders[folder[len(SESSIONS_PREFIX):]] = (folder, SESSIONS_SUFFIX)
+            elif folder == TRAJECTORY:
+                folders[TRAJECTORY] = (folder, TRAJECTORY_SUFFIX)
+        return folders
+
+    def _scan_folder(self, path, suffix):
+        files = {}
+        for file in sorted(os.listdir(path)):
+            if file.endswith(suffix):
+                files.setdefault(file[0:8], os.path.join(path, file))
+        return files
+
+    def _refresh_root(self):
+        try:
+            mtime = os.stat(self.root).st_mtime_ns
+        except OSError:
+            self._root_mtime = None
+            self._folders = {}
+            return
+        if mtime == self._root_mtime:
+            return
+
+        folders = self._scan_root()
+        # keep what is known about folders that are still there
+        self._folders = {
+            name: self._folders.get(name, {"folder": folder, "suffix": suffix, "mtime": None, "files": {}})
+            for name, (folder, suffix) in folders.items()
+        }
+        self._root_mtime = mtime
+
+    def _refresh_folder(self, name):
+        entry = self._folders.get(name)
+        if entry is None:
+            return None
+
+        path = os.path.join(self.root, entry["folder"])
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        if mtime != entry["mtime"]:
+            entry["files"] = self._scan_folder(path, entry["suffix"])
+            entry["mtime"] = mtime
+        return entry
+
+    def path(self, dataset, date):
+        '''
+        CSV file of a dataset ("Total", a building, "Trajectory") for a date
+
+        returns None when there is no such file
+        '''
+        with self._lock:
+            self._refresh_root()
+            entry = self._refresh_folder(dataset)
+            if entry is None:
+                return None
+            return entry["files"].get(date)
+
+    def dates(self, dataset):
+        with self._lock:
+            self._refresh_root()
+            entry = self._refresh_folder(dataset)
+            if entry is None:
+                return []
+            return sorted(entry["files"])
+
+    # date -> CSV file of every file of a dataset
+    def files(self, dataset):
+        with self._lock:
+            self._refresh_root()
+            entry = self._refresh_folder(dataset)
+            if entry is None:
+                return {}
+            return dict(entry["files"])
+
+    def datasets(self):
+        '''
+        Every dataset with the dates it has files for
+
+        returns a dict of dataset name -> sorted dates (YYYYMMDD)
+        '''
+        with self._lock:
+            self._refresh_root()
+            found = {}
+            for name in list(self._folders):
+                entry = self._refresh_folder(name)
+                if entry is not None:
+                    found[name] = sorted(entry["files"])
+            return found
+
+
+# catalog of the configured csv_data folder, one per process
+def dataset_catalog():
+    root = data_root()
+    with _catalogs_lock:
+        catalog = _catalogs.get(root)
+        if catalog is None:
+            catalog = _catalogs[root] = DatasetCatalog(root)
+        return catalog
@@ -0,0 +1,89 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.settings import api_settings
+from .consts import building_dict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# position of every building in the building table, the compact responses
+# refer to buildings by it
+BUILDINGS = list(building_dict)
+BUILDING_INDEX = {building: i for i, building in enumerate(BUILDINGS)}
+
+
+# ?format=compact or Accept: application/vnd.crowdview.compact+json
+class CompactJSONRenderer(JSONRenderer):
+    media_type = "application/vnd.crowdview.compact+json"
+    format = "compact"
+    compact_form = True
+
+
+# ?format=msgpack or Accept: application/msgpack, always the compact form
+class MessagePackRenderer(BaseRenderer):
+    media_type = "application/msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+    compact_form = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return msgpack.packb(data, use_bin_type=True)
+
+
+def compact_renderers():
+    '''
+    Renderers of a view that has a compact form: the default ones (JSON and
+    the browsable API) and the compact JSON and MessagePack ones, the
+    latter only when the msgpack package is installed
+    '''
+    renderers = list(api_settings.DEFAULT_RENDERER_CLASSES) + [CompactJSONRenderer]
+    if msgpack is not None:
+        renderers.append(MessagePackRenderer)
+    return renderers
+
+
+# did content negotiation pick a renderer of the compact form (not JSONRenderer's
+# compact, which is about the separators)
+def wants_compact(request):
+    return getattr(request.accepted_renderer, "compact_form", False)
+
+
+def building_table():
+    '''
+    Every building with its coordinates as parallel arrays, the table the
+    compact responses index into
+    '''
+    return {
+        "building": BUILDINGS,
+        "building_lat": [building_dict[building][0] for building in BUILDINGS],
+        "building_long": [building_dict[building][1] for building in BUILDINGS],
+    }
+
+
+def compact_occupancy(rows):
+    '''
+    campus_occupancy rows as parallel arrays, buildings as their position in
+    the building table and dates as their position in "dates"
+    '''
+    dates = {}
+    for row in rows:
+        dates.setdefault(row["date"], len(dates))
+    return {
+        "dates": list(dates),
+        "date": [dates[row["date"]] for row in rows],
+        "building": [BUILDING_INDEX[row["building"]] for row in rows],
+        "connection_count": [row["connection_count"] for row in rows],
+    }
+
+
+def compact_predictions(values):
+    '''
+    Model outputs of every building, in the order of the building table,
+    as one flat array (the model has a single output)
+    '''
+    return {"predicted_occupancy": [round(value[0], 2) for value in values]}
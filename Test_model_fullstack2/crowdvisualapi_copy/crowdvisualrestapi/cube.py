@@ -0,0 +1,325 @@
+import os
+import json
+import shutil
+import threading
+import numpy as np
+from .consts import building_dict
+from .store import open_sessions
+from .metrics import cache_lookup
+
+
+# bump whenever the arrays below change meaning or layout,
+# cubes written with another version are ignored and rebuilt
+CUBE_VERSION = 1
+CUBE_EXT = ".cube"
+
+# minute rows cover every timestamp the API accepts (0 - 1440),
+# hour rows every whole hour in that range
+MINUTES = 1441
+HOURS = 25
+
+_cache = {}
+_cache_lock = threading.Lock()
+_building = set()
+
+
+def cube_path(csv_path):
+    return os.path.splitext(csv_path)[0] + CUBE_EXT
+
+
+class OccupancyCube:
+    '''
+    Precomputed occupancy of one day, columns follow building_dict order
+
+    minute_count[m, b]      sessions of building b connected at minute m
+    minute_first[m, b]      first of those sessions in file order (-1 if none)
+    hour_count[h, b]        devices first seen in building b during hour h (campus view)
+    hour_first[h, b]        first session counted in hour_count
+    hour_devices[h, b]      distinct devices in building b during hour h (building view)
+    hour_sessions[h, b]     sessions overlapping hour h, with the sum and sum of
+    hour_dwell[h, b]        squares of their minutes spent inside the hour
+    hour_dwell_sq[h, b]
+    floors[b]               highest floor seen in the building
+    row_date, dates         date of every session, to label answers
+
+    Arrays are memory-mapped on first access, so worker processes share
+    the page cache instead of each holding a copy.
+    '''
+
+    ARRAYS = (
+        "minute_count", "minute_first",
+        "hour_count", "hour_first", "hour_devices",
+        "hour_sessions", "hour_dwell", "hour_dwell_sq",
+        "floors", "row_date", "dates",
+    )
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.buildings = meta["buildings"]
+        self.building_codes = {b: i for i, b in enumerate(self.buildings)}
+        self._arrays = {}
+
+    def __getattr__(self, name):
+        if name not in OccupancyCube.ARRAYS:
+            raise AttributeError(name)
+        array = self._arrays.get(name)
+        if array is None:
+            array = np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+            self._arrays[name] = array
+        return array
+
+    # hour rows only exist for whole hours
+    def has_hour(self, time):
+        return int(time) % 60 == 0 and 0 <= int(time) // 60 < HOURS
+
+    def has_minute(self, time):
+        return 0 <= int(time) < MINUTES
+
+    def date_of(self, row):
+        return str(self.dates[self.row_date[row]])
+
+
+# store building code -> cube column (building_dict order), -1 for
+# buildings we do not map, and the sessions that land in a column
+def building_columns(store):
+    codes = {b: i for i, b in enumerate(building_dict)}
+    columns = np.array([codes.get(b, -1) for b in store.buildings.tolist()], dtype=np.int64)
+    rows = np.flatnonzero(columns[store.building] >= 0)
+    return columns, rows
+
+
+def minute_matrix(store):
+    '''
+    [minute x building] count of connected sessions, from one pass over the store
+    a session counts for every whole minute m with start <= m < end
+    '''
+    columns, rows = building_columns(store)
+    counts = np.zeros((MINUTES + 1, len(building_dict)), dtype=np.int32)
+    col = columns[store.building[rows]]
+    first = np.clip(np.ceil(store.start[rows]), 0, MINUTES).astype(np.int64)
+    last = np.clip(np.ceil(store.end[rows]), 0, MINUTES).astype(np.int64)
+    proper = last > first
+
+    np.add.at(counts, (first[proper], col[proper]), 1)
+    np.add.at(counts, (last[proper], col[proper]), -1)
+    return np.cumsum(counts, axis=0, dtype=np.int32)[:MINUTES]
+
+
+def hour_stats(store, columns, known, h, devices, sessions, dwell_sum, dwell_sq=None):
+    '''
+    Building view of hour h: add the distinct devices, the sessions
+    overlapping the hour and the sum (and sum of squares, when dwell_sq is
+    given) of the minutes they spent inside it to the per building column
+    rows given
+
+    known marks the sessions of mapped buildings (see building_columns);
+    returns those overlapping the hour
+    '''
+    lower_bound = float(h * 60)
+    upper_bound = lower_bound + 59
+
+    matched = store.sessions_between(lower_bound, upper_bound)
+    matched = matched[known[matched]]
+    hcol = columns[store.building[matched]]
+
+    pairs = np.unique(hcol * len(store.devices) + store.device[matched])
+    np.add.at(devices, pairs // len(store.devices), 1)
+
+    start = store.start[matched]
+    end = store.end[matched]
+    dwell = np.select(
+        [(start < lower_bound) & (end > upper_bound), start < lower_bound, end > upper_bound],
+        [60.0, end - lower_bound, upper_bound - start],
+        end - start
+    )
+    np.add.at(sessions, hcol, 1)
+    np.add.at(dwell_sum, hcol, dwell)
+    if dwell_sq is not None:
+        np.add.at(dwell_sq, hcol, dwell * dwell)
+    return matched
+
+
+def build_arrays(store):
+    buildings = list(building_dict)
+    codes = {b: i for i, b in enumerate(buildings)}
+
+    columns, rows = building_columns(store)
+    col = columns[store.building[rows]]
+
+    minute_count = minute_matrix(store)
+
+    # paint every session over its minutes, latest row first, so the
+    # earliest session in file order is what is left in each cell
+    minute_first = np.full((MINUTES, len(buildings)), -1, dtype=np.int32)
+    first = np.clip(np.ceil(store.start[rows]), 0, MINUTES).astype(np.int64)
+    last = np.clip(np.ceil(store.end[rows]), 0, MINUTES).astype(np.int64)
+    for i in range(len(rows) - 1, -1, -1):
+        if last[i] > first[i]:
+            minute_first[first[i]:last[i], col[i]] = rows[i]
+
+    hour_count = np.zeros((HOURS, len(buildings)), dtype=np.int32)
+    hour_first = np.full((HOURS, len(buildings)), -1, dtype=np.int32)
+    hour_devices = np.zeros((HOURS, len(buildings)), dtype=np.int32)
+    hour_sessions = np.zeros((HOURS, len(buildings)), dtype=np.int32)
+    hour_dwell = np.zeros((HOURS, len(buildings)), dtype=np.float64)
+    hour_dwell_sq = np.zeros((HOURS, len(buildings)), dtype=np.float64)
+
+    known = np.zeros(len(store), dtype=bool)
+    known[rows] = True
+
+    for h in range(HOURS):
+        matched = hour_stats(store, columns, known, h, hour_devices[h], hour_sessions[h],
+                             hour_dwell[h], hour_dwell_sq[h])
+
+        # campus view: a device counts for the first building it is seen in
+        _, first_seen = np.unique(store.device[matched], return_index=True)
+        counted = matched[np.sort(first_seen)]
+        ccol = columns[store.building[counted]]
+        np.add.at(hour_count[h], ccol, 1)
+        seen, first_counted = np.unique(ccol, return_index=True)
+        hour_first[h, seen] = counted[first_counted]
+
+    floors = np.zeros(len(buildings), dtype=np.int32)
+    for b in buildings:
+        floors[codes[b]] = store.max_floor(b)
+
+    return {
+        "minute_count": minute_count,
+        "minute_first": minute_first,
+        "hour_count": hour_count,
+        "hour_first": hour_first,
+        "hour_devices": hour_devices,
+        "hour_sessions": hour_sessions,
+        "hour_dwell": hour_dwell,
+        "hour_dwell_sq": hour_dwell_sq,
+        "floors": floors,
+        "row_date": store.date.astype(np.int32),
+        "dates": store.dates,
+    }, buildings
+
+
+def build_cube(csv_path, checksum=None):
+    '''
+    Build the occupancy cube of a Sessions_Total CSV
+
+    uses the converted session store when there is one, the CSV otherwise;
+    checksum (of the CSV) is kept in meta.json when given. Returns the
+    number of sessions in the cube
+    '''
+    store = open_sessions(csv_path)
+    arrays, buildings = build_arrays(store)
+
+    out = cube_path(csv_path)
+    tmp = f"{out}.tmp{os.getpid()}.{threading.get_ident()}"
+    os.makedirs(tmp)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), array)
+
+    meta = {
+        "version": CUBE_VERSION,
+        "buildings": buildings,
+        "minutes": MINUTES,
+        "hours": HOURS,
+        "sessions": len(store),
+    }
+    if checksum is not None:
+        meta["checksum"] = checksum
+    with open(os.path.join(tmp, "meta.json"), "w") as file:
+        json.dump(meta, file)
+
+    swap_directory(tmp, out)
+    return meta["sessions"]
+
+
+def swap_directory(tmp, out):
+    '''
+    Put a freshly written folder in place of out
+
+    the old folder is renamed aside and only deleted once the new one is in
+    place, so readers do not find out missing while the old files are being
+    deleted; arrays already mapped from it stay readable after the delete
+    '''
+    old = f"{out}.old{os.getpid()}.{threading.get_ident()}"
+    try:
+        os.replace(out, old)
+    except FileNotFoundError:
+        old = None
+    try:
+        os.replace(tmp, out)
+    except OSError:
+        # another worker put the same folder in place first
+        shutil.rmtree(tmp, ignore_errors=True)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+# True when the CSV has a cube of the current version at least as new as itself
+def is_built(csv_path):
+    meta_path = os.path.join(cube_path(csv_path), "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    if os.path.getmtime(meta_path) < os.path.getmtime(csv_path):
+        return False
+    with open(meta_path) as file:
+        return json.load(file).get("version") == CUBE_VERSION
+
+
+# checksum of the CSV a cube of the current version was built from, None when not known
+def cube_checksum(csv_path):
+    meta_path = os.path.join(cube_path(csv_path), "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as file:
+        meta = json.load(file)
+    return meta.get("checksum") if meta.get("version") == CUBE_VERSION else None
+
+
+def load_cube(csv_path):
+    '''
+    Get the occupancy cube for a Sessions_Total CSV
+
+    returns None when there is no up to date cube, callers then
+    answer from the session store or the CSV
+    '''
+    if not is_built(csv_path):
+        cache_lookup("cube", misses=1)
+        return None
+    cache_lookup("cube", hits=1)
+
+    out = cube_path(csv_path)
+    meta_path = os.path.join(out, "meta.json")
+    mtime = os.path.getmtime(meta_path)
+    with _cache_lock:
+        cached = _cache.get(out)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+    with open(meta_path) as file:
+        cube = OccupancyCube(out, json.load(file))
+
+    with _cache_lock:
+        _cache[out] = (mtime, cube)
+    return cube
+
+
+def build_in_background(csv_path):
+    '''
+    Build a missing cube on a daemon thread
+
+    returns False when a build for the file is already running
+    '''
+    with _cache_lock:
+        if csv_path in _building:
+            return False
+        _building.add(csv_path)
+
+    def run():
+        try:
+            build_cube(csv_path)
+        finally:
+            with _cache_lock:
+                _building.discard(csv_path)
+
+    threading.Thread(target=run, daemon=True).start()
+    return True
@@ -1,25 +1,55 @@
-import os
-import csv
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+from django.conf import settings
 from django.utils.dateparse import parse_datetime
 from .consts import building_dict, ap_dict
-import re
+from .store import load_sessions, open_sessions, ap_floor
+from .catalog import dataset_catalog
+from .cube import load_cube, build_in_background, minute_matrix, building_columns
+from .trajectory import load_trajectory_index, index_in_background
+from .ragged import read_columns, number_lists, string_lists, factorize, firsts, lasts
+from .metrics import timed
 
 
 # get appropriate CSV file
 def get_csv(date, building=None):
     if building is None:
-        path = os.path.abspath(os.path.join(os.getcwd(), "csv_data", "Sessions_Total"))
+        path = dataset_catalog().path("Total", date)
     else:
-        print(building)
-        path = os.path.abspath(os.path.join(os.getcwd(), "csv_data", f"Sessions_{building}"))
-
-
-    for file in os.listdir(path):
-        if file.endswith("_sessions_final.csv") and file[0:8] == date:
-            return os.path.join(path, file)
-
-    return "error"
+        path = dataset_catalog().path(building, date)
+
+    if path is None:
+        return "error"
+    return path
+
+# keep only the first session (in file order) of every device
+def first_per_device(store, rows):
+    _, first = np.unique(store.device[rows], return_index=True)
+    return rows[np.sort(first)]
+
+# group rows by a code array, in order of first appearance
+# returns (codes, index of first row, count) per group
+def group_in_order(codes, rows):
+    values, first, counts = np.unique(codes, return_index=True, return_counts=True)
+    order = np.argsort(first, kind="stable")
+    return values[order], rows[first[order]], counts[order]
+
+# get the day's occupancy cube if it can answer the time asked for
+# a converted day without a cube gets one built in the background
+def cube_for(path, time, hour=False):
+    cube = load_cube(path)
+    if cube is None:
+        if getattr(settings, "OCCUPANCY_CUBE_AUTOBUILD", False) and load_sessions(path) is not None:
+            build_in_background(path)
+        return None
+
+    if hour is True and not cube.has_hour(time):
+        return None
+    if hour is False and not cube.has_minute(time):
+        return None
+    return cube
 
 # get campus occupancy by minute
 def campus_occupancy(path, time, hour=False):
@@ -28,69 +58,154 @@ def campus_occupancy(path, time, hour=False):
 
     returns a list of dictionaries per building occupied at specific minute
     '''
-    with open(path, "r") as file:
-
-        reader = csv.reader(file)
-        next(reader)  # Skip header
+    cube = cube_for(path, time, hour)
+    if cube is not None:
+        return campus_occupancy_cube(cube, time, hour)
+
+    store = load_sessions(path)
+    if store is None:
+        return campus_occupancy_csv(path, time, hour)
+    return campus_occupancy_store(store, time, hour)
+
+@timed("cube")
+def campus_occupancy_cube(cube, time, hour=False):
+    if hour is False:
+        counts = cube.minute_count[int(time)]
+        firsts = cube.minute_first[int(time)]
+    else:
+        counts = cube.hour_count[int(time) // 60]
+        firsts = cube.hour_first[int(time) // 60]
+
+    # buildings are listed in the order their first session appears in the file
+    columns = np.flatnonzero(counts)
+    columns = columns[np.argsort(firsts[columns], kind="stable")]
+
+    response = []
+    for b in columns:
+        building = cube.buildings[b]
+        response.append({
+            "date": cube.date_of(firsts[b]),
+            "building": building,
+            "building_lat": building_dict[building][0],
+            "building_long": building_dict[building][1],
+            "connection_count": int(counts[b])
+        })
+    return response
 
-        response = []
-        
-        temp_list = []
+@timed("store")
+def campus_occupancy_store(store, time, hour=False):
+    if hour is False:
+        rows = store.sessions_between(int(time), int(time))
+    else:
+        rows = store.sessions_between(float(time), float(time) + 59)
 
-        lower_bound = float(time)
-        upper_bound = float(time) + 59
-        device_set = set()
+    known = np.array([b in building_dict for b in store.buildings.tolist()], dtype=bool)
+    rows = rows[known[store.building[rows]]]
+    if hour is True:
+        # a device only counts towards the first building it is seen in
+        rows = first_per_device(store, rows)
+
+    response = []
+    for code, row, count in zip(*group_in_order(store.building[rows], rows)):
+        building = str(store.buildings[code])
+        response.append({
+            "date": str(store.dates[store.date[row]]),
+            "building": building,
+            "building_lat": building_dict[building][0],
+            "building_long": building_dict[building][1],
+            "connection_count": int(count)
+        })
+    return response
 
-        # Process only the first row after the header
-        for row in reader:
+@timed("csv")
+def campus_occupancy_csv(path, time, hour=False):
+    return campus_counts(campus_csv_columns(path), time, hour)
+
+# the columns of a Sessions_Total CSV campus_counts needs, parsed
+def campus_csv_columns(path):
+    starts, ends, devices, dates, names = read_columns(path, [2, 3, 26, 32, 36])
+    building, buildings = factorize(names)
+    start, start_offsets = number_lists(starts)
+    end, end_offsets = number_lists(ends)
+    return building, buildings, firsts(start, start_offsets), lasts(end, end_offsets), devices, dates
+
+# campus_occupancy from the parsed columns of the CSV, the benchmark times it on its own
+def campus_counts(columns, time, hour=False):
+    building, buildings, start, end, devices, dates = columns
+    known = np.array([b in building_dict for b in buildings.tolist()], dtype=bool)
+
+    # sessions in a known building with an access point connection at the minute (or in the hour)
+    if hour is False:
+        rows = np.flatnonzero(known[building] & (start <= int(time)) & (end > int(time)))
+    else:
+        rows = np.flatnonzero(known[building] & (start <= float(time) + 59) & (end > float(time)))
+        # a device only counts towards the first building it is seen in
+        device, _ = factorize([devices[i] for i in rows])
+        _, first = np.unique(device, return_index=True)
+        rows = rows[np.sort(first)]
+
+    response = []
+    for code, row, count in zip(*group_in_order(building[rows], rows)):
+        building_name = str(buildings[code])
+        response.append({
+            "date": dates[row][:10],
+            "building": building_name,
+            "building_lat": building_dict[building_name][0],
+            "building_long": building_dict[building_name][1],
+            "connection_count": int(count)
+        })
+    return response
 
-            start = row[2].strip("[]").split(',')
-            end = row[3].strip("[]").split(',')
-            device_id = row[26]
+# get campus occupancy of every building over a range of the day
+def campus_timeline(path, date, start, end, step=1, hour=False):
+    '''
+    Get occupancy of campus per building for every step between start and end
 
-            if row[36] not in building_dict:
+    returns parallel lists instead of one dictionary per building and minute:
+    times, buildings with their coordinates, and connection_count[time][building]
+    '''
+    times = list(range(start, end + 1, step))
+
+    if hour is False:
+        cube = cube_for(path, start)
+        if cube is not None:
+            matrix = np.asarray(cube.minute_count[start:end + 1:step])
+        else:
+            # one pass over the day, whatever the number of minutes asked for
+            matrix = minute_matrix(open_sessions(path))[start:end + 1:step]
+    else:
+        # whole hours come from the cube, every other window from one store
+        # opened (or CSV parsed) once for the whole range; minute 0 is a whole
+        # hour, so this gets the day's cube (or has it built in the background)
+        cube = cube_for(path, 0, True)
+        store = None
+        matrix = np.zeros((len(times), len(building_dict)), dtype=np.int32)
+        for i, time in enumerate(times):
+            if cube is not None and cube.has_hour(time):
+                matrix[i] = cube.hour_count[time // 60]
                 continue
-            
-            response_data = {}
-
-            # if session does not have an access point connection at the minute, continue
-            if hour is False:
-                if int(start[0]) > int(time) or float(end[-1]) <= int(time):
-                    continue
-            else:
-                if int(start[0]) > upper_bound or float(end[-1]) <= lower_bound:
-                    continue
-                if device_id in device_set:
-                    continue
-
-
-            # check if building is in temporary list
-            # add new dictionary to response list if not
-            if row[36] not in temp_list:
-
-                response_data["date"] = row[32][:10]
-                response_data["building"] = row[36]
-
-                # add building coordinates
-                response_data["building_lat"] = building_dict[row[36]][0]
-                response_data["building_long"] = building_dict[row[36]][1]
-
-
-                response_data["connection_count"] = 0
-
-                # append dictionary to list
-                # append building name to temporary list
-                response.append(response_data)
-                temp_list.append(row[36])
-            device_set.add(device_id)
-
-            # add temp dict
-            for i in range(len(response)):
-                if response[i]['building'] == row[36]:
-                    response[i]["connection_count"] += 1
-            
-                        
-    return response
+            if store is None:
+                store = open_sessions(path)
+                columns, _ = building_columns(store)
+            rows = store.sessions_between(float(time), float(time) + 59)
+            rows = rows[columns[store.building[rows]] >= 0]
+            # a device only counts towards the first building it is seen in
+            rows = first_per_device(store, rows)
+            matrix[i] = np.bincount(columns[store.building[rows]], minlength=len(building_dict))
+
+    # leave out buildings nobody connected to in the range
+    buildings = list(building_dict)
+    used = np.flatnonzero(matrix.any(axis=0))
+
+    return {
+        "date": date,
+        "granularity": "hour" if hour else "minute",
+        "times": times,
+        "buildings": [buildings[b] for b in used],
+        "building_lat": [building_dict[buildings[b]][0] for b in used],
+        "building_long": [building_dict[buildings[b]][1] for b in used],
+        "connection_count": matrix[:, used].tolist()
+    }
 
 # get building occupancy stats within hour 
 # time parameter gives lower bound, upper bound is time + 59
@@ -99,195 +214,314 @@ def building_occupancy(path, building, time, hour=False):
     if building not in building_dict:
         return "Data unavailable"
 
-    with open(path, "r") as file:
-        reader = csv.reader(file)
-        next(reader)  # Skip header
+    cube = cube_for(path, time, hour)
+    if cube is not None:
+        return building_occupancy_cube(cube, building, time, hour)
 
-        device_set = set()
-        time_arr = []
-        
-        lower_bound = float(time)
-        upper_bound = float(time) + 59
-
-        connection_count = 0
-
-        max_floor = 0
-        
-        for row in reader:
-            
-            if row[36] != building:
-                continue
-            points = row[1].strip("[]").split(',')
-
-            for p in points:
-                ap = p.strip(" ' '")
-                ap_name = ap.split("-")
-                level = re.search(r'\d', ap_name[1])
-                floor_level = int(level.group(0))
-                
-                if floor_level > max_floor:
-                    max_floor = floor_level
-
-
-            start = row[2].strip("[]").split(',')
-            end = row[3].strip("[]").split(',')
-
-            if hour is True:
-                device_id = row[26]
-
-                if int(start[0]) > upper_bound or float(end[-1]) <= lower_bound:
-                    continue
-                
-                if float(start[0]) < lower_bound and float(end[-1]) > upper_bound:
-                    time_arr.append(60.0)
-
-                # device start time is lower than lower bound
-                # subtract end time by lower bound to get total time
-                elif (float(start[0]) < lower_bound):
-                    t = float(end[-1]) - lower_bound
-                    time_arr.append(t)
-
-                # device start time is lower than lower bound
-                # subtract end time by lower bound to get total time
-                elif (float(end[-1]) > upper_bound):
-                    t = upper_bound - float(start[0])
-                    time_arr.append(t)
-
-                #8 device start and end time is within bounds
-                else:
-                    time_arr.append(float(end[-1]) - float(start[0]))
-
-
-                if device_id not in device_set:
-                    connection_count += 1
-                device_set.add(device_id)
-            
-            else:
-                if int(start[0]) > int(time) or float(end[-1]) <= int(time):
-                    continue
-                else:
-                    connection_count += 1
+    store = load_sessions(path)
+    if store is None:
+        return building_occupancy_csv(path, building, time, hour)
+    return building_occupancy_store(store, building, time, hour)
 
+@timed("cube")
+def building_occupancy_cube(cube, building, time, hour=False):
+    b = cube.building_codes[building]
+    max_floor = int(cube.floors[b])
 
     if hour is True:
-        # convert array to pandas series
-        s = pd.Series(time_arr)
-        
-        # include relevant information in dict and return
-        stats_dict = {
+        h = int(time) // 60
+        n = int(cube.hour_sessions[h, b])
+        total = float(cube.hour_dwell[h, b])
+
+        # same as pandas mean/std (n - 1) over the minutes spent in the hour
+        average = np.float64(total / n) if n > 0 else np.float64("nan")
+        if n > 1:
+            variance = (float(cube.hour_dwell_sq[h, b]) - total * total / n) / (n - 1)
+            standard_deviation = np.float64(np.sqrt(max(variance, 0.0)))
+        else:
+            standard_deviation = np.float64("nan")
+
+        return {
             'building': building,
             'building_lat': building_dict[building][0],
             'building_long': building_dict[building][1],
-            'average': round(s.mean(),1),
-            'standard_deviation': round(s.std(),1),
-            'connection_count': connection_count,
+            'average': round_stat(average),
+            'standard_deviation': round_stat(standard_deviation),
+            'connection_count': int(cube.hour_devices[h, b]),
             "no_floors": max_floor
         }
-    else:
-        stats_dict = {
+
+    return {
+        'building': building,
+        'building_lat': building_dict[building][0],
+        'building_long': building_dict[building][1],
+        'connection_count': int(cube.minute_count[int(time), b]),
+        "no_floors": max_floor
+    }
+
+def building_occupancy_store(store, building, time, hour=False):
+    return buildings_occupancy_store(store, [building], time, hour)[building]
+
+def building_occupancy_csv(path, building, time, hour=False):
+    return buildings_occupancy_csv(path, [building], time, hour)[building]
+
+# round a dwell statistic, None when it is undefined (no sessions, or a
+# single one for the standard deviation) since JSON has no NaN
+def round_stat(value):
+    if pd.isna(value):
+        return None
+    return round(value,1)
+
+# building_occupancy response from the counts of one building
+def building_stats(building, connection_count, max_floor, time_arr=None):
+    if time_arr is None:
+        return {
             'building': building,
             'building_lat': building_dict[building][0],
             'building_long': building_dict[building][1],
             'connection_count': connection_count,
             "no_floors": max_floor
         }
-    return stats_dict
+
+    # convert array to pandas series
+    s = pd.Series(time_arr)
+    return {
+        'building': building,
+        'building_lat': building_dict[building][0],
+        'building_long': building_dict[building][1],
+        'average': round_stat(s.mean()),
+        'standard_deviation': round_stat(s.std()),
+        'connection_count': connection_count,
+        "no_floors": max_floor
+    }
+
+# get building occupancy stats of many buildings at once
+def buildings_occupancy(path, buildings, time, hour=False):
+    '''
+    Get the building_occupancy stats of several buildings in one pass
+
+    returns a dict of building -> what building_occupancy returns for it
+    '''
+    buildings = [b for b in buildings if b in building_dict]
+
+    cube = cube_for(path, time, hour)
+    if cube is not None:
+        return {b: building_occupancy_cube(cube, b, time, hour) for b in buildings}
+
+    store = load_sessions(path)
+    if store is None:
+        return buildings_occupancy_csv(path, buildings, time, hour)
+    return buildings_occupancy_store(store, buildings, time, hour)
+
+@timed("store")
+def buildings_occupancy_store(store, buildings, time, hour=False):
+    codes = [store.building_codes.get(b, -1) for b in buildings]
+
+    if hour is False:
+        rows = store.sessions_between(int(time), int(time))
+        counts = np.bincount(store.building[rows], minlength=len(store.buildings))
+        return {
+            b: building_stats(b, int(counts[code]) if code >= 0 else 0, store.max_floor(b))
+            for b, code in zip(buildings, codes)
+        }
+
+    lower_bound = float(time)
+    upper_bound = float(time) + 59
+
+    rows = store.sessions_between(lower_bound, upper_bound)
+    start = store.start[rows]
+    end = store.end[rows]
+
+    # time spent within the hour, clipped to its bounds
+    time_arr = np.select(
+        [(start < lower_bound) & (end > upper_bound), start < lower_bound, end > upper_bound],
+        [60.0, end - lower_bound, upper_bound - start],
+        end - start
+    )
+
+    # group the sessions by building, file order kept inside each group
+    order = np.argsort(store.building[rows], kind="stable")
+    bounds = np.searchsorted(store.building[rows][order], np.arange(len(store.buildings) + 1))
+
+    response = {}
+    for b, code in zip(buildings, codes):
+        group = order[bounds[code]:bounds[code + 1]] if code >= 0 else order[:0]
+        connection_count = len(np.unique(store.device[rows[group]]))
+        response[b] = building_stats(b, connection_count, store.max_floor(b), time_arr[group])
+    return response
+
+@timed("csv")
+def buildings_occupancy_csv(path, buildings, time, hour=False):
+    # one building's sessions are picked out while reading, several after
+    where = (36, buildings) if len(buildings) == 1 else None
+    aps, starts, ends, devices, names = read_columns(path, [1, 2, 3, 26, 36], where=where)
+    building, table = factorize(names)
+    codes = {b: code for code, b in enumerate(table.tolist())}
+    wanted = np.zeros(len(table), dtype=bool)
+    wanted[[codes[b] for b in buildings if b in codes]] = True
+    rows = np.flatnonzero(wanted[building])
+    building = building[rows]
+
+    # highest floor of the access points used in each building, 0 if none has one
+    ap, ap_names, ap_offsets = string_lists([aps[i] for i in rows])
+    floors = np.array([ap_floor(name) for name in ap_names.tolist()], dtype=np.int32)
+    max_floor = np.zeros(len(table), dtype=np.int32)
+    np.maximum.at(max_floor, np.repeat(building, np.diff(ap_offsets)), floors[ap])
+
+    start, start_offsets = number_lists([starts[i] for i in rows])
+    end, end_offsets = number_lists([ends[i] for i in rows])
+    start, end = firsts(start, start_offsets), lasts(end, end_offsets)
+
+    if hour is False:
+        inside = (start <= int(time)) & (end > int(time))
+        counts = np.bincount(building[inside], minlength=len(table))
+        return {
+            b: building_stats(b, int(counts[codes[b]]), int(max_floor[codes[b]])) if b in codes
+            else building_stats(b, 0, 0)
+            for b in buildings
+        }
+
+    lower_bound = float(time)
+    upper_bound = float(time) + 59
+
+    inside = np.flatnonzero((start <= upper_bound) & (end > lower_bound))
+    start = start[inside]
+    end = end[inside]
+    device, _ = factorize([devices[i] for i in rows[inside]])
+
+    # time spent within the hour, clipped to its bounds
+    time_arr = np.select(
+        [(start < lower_bound) & (end > upper_bound), start < lower_bound, end > upper_bound],
+        [60.0, end - lower_bound, upper_bound - start],
+        end - start
+    )
+
+    # group the sessions by building, file order kept inside each group
+    order = np.argsort(building[inside], kind="stable")
+    bounds = np.searchsorted(building[inside][order], np.arange(len(table) + 1))
+
+    response = {}
+    for b in buildings:
+        code = codes.get(b)
+        if code is None:
+            response[b] = building_stats(b, 0, 0, time_arr[:0])
+            continue
+        group = order[bounds[code]:bounds[code + 1]]
+        response[b] = building_stats(b, len(np.unique(device[group])), int(max_floor[code]), time_arr[group])
+    return response
+
+# get the floors of a building that have access points
+def building_floors(path, building):
+    '''
+    Get the floors of a building from the day's access point table
+
+    returns the highest floor and, per floor in use, how many access points
+    it has and how many of them have a location in ap_dict
+    '''
+    if building not in building_dict:
+        return "Data unavailable"
+
+    store = open_sessions(path)
+    return {
+        "building": building,
+        "building_lat": building_dict[building][0],
+        "building_long": building_dict[building][1],
+        "no_floors": store.max_floor(building),
+        "floors": [
+            {"floor": floor, "access_points": count, "mapped_access_points": mapped}
+            for floor, count, mapped in store.floors(building)
+        ]
+    }
 
 def ap_occupancy(path, building, time, floor, hour=False):
 
     if building not in ap_dict:
         return "Data unavailable"
 
+    store = load_sessions(path)
+    if store is None:
+        return ap_occupancy_csv(path, building, time, floor, hour)
+    return ap_occupancy_store(store, building, time, floor, hour)
 
-    with open(path, "r") as file:
+@timed("store")
+def ap_occupancy_store(store, building, time, floor, hour=False):
+    if hour is False:
+        conns = store.connections_between(int(time), int(time))
+    else:
+        conns = store.connections_between(float(time), float(time) + 59)
 
-        reader = csv.reader(file)
-        next(reader)  # Skip header
-        
-        response = []
-        temp_list = []
-        device_set = set()
+    code = store.building_codes.get(building, -1)
+    conns = conns[store.building[store.ap_session[conns]] == code]
+    conns = conns[store.ap_floors[store.ap[conns]] == floor]
 
-        # Process only the first row after the header
-        for row in reader:
-            if building != row[36]:
-                continue
-            count_rooms = int(row[0])
-            rooms = row[1].strip("[]").split(',')
-            start = row[2].strip("[]").split(',')
-            end = row[3].strip("[]").split(',')
-            device_id = row[26]
-   
-            
-            response_data = {}
-            
-            for n in range(count_rooms):
-
-
-                ap = rooms[n].strip(" ' '")
-                ap_name = ap.split("-")
-                level = re.search(r'\d', ap_name[1])
-                floor_level = int(level.group(0))
-                
-                if hour is False:
-                    if int(start[n]) > int(time) or float(end[n]) <= int(time):
-                        continue
-                else:
-                    lower_bound = float(time)
-                    upper_bound = float(time) + 59
-                    if int(start[n]) > upper_bound or float(end[n]) <= lower_bound:
-                        continue
-                    
-                    if device_id in device_set:
-                        continue
-                    
-                
-
-                
-                if floor != floor_level:
-                    continue
-                
-                if ap not in temp_list:
-
-                    #print(row[36])
-                    response_data["date"] = row[32][:10]
-                    response_data["access_point"] = ap
-                    #response_data["floor"] = floor.group(0)
-                    
-                    response_data["connection_count"] = 0
-                    
-                    if ap in ap_dict[building]:
-                        response_data["building_lat"] = ap_dict[building][ap][0]
-                        response_data["building_long"] = ap_dict[building][ap][1]
-                    else:
-                        #print(row[36])
-                        response_data["building_lat"] = 0
-                        response_data["building_long"] = 0
-                        
-                    #response[row[36]] = response_data
-                    response.append(response_data)
-                    temp_list.append(ap)
-    
-                device_set.add(device_id)
+    if hour is True:
+        # a device only counts towards the first access point it is seen on
+        _, first = np.unique(store.device[store.ap_session[conns]], return_index=True)
+        conns = conns[np.sort(first)]
+
+    response = []
+    for code, conn, count in zip(*group_in_order(store.ap[conns], conns)):
+        ap = str(store.aps[code])
+        lat, long = (0, 0) if np.isnan(store.ap_lat[code]) else (float(store.ap_lat[code]), float(store.ap_long[code]))
+        response.append({
+            "date": str(store.dates[store.date[store.ap_session[conn]]]),
+            "access_point": ap,
+            "connection_count": int(count),
+            "building_lat": lat,
+            "building_long": long
+        })
+    return response
 
-            
+@timed("csv")
+def ap_occupancy_csv(path, building, time, floor, hour=False):
+    return ap_counts(ap_csv_columns(path, building), building, time, floor, hour)
+
+# the columns of a building's rows in a Sessions_Total CSV ap_counts needs, parsed
+def ap_csv_columns(path, building):
+    aps, starts, ends, devices, dates = read_columns(path, [1, 2, 3, 26, 32], where=(36, [building]))
+    ap, ap_names, ap_offsets = string_lists(aps)
+    ap_start, _ = number_lists(starts)
+    ap_end, _ = number_lists(ends)
+    # session (row read) of every access point connection
+    ap_row = np.repeat(np.arange(len(aps)), np.diff(ap_offsets))
+    return ap, ap_names, ap_start, ap_end, ap_row, devices, dates
+
+# ap_occupancy from the parsed columns of the building's rows, the benchmark times it on its own
+def ap_counts(columns, building, time, floor, hour=False):
+    ap, ap_names, ap_start, ap_end, ap_row, devices, dates = columns
+
+    if hour is False:
+        conns = np.flatnonzero((ap_start <= int(time)) & (ap_end > int(time)))
+    else:
+        conns = np.flatnonzero((ap_start <= float(time) + 59) & (ap_end > float(time)))
 
-                
-                for i in range(len(response)):
-                    if response[i]['access_point'] == ap:
-                        response[i]["connection_count"] += 1
-                
-    
+    floors = np.array([ap_floor(name) for name in ap_names.tolist()], dtype=np.int32)
+    conns = conns[floors[ap[conns]] == floor]
+
+    if hour is True:
+        # a device only counts towards the first access point it is seen on
+        device, _ = factorize([devices[i] for i in ap_row[conns]])
+        _, first = np.unique(device, return_index=True)
+        conns = conns[np.sort(first)]
+
+    response = []
+    for code, conn, count in zip(*group_in_order(ap[conns], conns)):
+        name = str(ap_names[code])
+        lat, long = ap_dict[building].get(name, (0, 0))
+        response.append({
+            "date": dates[ap_row[conn]][:10],
+            "access_point": name,
+            "connection_count": int(count),
+            "building_lat": lat,
+            "building_long": long
+        })
     return response
 
 def trajectory_csv_data(date):
-    path = os.path.abspath(os.path.join(os.getcwd(), "csv_data", "Trajectory"))
-    for file in os.listdir(path):
-        if file.endswith("_finaltraj.csv"):
-            return os.path.join(path, file)
-
-    
-    return "error"
+    path = dataset_catalog().path("Trajectory", date)
+    if path is None:
+        return "error"
+    return path
 
 def time_and_date(timestamp_str):
      # parse in ISO 8601
@@ -310,39 +544,90 @@ def time_and_date(timestamp_str):
     return date, minutes_offset
 
 def device_traj(path, user_id):
-    with open(path, "r") as file:
-        reader = csv.reader(file)
-        next(reader)  # Skip header
-        
-        response = []
-
-        for row in reader:
-            if user_id != row[0]:
-                continue
+    '''
+    Get the stays of a device, one list per trajectory row
 
-            traj_session = []
-            traj = row[1].strip("[]").split(',')
-            start = row[2].strip("[]").split(',')
-            end = row[3].strip("[]").split(',')
-
-
-            for n in range(len(traj)):
-                building = traj[n].strip(" ' '")
-                if float(end[n]) - float(start[n]) < 1:
-                    continue
-                if building != "UNKN":  
-                    stay_time = {
-                        "building": building,
-                        "building_lat": building_dict[building][0],
-                        "building_long": building_dict[building][1],
-                        "start_time": convert(start[n]),
-                        "end_time": convert(end[n]),
-                        "total_time": float(end[n]) - float(start[n])
-                    }
-                    traj_session.append(stay_time)
-            
-            response.append(traj_session)
-        
+    looks the device up in the day's trajectory index, the CSV is only
+    scanned while the index is missing (it is then built in the background)
+    '''
+    index = load_trajectory_index(path)
+    if index is None:
+        if getattr(settings, "TRAJECTORY_INDEX_AUTOBUILD", False):
+            index_in_background(path)
+        return device_traj_csv(path, user_id)
+    return device_traj_index(index, user_id)
+
+# reads the per-day trajectory files of range queries, shared by all requests
+trajectory_workers = getattr(settings, "TRAJECTORY_WORKERS", 4)
+trajectory_pool = ThreadPoolExecutor(max_workers=trajectory_workers, thread_name_prefix="trajectory")
+
+def device_traj_days(user_id, dates):
+    '''
+    Get the stays of a device over several days
+
+    yields (date, stays) for every date that has a trajectory file, in the
+    order given; days are read on trajectory_pool, at most one per worker
+    ahead of the consumer, so memory does not grow with the range
+    '''
+    dates = iter(dates)
+    pending = deque()
+
+    def submit():
+        for date in dates:
+            path = trajectory_csv_data(date)
+            if path != "error":
+                pending.append((date, trajectory_pool.submit(device_traj, path, user_id)))
+                return
+
+    for _ in range(trajectory_workers):
+        submit()
+
+    while pending:
+        date, future = pending.popleft()
+        submit()
+        yield date, future.result()
+
+@timed("trajectory_index")
+def device_traj_index(index, user_id):
+    response = []
+    for stays in index.trajectories(user_id):
+        traj_session = []
+        for building, start, end in stays:
+            traj_session.append({
+                "building": building,
+                "building_lat": building_dict[building][0],
+                "building_long": building_dict[building][1],
+                "start_time": convert(start),
+                "end_time": convert(end),
+                "total_time": end - start
+            })
+        response.append(traj_session)
+    return response
+
+@timed("csv")
+def device_traj_csv(path, user_id):
+    traj, starts, ends = read_columns(path, [1, 2, 3], where=(0, [user_id]))
+    building, names, offsets = string_lists(traj)
+    names = names[building].tolist()
+    start = number_lists(starts)[0].tolist()
+    end = number_lists(ends)[0].tolist()
+
+    response = []
+    for r in range(len(traj)):
+        traj_session = []
+        for n in range(offsets[r], offsets[r + 1]):
+            if end[n] - start[n] < 1:
+                continue
+            if names[n] != "UNKN" and names[n] in building_dict:
+                traj_session.append({
+                    "building": names[n],
+                    "building_lat": building_dict[names[n]][0],
+                    "building_long": building_dict[names[n]][1],
+                    "start_time": convert(start[n]),
+                    "end_time": convert(end[n]),
+                    "total_time": end[n] - start[n]
+                })
+        response.append(traj_session)
     return response
 
 
@@ -0,0 +1,99 @@
+import os
+import hashlib
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+
+# bump whenever the responses of the cached views change for the same files,
+# so browsers and proxies stop reusing the old ones
+ETAG_VERSION = 1
+
+
+def source_validators(path, request):
+    '''
+    ETag and Last-Modified of a response computed from a data file
+
+    the ETag covers the file (path, size, modification time), the request
+    path, the query parameters and the Accept header (JSON or the browsable
+    API); returns (etag, last modified timestamp)
+    '''
+    stat = os.stat(path)
+    digest = hashlib.sha1(f"{ETAG_VERSION}:{path}:{stat.st_size}:{stat.st_mtime_ns}:{request.path}".encode())
+    for key, values in sorted(request.GET.lists()):
+        digest.update(f"&{key}={','.join(values)}".encode())
+    digest.update(f"|{request.META.get('HTTP_ACCEPT', '')}".encode())
+    return quote_etag(digest.hexdigest()[:24]), int(stat.st_mtime)
+
+
+# seconds a response about a date (YYYYMMDD) may be reused without asking again
+def max_age(date):
+    cache_settings = getattr(settings, "HTTP_CACHE", {})
+    if date < f"{timezone.localdate():%Y%m%d}":
+        return cache_settings.get("PAST_MAX_AGE", 604800)
+    return cache_settings.get("TODAY_MAX_AGE", 10)
+
+
+def conditional(source):
+    '''
+    Conditional GET for a view method answering from one day's data file
+
+    source(request, **kwargs) returns the (file path, date YYYYMMDD) the
+    response is computed from, or None when the request is invalid (the
+    view then runs and reports the error). A request whose If-None-Match or
+    If-Modified-Since still matches the file gets a 304 without running the
+    view. 200 and 304 responses carry the ETag, Last-Modified and a public
+    Cache-Control, long for past days and short for today, which can still
+    get new sessions.
+    '''
+
+    def decorator(method):
+        def before(request, kwargs):
+            found = source(request, **kwargs)
+            if found is None:
+                return None, None
+            path, date = found
+            try:
+                etag, last_modified = source_validators(path, request)
+            except OSError:
+                return None, None
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            return response, (etag, last_modified, max_age(date))
+
+        def after(response, headers):
+            if headers is None or response.status_code not in (200, 304):
+                return response
+            etag, last_modified, age = headers
+            response.headers.setdefault("ETag", etag)
+            response.headers.setdefault("Last-Modified", http_date(last_modified))
+            patch_cache_control(response, public=True, max_age=age)
+            # the format (JSON, compact, MessagePack) can come from the Accept header
+            patch_vary_headers(response, ("Accept",))
+            return response
+
+        if iscoroutinefunction(method):
+
+            @wraps(method)
+            async def inner(self, request, *args, **kwargs):
+                # source() and the stat hit the disk and the catalog, keep
+                # them off the event loop
+                response, headers = await sync_to_async(before, thread_sensitive=False)(request, kwargs)
+                if response is None:
+                    response = await method(self, request, *args, **kwargs)
+                return after(response, headers)
+
+        else:
+
+            @wraps(method)
+            def inner(self, request, *args, **kwargs):
+                response, headers = before(request, kwargs)
+                if response is None:
+                    response = method(self, request, *args, **kwargs)
+                return after(response, headers)
+
+        return inner
+
+    return decorator
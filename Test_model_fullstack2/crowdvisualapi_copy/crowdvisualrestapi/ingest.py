@@ -0,0 +1,317 @@
+import os
+import re
+import json
+import hashlib
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+import numpy as np
+from .consts import building_dict
+from .store import data_root, session_row, append_csv, update_store, open_sessions, is_converted
+from .rollup import build_rollup, is_rolled_up
+
+
+# one association event per line, e.g.
+# 2021-03-01 08:15:22 wlc1 stm[2211]: Station 3c:22:fb:01:02:03 associated to AP LGRC-A307-1
+# 2021-03-01 08:31:40 wlc1 stm[2211]: Station 3c:22:fb:01:02:03 disassociated from AP LGRC-A307-1
+# other controllers need their own pattern with the same four groups
+SYSLOG_PATTERN = (
+    r"^(?P<timestamp>\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2})\S*\s.*?"
+    r"Station (?P<device>\S+) (?P<event>associated|reassociated|disassociated|deauthenticated) "
+    r"(?:to|from) AP (?P<ap>\S+)"
+)
+LEAVE_EVENTS = ("disassociated", "deauthenticated")
+
+CHECKPOINT_VERSION = 1
+CHECKPOINT_NAME = "syslog_checkpoint.json"
+
+
+# devices are stored under a hash of their MAC address, like the exported files
+def device_id(mac):
+    return "#" + hashlib.sha1(mac.lower().encode()).hexdigest()[:12] + "#"
+
+
+def parse_line(line, pattern):
+    '''
+    Get (time, device, event, access point) from a syslog line
+
+    returns None for lines that are not association events or are on an
+    access point of a building the map does not know
+    '''
+    match = pattern.search(line)
+    if match is None:
+        return None
+    if match["ap"].split("-")[0] not in building_dict:
+        return None
+    when = datetime.fromisoformat(match["timestamp"])
+    return when, device_id(match["device"]), match["event"], match["ap"]
+
+
+def read_chunk(path, offset, max_lines, partial=False):
+    '''
+    Read up to max_lines lines of a file from a byte offset
+
+    a last line without its newline is left for the next read (the logger
+    may still be writing it) unless partial is True
+    returns (lines, offset after the last line read)
+    '''
+    lines = []
+    with open(path, "rb") as file:
+        file.seek(offset)
+        while len(lines) < max_lines:
+            line = file.readline()
+            if not line or (not line.endswith(b"\n") and not partial):
+                break
+            lines.append(line.decode("utf-8", "replace"))
+            offset += len(line)
+    return lines, offset
+
+
+def minute_of(when):
+    return when.hour * 60 + when.minute
+
+
+class Sessionizer:
+    '''
+    Turn association events into sessions like the *_sessions_final.csv
+    rows: one per device per building per day, with a connection per
+    access point in the order they were used
+
+    A session ends when its device shows up in another building or on
+    another day, or after it has been disassociated for more than gap
+    minutes (roaming between access points of a building keeps it open).
+    At most max_open sessions are kept open, past that the one of the
+    device seen longest ago is ended early, so memory stays bounded
+    whatever the number of devices. Ended sessions wait in closed until
+    take() hands them out.
+    '''
+
+    def __init__(self, gap=1, max_open=100000, state=None):
+        self.gap = timedelta(minutes=gap)
+        self.max_open = max_open
+        self.open = OrderedDict()  # device -> session, least recently seen first
+        self.closed = []
+        self.clock = None  # time of the latest event
+
+        if state:
+            self.clock = state["clock"] and datetime.fromisoformat(state["clock"])
+            for device, session in state["sessions"]:
+                self.open[device] = dict(session, seen=datetime.fromisoformat(session["seen"]))
+
+    def state(self):
+        '''
+        Open sessions and clock as JSON data, see __init__
+        '''
+        return {
+            "clock": self.clock and self.clock.isoformat(),
+            "sessions": [[device, dict(session, seen=session["seen"].isoformat())]
+                         for device, session in self.open.items()],
+        }
+
+    def idle(self, session, when):
+        return not session["connected"] and when - session["seen"] > self.gap
+
+    def feed(self, when, device, event, ap):
+        building = ap.split("-")[0]
+        minute = minute_of(when)
+        day = when.date().isoformat()
+        if self.clock is None or when > self.clock:
+            self.clock = when
+
+        session = self.open.get(device)
+        if session is not None and (session["date"] != day or session["building"] != building
+                                    or self.idle(session, when)):
+            self.close(device)
+            session = None
+
+        if event in LEAVE_EVENTS:
+            # only the access point the device is on can end its connection
+            if session is not None and session["connected"] and session["aps"][-1] == ap:
+                session["ends"][-1] = float(minute)
+                session["connected"] = False
+                session["seen"] = when
+                self.open.move_to_end(device)
+            return
+
+        if session is None:
+            session = self.open[device] = {
+                "date": day, "building": building, "aps": [], "starts": [], "ends": [],
+                "connected": False, "seen": when,
+            }
+        elif session["connected"]:
+            if session["aps"][-1] == ap:
+                # associated again to the access point it is on
+                session["seen"] = when
+                self.open.move_to_end(device)
+                return
+            session["ends"][-1] = float(minute)
+
+        session["aps"].append(ap)
+        session["starts"].append(minute)
+        session["ends"].append(float(minute))
+        session["connected"] = True
+        session["seen"] = when
+        self.open.move_to_end(device)
+
+        while len(self.open) > self.max_open:
+            self.close(next(iter(self.open)))
+
+    def close(self, device):
+        session = self.open.pop(device)
+        if session["connected"]:
+            # still associated: it lasts until the latest event of its day
+            end = minute_of(self.clock) if self.clock.date().isoformat() == session["date"] else 1440
+            session["ends"][-1] = max(session["ends"][-1], float(end))
+        self.closed.append((device, session))
+
+    def expire(self):
+        '''
+        End the sessions idle for more than gap at the latest event time
+        and the sessions of earlier days
+        '''
+        if self.clock is None:
+            return
+        today = self.clock.date().isoformat()
+        for device in list(self.open):
+            session = self.open[device]
+            if session["seen"] >= self.clock - self.gap and session["date"] == today:
+                # sessions after it were seen even later
+                break
+            if session["date"] != today or self.idle(session, self.clock):
+                self.close(device)
+
+    # end every open session
+    def finish(self):
+        for device in list(self.open):
+            self.close(device)
+
+    # ended sessions as (device, session), oldest first, and forget them
+    def take(self):
+        closed, self.closed = self.closed, []
+        return closed
+
+
+# Sessions_Total file of a day (YYYY-MM-DD)
+def sessions_csv(day):
+    return os.path.join(data_root(), "Sessions_Total", day.replace("-", "") + "_sessions_final.csv")
+
+
+def written_sessions(csv_path, devices):
+    '''
+    (device, building, first start) of the sessions of some devices already
+    in a day's file, from its store (or the CSV when the store is behind it)
+    '''
+    if not os.path.exists(csv_path):
+        return set()
+    store = open_sessions(csv_path)
+    rows = np.flatnonzero(np.isin(store.devices, list(devices))[store.device])
+    return set(zip(
+        store.devices[store.device[rows]].tolist(),
+        store.buildings[store.building[rows]].tolist(),
+        store.start[rows].tolist()
+    ))
+
+
+class SessionWriter:
+    '''
+    Append ended sessions to the Sessions_Total file of their day, and bring
+    the stores and rollups of the days that got some up to date on refresh()
+
+    The CSV gets every batch as it comes; a day's store and rollup are
+    rewritten whole, so they are only redone on refresh (every few minutes
+    while following, and when the command ends), not on every write.
+
+    Sessions the file already has are left out: a run stopped after writing
+    but before saving its checkpoint reads the same events again when it
+    resumes. A device has one session per building starting at a minute,
+    so (device, building, first start) tells them apart. A run never hands
+    out a session twice itself, so a day's file is only checked the first
+    time the run writes to it.
+    '''
+
+    def __init__(self):
+        self.checked = set()
+        self.pending = {}  # day -> (store was up to date before the rows, rows since refresh)
+
+    def write(self, sessions):
+        '''
+        Append ended sessions to the CSV of their day
+
+        returns the number of sessions written
+        '''
+        by_day = {}
+        for device, session in sessions:
+            by_day.setdefault(session["date"], []).append((device, session))
+
+        written = 0
+        for day, day_sessions in by_day.items():
+            csv_path = sessions_csv(day)
+            done = set()
+            if day not in self.checked:
+                done = written_sessions(csv_path, {device for device, _ in day_sessions})
+                self.checked.add(day)
+                # an earlier run stopped before refreshing the day
+                if os.path.exists(csv_path) and not (is_converted(csv_path) and is_rolled_up(csv_path)):
+                    self.pending.setdefault(day, (False, []))
+
+            rows = [
+                session_row(device, session["building"], session["aps"], session["starts"], session["ends"],
+                            date.fromisoformat(day))
+                for device, session in day_sessions
+                if (device, session["building"], float(session["starts"][0])) not in done
+            ]
+            if not rows:
+                continue
+            if day not in self.pending:
+                self.pending[day] = (os.path.exists(csv_path) and is_converted(csv_path), [])
+            append_csv(csv_path, rows)
+            self.pending[day][1].extend(rows)
+            written += len(rows)
+        return written
+
+    def refresh(self):
+        '''
+        Update the store and rollup of every day written to since the last
+        refresh, so the occupancy views and aggregates include its sessions
+
+        returns the days refreshed
+        '''
+        days = sorted(self.pending)
+        for day in days:
+            current, rows = self.pending.pop(day)
+            csv_path = sessions_csv(day)
+            # converted again meanwhile (build_store), it has the rows already
+            if not is_converted(csv_path):
+                update_store(csv_path, rows, current)
+            build_rollup(csv_path)
+        return days
+
+
+def checkpoint_path():
+    return os.path.join(data_root(), CHECKPOINT_NAME)
+
+
+def load_checkpoint(path):
+    '''
+    Get the read position of every syslog file and the sessions left open
+    by the last run
+
+    returns an empty checkpoint when there is none (or of another version)
+    '''
+    if os.path.exists(path):
+        with open(path) as file:
+            checkpoint = json.load(file)
+        if checkpoint.get("version") == CHECKPOINT_VERSION:
+            return checkpoint
+    return {"version": CHECKPOINT_VERSION, "files": {}, "sessionizer": None}
+
+
+def save_checkpoint(path, files, sessionizer):
+    checkpoint = {"version": CHECKPOINT_VERSION, "files": files, "sessionizer": sessionizer.state()}
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(tmp, path)
+
+
+def compile_pattern(pattern=None):
+    return re.compile(pattern or SYSLOG_PATTERN)
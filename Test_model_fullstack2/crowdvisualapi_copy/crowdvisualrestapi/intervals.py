@@ -0,0 +1,101 @@
+import numpy as np
+
+
+class _Node:
+    __slots__ = ("center", "left", "right", "by_start", "starts", "by_end", "ends", "ids")
+
+
+class IntervalIndex:
+    '''
+    Centered interval tree over [start, end) minute intervals
+
+    overlapping(lo, hi) returns the indices (ascending) of every interval with
+    start <= hi and end > lo in O(log n + k), which is the test the occupancy
+    helpers apply to each session: lo == hi for a single minute, hi = lo + 59
+    for an hour
+    '''
+
+    LEAF_SIZE = 32
+
+    def __init__(self, start, end):
+        self.start = np.asarray(start, dtype=np.float64)
+        self.end = np.asarray(end, dtype=np.float64)
+
+        ids = np.arange(len(self.start))
+        proper = self.end > self.start
+
+        # zero-length (or inverted) intervals have no center to hang on,
+        # they are rare and get checked directly
+        self.degenerate = ids[~proper]
+        self.root = self._build(ids[proper])
+
+    def __len__(self):
+        return len(self.start)
+
+    def _build(self, ids):
+        if len(ids) == 0:
+            return None
+
+        node = _Node()
+        if len(ids) <= self.LEAF_SIZE:
+            node.ids = ids
+            return node
+        node.ids = None
+
+        start = self.start[ids]
+        end = self.end[ids]
+        center = float(np.median(start))
+        node.center = center
+
+        # left holds intervals ending at or before the center, right those
+        # starting after it, the node keeps the ones that contain it
+        left = end <= center
+        right = start > center
+        here = ~(left | right)
+
+        node.left = self._build(ids[left])
+        node.right = self._build(ids[right])
+
+        here_ids = ids[here]
+        order = np.argsort(start[here], kind="stable")
+        node.by_start = here_ids[order]
+        node.starts = start[here][order]
+        order = np.argsort(end[here], kind="stable")
+        node.by_end = here_ids[order]
+        node.ends = end[here][order]
+        return node
+
+    def overlapping(self, lo, hi):
+        found = []
+
+        if len(self.degenerate):
+            d = self.degenerate
+            found.append(d[(self.start[d] <= hi) & (self.end[d] > lo)])
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+
+            if node.ids is not None:
+                ids = node.ids
+                found.append(ids[(self.start[ids] <= hi) & (self.end[ids] > lo)])
+            elif hi < node.center:
+                # every interval here ends after hi, only the start matters
+                k = np.searchsorted(node.starts, hi, side="right")
+                found.append(node.by_start[:k])
+                stack.append(node.left)
+            elif lo >= node.center:
+                # every interval here starts before lo, only the end matters
+                k = np.searchsorted(node.ends, lo, side="right")
+                found.append(node.by_end[k:])
+                stack.append(node.right)
+            else:
+                found.append(node.by_start)
+                stack.append(node.left)
+                stack.append(node.right)
+
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(found))
@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from django.conf import settings
+from django.utils import timezone
+from .helper import get_csv, campus_occupancy
+from .store import store_path
+
+logger = logging.getLogger(__name__)
+
+# seconds between keepalive comments on a stream that had nothing to send
+KEEPALIVE = 30
+
+
+def live_interval():
+    return getattr(settings, "LIVE_OCCUPANCY_INTERVAL", 10)
+
+
+# minute of the day a key asks for, "now" keys follow the clock
+def key_minute(key):
+    _, minute, hour = key
+    if minute is None:
+        now = timezone.localtime()
+        minute = now.hour * 60 + now.minute
+    if hour:
+        minute -= minute % 60
+    return minute
+
+
+# what a computation of a key depends on: the files of its day and its minute
+def key_inputs(key):
+    path = get_csv(key[0])
+    if path == "error":
+        return None
+    mtimes = tuple(os.path.getmtime(p) if os.path.exists(p) else None for p in (path, store_path(path)))
+    return path, mtimes, key_minute(key)
+
+
+class LiveOccupancy:
+    '''
+    Campus occupancy shared by the live streams of a process
+
+    Streams subscribe with a key, (date YYYYMMDD, minute or None for the
+    current time, hour). Every interval seconds one thread computes
+    campus_occupancy once per subscribed key, and only when the key's files
+    or minute changed since the last time, then wakes the streams of that
+    key only. The cost of a tick depends on the distinct keys, not on the
+    number of streams. The thread stops when the last stream goes away.
+    '''
+
+    def __init__(self, interval=None):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._keys = {}        # key -> streams subscribed to it
+        self._snapshots = {}   # key -> (version, minute, {building: row})
+        self._inputs = {}      # key -> key_inputs of the last computation
+        self._conditions = {}  # key -> Condition (on _lock) its threads wait on
+        self._waiters = {}     # key -> {(loop, asyncio.Event)} of streams served by an event loop
+        self._thread = None
+        self._version = 0
+
+    def subscribe(self, key):
+        with self._lock:
+            self._keys[key] = self._keys.get(key, 0) + 1
+            if key not in self._conditions:
+                self._conditions[key] = threading.Condition(self._lock)
+                self._waiters[key] = set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        # a new key is computed right away, not on the next tick
+        if key not in self._snapshots:
+            self.refresh(key)
+
+    def unsubscribe(self, key):
+        with self._lock:
+            if key not in self._keys:
+                return
+            self._keys[key] -= 1
+            if self._keys[key] == 0:
+                del self._keys[key]
+                self._snapshots.pop(key, None)
+                self._inputs.pop(key, None)
+                self._conditions.pop(key, None)
+                self._waiters.pop(key, None)
+
+    # (version, minute, {building: row}) last computed for a key, or None
+    def snapshot(self, key):
+        with self._lock:
+            return self._snapshots.get(key)
+
+    def _key_version(self, key):
+        snapshot = self._snapshots.get(key)
+        return 0 if snapshot is None else snapshot[0]
+
+    def refresh(self, key):
+        '''
+        Compute a key again if what it depends on changed
+
+        returns True when a new snapshot was published
+        '''
+        inputs = key_inputs(key)
+        with self._lock:
+            if key in self._snapshots and inputs == self._inputs.get(key):
+                return False
+
+        if inputs is None:
+            rows = {}
+            minute = key_minute(key)
+        else:
+            path, _, minute = inputs
+            rows = {row["building"]: row for row in campus_occupancy(path, minute, key[2])}
+
+        with self._lock:
+            if key not in self._keys:
+                return False
+            # versions grow across keys, so one never goes back after a resubscribe
+            self._version += 1
+            self._snapshots[key] = (self._version, minute, rows)
+            self._inputs[key] = inputs
+            self._conditions[key].notify_all()
+            waiters = list(self._waiters[key])
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval or live_interval())
+            with self._lock:
+                keys = list(self._keys)
+                if not keys:
+                    self._thread = None
+                    return
+            for key in keys:
+                try:
+                    self.refresh(key)
+                except Exception:
+                    logger.exception(f"Live occupancy of {key} failed")
+
+    # block until a snapshot of a subscribed key newer than version, or timeout seconds
+    def wait(self, key, version, timeout):
+        with self._lock:
+            self._conditions[key].wait_for(lambda: self._key_version(key) > version, timeout)
+
+    async def wait_async(self, key, version, timeout):
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        with self._lock:
+            if self._key_version(key) > version:
+                return
+            waiters = self._waiters[key]
+            waiters.add(waiter)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                waiters.discard(waiter)
+
+
+live_occupancy = LiveOccupancy()
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_message(sent, current):
+    '''
+    SSE message taking a stream from what it sent to the current snapshot
+
+    sent is None for the first message (a full snapshot), otherwise the
+    {building: row} last sent; returns None when nothing changed
+    '''
+    _, minute, rows = current
+    time_str = f"{minute // 60:02d}:{minute % 60:02d}"
+    if sent is None:
+        return sse("snapshot", {"time": time_str, "data": list(rows.values())})
+
+    changed = [row for building, row in rows.items() if sent.get(building) != row]
+    removed = [building for building in sent if building not in rows]
+    if not changed and not removed:
+        return None
+    return sse("delta", {"time": time_str, "changed": changed, "removed": removed})
+
+
+def live_stream(key, hub=None):
+    '''
+    SSE messages of a key for a thread per connection server (WSGI):
+    a snapshot, then a delta each time the counts change
+    '''
+    hub = hub or live_occupancy
+    try:
+        hub.subscribe(key)
+        version, sent = 0, None
+        last = time.monotonic()
+        while True:
+            current = hub.snapshot(key)
+            if current is not None and current[0] > version:
+                version = current[0]
+                message = stream_message(sent, current)
+                if message is not None:
+                    sent = current[2]
+                    last = time.monotonic()
+                    yield message
+            if time.monotonic() - last >= KEEPALIVE:
+                last = time.monotonic()
+                yield ": keepalive\n\n"
+            hub.wait(key, version, KEEPALIVE)
+    finally:
+        hub.unsubscribe(key)
+
+
+async def live_stream_async(key, hub=None):
+    '''
+    live_stream for ASGI servers, waits on the event loop instead of a thread
+    '''
+    hub = hub or live_occupancy
+    try:
+        await asyncio.to_thread(hub.subscribe, key)
+        version, sent = 0, None
+        last = time.monotonic()
+        while True:
+            current = hub.snapshot(key)
+            if current is not None and current[0] > version:
+                version = current[0]
+                message = stream_message(sent, current)
+                if message is not None:
+                    sent = current[2]
+                    last = time.monotonic()
+                    yield message
+            if time.monotonic() - last >= KEEPALIVE:
+                last = time.monotonic()
+                yield ": keepalive\n\n"
+            await hub.wait_async(key, version, KEEPALIVE)
+    finally:
+        hub.unsubscribe(key)
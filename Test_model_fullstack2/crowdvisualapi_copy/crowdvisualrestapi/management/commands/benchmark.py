@@ -0,0 +1,256 @@
+import os
+import gc
+import json
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+import torch
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory
+from crowdvisualrestapi.consts import building_dict, ap_dict
+from crowdvisualrestapi.synthetic import generate_dataset
+from crowdvisualrestapi.store import convert_sessions
+from crowdvisualrestapi.cube import build_cube
+from crowdvisualrestapi.trajectory import build_trajectory_index
+from crowdvisualrestapi.helper import (campus_occupancy, building_occupancy, ap_occupancy, device_traj, get_csv, trajectory_csv_data,
+                                      campus_csv_columns, campus_counts, ap_csv_columns, ap_counts)
+from crowdvisualrestapi.registry import registry, peak_rss, reference_scaler, EnhancedRNN, feature_count, hidden_size, num_layers, output_size
+from crowdvisualrestapi.views import PredictionAPI, CampusPredictionAPI, prediction_cache
+
+BACKENDS = ("csv", "store", "cube")
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=settings.BASE_DIR
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def measure(fn, repeat):
+    '''
+    Time repeat calls of fn(i) after one untimed call, then record the peak
+    Python allocation of one more call with tracemalloc
+    '''
+    fn(0)
+
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(i)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn(repeat)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "runs": repeat,
+        "p50_ms": round(float(np.percentile(timings, 50)), 3),
+        "p95_ms": round(float(np.percentile(timings, 95)), 3),
+        "mean_ms": round(float(np.mean(timings)), 3),
+        "min_ms": round(float(np.min(timings)), 3),
+        "peak_alloc_bytes": peak,
+    }
+
+
+class Command(BaseCommand):
+    help = "Time the occupancy helpers and prediction views on synthetic campus data"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--devices", type=int, default=5000, help="Distinct devices per day")
+        parser.add_argument("--sessions", type=int, default=20000, help="Sessions per day")
+        parser.add_argument("--days", type=int, default=1, help="Days of data to generate")
+        parser.add_argument("--repeat", type=int, default=20, help="Timed calls per case")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--backends", default=",".join(BACKENDS), help="Comma separated subset of csv,store,cube")
+        parser.add_argument("--output", default="benchmark.json", help="Where to write the results")
+        parser.add_argument("--compare", help="Earlier results file to compare the p50 latencies against")
+        parser.add_argument("--random-model", action="store_true",
+                            help="Benchmark the prediction views with an untrained model of the feature width")
+        parser.add_argument("--skip-predictions", action="store_true")
+        parser.add_argument("--keep", action="store_true", help="Keep the generated data folder")
+
+    def handle(self, *args, **options):
+        backends = [b for b in options["backends"].split(",") if b]
+        for backend in backends:
+            if backend not in BACKENDS:
+                raise CommandError(f"Unknown backend {backend}, expected one of {', '.join(BACKENDS)}")
+
+        root = tempfile.mkdtemp(prefix="crowdview-benchmark-")
+        results = []
+        try:
+            start = time.perf_counter()
+            dates = generate_dataset(
+                root, days=options["days"], devices=options["devices"],
+                sessions=options["sessions"], seed=options["seed"]
+            )
+            self.stdout.write(f"Generated {len(dates)} day(s) in {root} ({time.perf_counter() - start:.1f}s)")
+
+            # cubes and trajectory indexes are only built when a backend asks for them
+            with override_settings(
+                CSV_DATA_DIR=os.path.join(root, "csv_data"),
+                OCCUPANCY_CUBE_AUTOBUILD=False,
+                TRAJECTORY_INDEX_AUTOBUILD=False
+            ):
+                results += self.helper_cases(dates[0], backends, options["repeat"])
+            if not options["skip_predictions"]:
+                results += self.prediction_cases(options["repeat"], options["random_model"])
+        finally:
+            if options["keep"]:
+                self.stdout.write(f"Data kept in {root}")
+            else:
+                shutil.rmtree(root, ignore_errors=True)
+
+        report = {
+            "commit": current_commit(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "engine": registry.engine,
+            "scale": {
+                "devices": options["devices"],
+                "sessions": options["sessions"],
+                "days": options["days"],
+                "seed": options["seed"],
+            },
+            "peak_rss_bytes": peak_rss(),
+            "results": results,
+        }
+        with open(options["output"], "w") as file:
+            json.dump(report, file, indent=2)
+
+        self.report(results, options["compare"])
+        self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+    def helper_cases(self, date, backends, repeat):
+        path = get_csv(date)
+        building = next(iter(ap_dict))
+        floor = 2
+
+        results = []
+        for backend in BACKENDS:
+            # each backend adds its files on top of the previous one
+            if backend == "store":
+                convert_sessions(path)
+            if backend == "cube":
+                build_cube(path)
+            if backend not in backends:
+                continue
+
+            cases = [
+                ("campus_occupancy minute", lambda i: campus_occupancy(path, 480 + i * 37 % 720)),
+                ("campus_occupancy hour", lambda i: campus_occupancy(path, 60 * (8 + i % 12), True)),
+                ("building_occupancy minute", lambda i: building_occupancy(path, building, 480 + i * 37 % 720)),
+                ("building_occupancy hour", lambda i: building_occupancy(path, building, 60 * (8 + i % 12), True)),
+                ("ap_occupancy minute", lambda i: ap_occupancy(path, building, 480 + i * 37 % 720, floor)),
+                ("ap_occupancy hour", lambda i: ap_occupancy(path, building, 60 * (8 + i % 12), floor, True)),
+            ]
+            for name, fn in cases:
+                results.append(dict(name=name, backend=backend, **measure(fn, repeat)))
+                self.stdout.write(f"{name} ({backend}): done")
+
+        if "csv" in backends:
+            results += self.csv_count_cases(path, building, floor, repeat)
+
+        trajectory = trajectory_csv_data(date)
+        devices = [f"#syn{i:08d}#" for i in range(50)]
+        for backend in ("csv", "index"):
+            if backend == "index":
+                build_trajectory_index(trajectory)
+            results.append(dict(
+                name="device_traj", backend=backend,
+                **measure(lambda i: device_traj(trajectory, devices[i % len(devices)]), repeat)
+            ))
+        return results
+
+    def csv_count_cases(self, path, building, floor, repeat):
+        '''
+        The counting of the CSV fallbacks without the parsing, which takes
+        most of their time: the columns are parsed once, then every call
+        only counts the sessions of one minute or hour
+        '''
+        campus = campus_csv_columns(path)
+        aps = ap_csv_columns(path, building)
+        cases = [
+            ("campus_counts minute", lambda i: campus_counts(campus, 480 + i * 37 % 720)),
+            ("campus_counts hour", lambda i: campus_counts(campus, 60 * (8 + i % 12), True)),
+            ("ap_counts minute", lambda i: ap_counts(aps, building, 480 + i * 37 % 720, floor)),
+            ("ap_counts hour", lambda i: ap_counts(aps, building, 60 * (8 + i % 12), floor, True)),
+        ]
+        results = []
+        for name, fn in cases:
+            results.append(dict(name=name, backend="csv-parsed", **measure(fn, repeat)))
+            self.stdout.write(f"{name} (csv-parsed): done")
+        return results
+
+    def prediction_cases(self, repeat, random_model):
+        names = ("PredictionAPI", "CampusPredictionAPI")
+        if random_model:
+            registry.use_model(EnhancedRNN(feature_count, hidden_size, num_layers, output_size))
+            registry.use_scaler(reference_scaler())
+        # load outside the timings, like a warmed up server
+        try:
+            registry.warm_up()
+        except ValueError as e:
+            # the shipped model and scaler do not take the features the views
+            # build, --random-model benchmarks with ones that do
+            self.stdout.write(f"Predictions skipped: {e}")
+            return [{"name": name, "backend": "model", "error": str(e)} for name in names]
+
+        factory = APIRequestFactory()
+        building = next(iter(building_dict))
+        # the views are coroutines, run each call on its own event loop like WSGI does
+        views = [
+            ("PredictionAPI", async_to_sync(PredictionAPI.as_view()), lambda i: (f"/predict/datetime/2021-03-15T{8 + i % 12:02d}:{i % 60:02d}/", {"building": building})),
+            ("CampusPredictionAPI", async_to_sync(CampusPredictionAPI.as_view()), lambda i: (f"/predict/campus/datetime/2021-03-15T{8 + i % 12:02d}:{i % 60:02d}/", {})),
+        ]
+
+        results = []
+        for name, view, request_for in views:
+            def call(i):
+                # every call goes through the model, the cache would hide it
+                prediction_cache.clear()
+                url, params = request_for(i)
+                response = view(factory.get(url, params), datetime_str=url.rstrip("/").rsplit("/", 1)[1])
+                response.render()
+                if response.status_code != 200:
+                    raise CommandError(f"{name} returned {response.status_code}: {response.content[:200]}")
+
+            results.append(dict(name=name, backend="model", **measure(call, repeat)))
+            self.stdout.write(f"{name}: done")
+        return results
+
+    def report(self, results, compare):
+        previous = {}
+        if compare:
+            with open(compare) as file:
+                previous = {(r["name"], r["backend"]): r for r in json.load(file)["results"]}
+
+        self.stdout.write("")
+        for result in results:
+            label = f"{result['name']} ({result['backend']})"
+            if "error" in result:
+                self.stdout.write(f"{label:40} error: {result['error']}")
+                continue
+
+            line = (f"{label:40} p50 {result['p50_ms']:9.3f} ms  p95 {result['p95_ms']:9.3f} ms"
+                    f"  peak {result['peak_alloc_bytes'] / 1e6:8.2f} MB")
+            before = previous.get((result["name"], result["backend"]))
+            if before and before.get("p50_ms"):
+                line += f"  x{result['p50_ms'] / before['p50_ms']:.2f} vs {before['p50_ms']:.3f} ms"
+            self.stdout.write(line)
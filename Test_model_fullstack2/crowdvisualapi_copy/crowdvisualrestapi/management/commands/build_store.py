@@ -0,0 +1,148 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import django
+from django.core.management.base import BaseCommand, CommandError
+from crowdvisualrestapi.store import data_root, convert_sessions, is_converted, store_path, store_checksum, file_checksum
+from crowdvisualrestapi.cube import build_cube, is_built, cube_path, cube_checksum
+from crowdvisualrestapi.trajectory import build_trajectory_index, is_indexed, trajectory_index_path, index_checksum
+from crowdvisualrestapi.rollup import build_rollup, is_rolled_up, rollup_path, rollup_checksum
+
+
+# every kind of file built from a CSV: (is it up to date, file whose mtime says so,
+# checksum of the CSV it was built from, build it)
+STEPS = {
+    "store": (is_converted, store_path, store_checksum, convert_sessions),
+    "cube": (is_built, lambda csv_path: os.path.join(cube_path(csv_path), "meta.json"), cube_checksum, build_cube),
+    "index": (is_indexed, lambda csv_path: os.path.join(trajectory_index_path(csv_path), "meta.json"),
+              index_checksum, build_trajectory_index),
+    "rollup": (is_rolled_up, rollup_path, rollup_checksum, build_rollup),
+}
+
+
+def build_file(csv_path, steps, force):
+    '''
+    Bring the files built from one CSV up to date, steps in order (the cube
+    and the rollup are built from the store), in a worker process
+
+    A file older than its CSV is only rebuilt when the CSV content changed:
+    when it was built from a CSV with the same checksum (the file was copied
+    or touched) it is touched instead.
+    returns {"built": steps, "unchanged": steps, "rows": CSV rows, "seconds": time}
+    '''
+    start = time.perf_counter()
+    result = {"built": [], "unchanged": [], "rows": 0}
+    checksum = None
+    for step in steps:
+        is_current, output, recorded, build = STEPS[step]
+        if not force and is_current(csv_path):
+            continue
+        if checksum is None:
+            checksum = file_checksum(csv_path)
+        if not force and recorded(csv_path) == checksum:
+            os.utime(output(csv_path))
+            result["unchanged"].append(step)
+            continue
+        result["rows"] = max(result["rows"], build(csv_path, checksum))
+        result["built"].append(step)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+class Command(BaseCommand):
+    help = "Convert *_sessions_final.csv files into the columnar session store, build occupancy cubes, rollups and trajectory indexes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("dates", nargs="*", help="Only convert these dates (YYYYMMDD)")
+        parser.add_argument("--force", action="store_true", help="Convert files that are already up to date")
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="Processes converting files at once (default: one per CPU)")
+
+    def handle(self, *args, **options):
+        root = data_root()
+        dates = set(options["dates"])
+        tasks = []
+
+        for folder in sorted(os.listdir(root)):
+            if not folder.startswith("Sessions_"):
+                continue
+            path = os.path.join(root, folder)
+
+            for file in sorted(os.listdir(path)):
+                if not file.endswith("_sessions_final.csv"):
+                    continue
+                if dates and file[0:8] not in dates:
+                    continue
+
+                # campus and building views are served from the Sessions_Total cubes,
+                # the week and month aggregates from their rollups
+                steps = ["store", "cube", "rollup"] if folder == "Sessions_Total" else ["store"]
+                tasks.append((f"{folder}/{file}", os.path.join(path, file), steps))
+
+        # route lookups are served from the per-device trajectory indexes
+        trajectory = os.path.join(root, "Trajectory")
+        for file in sorted(os.listdir(trajectory)) if os.path.isdir(trajectory) else []:
+            if not file.endswith("_finaltraj.csv"):
+                continue
+            if dates and file[0:8] not in dates:
+                continue
+            tasks.append((f"Trajectory/{file}", os.path.join(trajectory, file), ["index"]))
+
+        # biggest files first, so no worker is left alone with a big one at the end
+        tasks.sort(key=lambda task: os.path.getsize(task[1]), reverse=True)
+
+        built = {"store": 0, "cube": 0, "rollup": 0, "index": 0}
+        unchanged = 0
+        rows = 0
+        failed = []
+        start = time.perf_counter()
+        for name, result in self.run(tasks, max(options["workers"], 1), options["force"]):
+            if isinstance(result, Exception):
+                failed.append(name)
+                self.stderr.write(f"{name}: {type(result).__name__}: {result}")
+                continue
+            for step in result["built"]:
+                built[step] += 1
+            unchanged += bool(result["unchanged"])
+            rows += result["rows"]
+
+            if result["built"]:
+                rate = result["rows"] / max(result["seconds"], 1e-9)
+                self.stdout.write(f"{name} {', '.join(result['built'])}: {result['seconds']:.2f}s, "
+                                  f"{result['rows']} rows ({rate:.0f} rows/s)")
+            elif result["unchanged"]:
+                self.stdout.write(f"{name} {', '.join(result['unchanged'])}: unchanged (same checksum)")
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Converted {built['store']} file(s), built {built['cube']} cube(s), {built['rollup']} rollup(s) "
+            f"and {built['index']} trajectory index(es), {unchanged} file(s) unchanged; {rows} rows in {elapsed:.2f}s "
+            f"({rows / max(elapsed, 1e-9):.0f} rows/s)"
+        ))
+        if failed:
+            raise CommandError(f"{len(failed)} file(s) failed: {', '.join(failed)}")
+
+    def run(self, tasks, workers, force):
+        '''
+        Yield (name, build_file result or the exception it raised) of every
+        task as they finish, on a process pool when there are several workers
+        '''
+        if workers == 1 or len(tasks) < 2:
+            for name, csv_path, steps in tasks:
+                try:
+                    yield name, build_file(csv_path, steps, force)
+                except Exception as e:
+                    yield name, e
+            return
+
+        # the workers need the app registry (settings) before the helpers run
+        with ProcessPoolExecutor(min(workers, len(tasks)), initializer=django.setup) as executor:
+            futures = {
+                executor.submit(build_file, csv_path, steps, force): name
+                for name, csv_path, steps in tasks
+            }
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as e:
+                    yield futures[future], e
@@ -0,0 +1,56 @@
+import numpy as np
+import torch
+from django.core.management.base import BaseCommand, CommandError
+from crowdvisualrestapi.consts import building_dict
+from crowdvisualrestapi.registry import registry, ModelRegistry, ENGINES, prediction_features
+
+
+# every building at every hour of a week
+def reference_features():
+    timestamps = [hour * 60 for hour in range(24) for _ in building_dict]
+    buildings = [building for _ in range(24) for building in building_dict]
+    return np.concatenate([
+        prediction_features(timestamps, future_day, buildings) for future_day in range(7)
+    ])
+
+
+class Command(BaseCommand):
+    help = "Compare an inference engine against the float model on a reference input set"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--engine", choices=ENGINES, help="Engine to check (default PREDICTION_ENGINE)")
+        parser.add_argument("--tolerance", type=float, help="Fail when the max deviation is above this")
+        parser.add_argument("--seed", type=int, default=0, help="Seed of the random rows used when the features do not fit the model")
+
+    def handle(self, *args, **options):
+        checked = registry
+        if options["engine"] and options["engine"] != registry.engine:
+            checked = ModelRegistry(
+                registry.model_path, registry.scaler_path,
+                engine=options["engine"], num_threads=registry.num_threads
+            )
+
+        features = reference_features()
+        widths = checked.widths()
+        if len(set(widths.values())) == 1:
+            inputs = torch.tensor(checked.scaler().transform(features), dtype=torch.float32).unsqueeze(1)
+            source = "scaled prediction features, every building at every hour of a week"
+        else:
+            # the model, the scaler and the views disagree on the feature
+            # width, compare on standard normal rows of the width the model takes
+            generator = torch.Generator().manual_seed(options["seed"])
+            inputs = torch.randn((len(features), 1, widths["model"]), generator=generator)
+            source = (f"standard normal rows (features have {widths['features']} columns, the scaler "
+                      f"expects {widths['scaler']}, the model takes {widths['model']})")
+
+        result = checked.check_engine(inputs)
+        self.stdout.write(f"Engine: {result['engine']} ({torch.get_num_threads()} thread(s))")
+        self.stdout.write(f"Inputs: {result['rows']} {source}")
+        self.stdout.write(f"Max abs deviation: {result['max_abs_deviation']:.6g}")
+        self.stdout.write(f"Mean abs deviation: {result['mean_abs_deviation']:.6g}")
+        self.stdout.write(f"Max abs output: {result['max_abs_output']:.6g}")
+        self.stdout.write(f"Float model: {result['float_seconds']}s, engine: {result['engine_seconds']}s")
+
+        if options["tolerance"] is not None and result["max_abs_deviation"] > options["tolerance"]:
+            raise CommandError(f"Max deviation {result['max_abs_deviation']:.6g} is above {options['tolerance']}")
+        self.stdout.write(self.style.SUCCESS("Done"))
@@ -0,0 +1,114 @@
+import os
+import re
+import time
+from django.core.management.base import BaseCommand, CommandError
+from crowdvisualrestapi.ingest import (
+    Sessionizer, SessionWriter, parse_line, read_chunk,
+    checkpoint_path, load_checkpoint, save_checkpoint, compile_pattern,
+)
+
+
+class Command(BaseCommand):
+    help = "Turn WiFi syslog association events into sessions appended to the day's Sessions_Total file and store"
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="Syslog files, read in this order")
+        parser.add_argument("--follow", action="store_true",
+                            help="Keep reading the last file as it grows (and after it is rotated)")
+        parser.add_argument("--checkpoint", help="Where to keep read positions and open sessions "
+                                                 "(default syslog_checkpoint.json in CSV_DATA_DIR)")
+        parser.add_argument("--chunk", type=int, default=100000, help="Lines read between writes")
+        parser.add_argument("--flush", type=float, default=30, help="Seconds between writes while following")
+        parser.add_argument("--refresh", type=float, default=300,
+                            help="Seconds between updates of the stores and rollups of the days written to while following")
+        parser.add_argument("--poll", type=float, default=2, help="Seconds between reads while following")
+        parser.add_argument("--gap", type=float, default=1,
+                            help="Minutes a device can be disassociated before its session ends")
+        parser.add_argument("--max-open", type=int, default=100000, help="Most sessions kept open at once")
+        parser.add_argument("--pattern", help="Regular expression with timestamp, device, event and ap groups")
+        parser.add_argument("--close", action="store_true",
+                            help="End and write the sessions still open when the files are read")
+
+    def handle(self, *args, **options):
+        try:
+            self.pattern = compile_pattern(options["pattern"])
+        except re.error as e:
+            raise CommandError(f"Invalid pattern: {e}")
+        missing = {"timestamp", "device", "event", "ap"} - set(self.pattern.groupindex)
+        if missing:
+            raise CommandError(f"The pattern has no {', '.join(sorted(missing))} group(s)")
+
+        checkpoint = options["checkpoint"] or checkpoint_path()
+        state = load_checkpoint(checkpoint)
+        files = state["files"]
+        self.sessionizer = Sessionizer(options["gap"], options["max_open"], state["sessionizer"])
+        self.stats = {"lines": 0, "events": 0, "sessions": 0}
+        self.writer = SessionWriter()
+
+        def flush():
+            sessions = self.sessionizer.take()
+            if sessions:
+                self.stats["sessions"] += self.writer.write(sessions)
+            save_checkpoint(checkpoint, files, self.sessionizer)
+
+        paths = [os.path.abspath(path) for path in options["paths"]]
+        start = time.perf_counter()
+        try:
+            for n, path in enumerate(paths):
+                if not os.path.exists(path):
+                    raise CommandError(f"{path} does not exist")
+                follow = options["follow"] and n == len(paths) - 1
+                self.read(path, files, flush, follow, options)
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped")
+
+        if options["close"]:
+            self.sessionizer.finish()
+        flush()
+        self.writer.refresh()
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Read {self.stats['lines']} line(s) ({self.stats['lines'] / max(elapsed, 1e-9):.0f}/s), "
+            f"{self.stats['events']} event(s), wrote {self.stats['sessions']} session(s), "
+            f"{len(self.sessionizer.open)} still open"
+        ))
+
+    def read(self, path, files, flush, follow, options):
+        position = files.get(path)
+        inode = os.stat(path).st_ino
+        offset = 0
+        if position is not None and position["inode"] == inode and position["offset"] <= os.path.getsize(path):
+            offset = position["offset"]
+
+        last_flush = last_refresh = time.monotonic()
+        while True:
+            lines, offset = read_chunk(path, offset, options["chunk"], partial=not follow)
+            for line in lines:
+                event = parse_line(line, self.pattern)
+                if event is not None:
+                    self.sessionizer.feed(*event)
+                    self.stats["events"] += 1
+            self.stats["lines"] += len(lines)
+            files[path] = {"inode": inode, "offset": offset}
+            self.sessionizer.expire()
+
+            # write full chunks right away, keep small ones while following
+            # until flush seconds went by
+            done = len(lines) < options["chunk"]
+            if not done or not follow or time.monotonic() - last_flush >= options["flush"]:
+                flush()
+                last_flush = time.monotonic()
+            if follow and time.monotonic() - last_refresh >= options["refresh"]:
+                self.writer.refresh()
+                last_refresh = time.monotonic()
+            if done and not follow:
+                return
+
+            if done:
+                time.sleep(options["poll"])
+                # rotated (a new file under the name) or truncated: start over
+                if os.path.exists(path):
+                    stat = os.stat(path)
+                    if stat.st_ino != inode or stat.st_size < offset:
+                        inode, offset = stat.st_ino, 0
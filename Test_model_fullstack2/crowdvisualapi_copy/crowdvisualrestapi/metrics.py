@@ -0,0 +1,346 @@
+import os
+import re
+import time
+import hmac
+import cProfile
+import pstats
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager
+from django.conf import settings
+
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# every metric with its type and help line, in the order /metrics lists them
+DEFINITIONS = {
+    "crowdview_request_duration_seconds": ("histogram", "Time to answer a request, per endpoint"),
+    "crowdview_section_duration_seconds": (
+        "histogram", "Time spent in the hot paths: cube, store or csv reads and model inference"
+    ),
+    "crowdview_rows_scanned_total": ("counter", "Session and trajectory rows looked at, per source"),
+    "crowdview_csv_bytes_read_total": ("counter", "Bytes of CSV files read"),
+    "crowdview_cache_lookups_total": (
+        "counter", "Lookups of the precomputed files (cube, store, trajectory_index, rollup) and of the "
+                   "prediction cache, per result (hit or miss)"
+    ),
+}
+
+
+def label_text(labels):
+    if not labels:
+        return ""
+    values = ",".join(f'{key}="{value}"' for key, value in labels)
+    return "{" + values + "}"
+
+
+class Metrics:
+    '''
+    Counters and histograms of the process, rendered in the Prometheus
+    text format
+
+    Each server process keeps its own, so with several workers every one
+    of them has to be scraped (or the sums taken by the scraper).
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+
+        lines = []
+        for name, (kind, help_text) in DEFINITIONS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{label_text(labels)} {value}")
+                continue
+
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                # buckets are cumulative already, +Inf is every observation
+                for bound, count in zip(LATENCY_BUCKETS, histogram):
+                    lines.append(f"{name}_bucket{label_text(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{label_text(labels + (('le', '+Inf'),))} {histogram[-1]}")
+                lines.append(f"{name}_sum{label_text(labels)} {histogram[-2]}")
+                lines.append(f"{name}_count{label_text(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class RequestMetrics:
+    '''
+    What one request spent its time on, for its Server-Timing header
+
+    profiles is a list collecting the cProfile runs of the request when it
+    asked to be profiled, None otherwise; view_profile is the run of a sync
+    view while it is going on
+    '''
+
+    def __init__(self, profile=False):
+        self.start = time.perf_counter()
+        self.sections = {}
+        self.profiles = [] if profile else None
+        self.view_profile = None
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.sections[name] = self.sections.get(name, 0) + seconds
+
+    def server_timing(self):
+        total = time.perf_counter() - self.start
+        with self._lock:
+            sections = list(self.sections.items())
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in sections]
+        entries.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_current = contextvars.ContextVar("crowdview_request_metrics", default=None)
+
+
+# the RequestMetrics of the request being answered, None outside of requests
+def current_request():
+    return _current.get()
+
+
+@contextmanager
+def timed(section):
+    '''
+    Time a hot path, as a with block or a decorator
+
+    the time goes to the section histogram and, inside a request, to its
+    Server-Timing header
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe("crowdview_section_duration_seconds", elapsed, section=section)
+        request = _current.get()
+        if request is not None:
+            request.add(section, elapsed)
+
+
+# rows a store or index query returned, the rows the caller then goes through
+def rows_scanned(source, count):
+    metrics.inc("crowdview_rows_scanned_total", count, source=source)
+
+
+# a whole CSV file read, rows without the header
+def csv_scanned(path, rows):
+    metrics.inc("crowdview_rows_scanned_total", rows, source="csv")
+    metrics.inc("crowdview_csv_bytes_read_total", os.path.getsize(path))
+
+
+def cache_lookup(cache, hits=0, misses=0):
+    if hits:
+        metrics.inc("crowdview_cache_lookups_total", hits, cache=cache, result="hit")
+    if misses:
+        metrics.inc("crowdview_cache_lookups_total", misses, cache=cache, result="miss")
+
+
+# From Python 3.12 cProfile is process wide (sys.monitoring): starting one
+# while another is on, in any thread, raises ValueError. So one runs at a time
+_profiler_lock = threading.Lock()
+
+
+def start_profile():
+    '''
+    Start a cProfile on this thread, once the one running (of this or
+    another request) is stopped
+
+    returns None, without waiting, when a profiler that is not ours is on
+    '''
+    _profiler_lock.acquire()
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        _profiler_lock.release()
+        return None
+    return profile
+
+
+def stop_profile(request, profile):
+    if profile is None:
+        return
+    profile.disable()
+    _profiler_lock.release()
+    request.profiles.append(profile)
+
+
+def call(fn, *args):
+    '''
+    Run fn(*args) on a pool thread for the current request, under cProfile
+    when the request is being profiled
+
+    this is where the work of the async views is profiled, the sync ones are
+    profiled on their own thread by the middleware
+    '''
+    request = _current.get()
+    if request is None or request.profiles is None:
+        return fn(*args)
+    profile = start_profile()
+    try:
+        return fn(*args)
+    finally:
+        stop_profile(request, profile)
+
+
+def collect(fn, *args):
+    '''
+    Run fn(*args) in a process pool worker, returning its result and the
+    seconds spent in each timed section
+
+    the worker's own metrics are never scraped, record_sections adds the
+    sections to the parent's; counters (rows scanned, cache lookups) stay
+    in the worker
+    '''
+    current = RequestMetrics()
+    token = _current.set(current)
+    try:
+        return fn(*args), current.sections
+    finally:
+        _current.reset(token)
+
+
+def record_sections(request, future):
+    '''
+    Done callback of a collect run: its sections go to the section histogram
+    and to the Server-Timing of request (the one that submitted it, or None)
+
+    one observation per section name, the worker adds up repeated ones
+    '''
+    if future.cancelled() or future.exception() is not None:
+        return
+    for section, seconds in future.result()[1].items():
+        metrics.observe("crowdview_section_duration_seconds", seconds, section=section)
+        if request is not None:
+            request.add(section, seconds)
+
+
+def metrics_settings():
+    return getattr(settings, "METRICS", {})
+
+
+# did the request ask to be profiled with the configured token
+def wants_profile(request):
+    token = metrics_settings().get("PROFILE_TOKEN")
+    sent = request.headers.get("X-Profile")
+    return bool(token) and sent is not None and hmac.compare_digest(sent.encode(), token.encode())
+
+
+def start_request(request):
+    '''
+    Make a RequestMetrics current for the request
+
+    returns (RequestMetrics, token to give finish_request)
+    '''
+    current = RequestMetrics(profile=wants_profile(request))
+    return current, _current.set(current)
+
+
+# the url name of the view that answered, so the latency labels stay few
+def endpoint(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unmatched"
+    return match.url_name or match.route
+
+
+def finish_request(request, response, current, token):
+    '''
+    Add the request's Server-Timing header and write its profile, then
+    forget the RequestMetrics
+
+    the latency is recorded now, or for a streamed response (SSE, NDJSON)
+    once it is closed, after its body was sent
+    '''
+    _current.reset(token)
+    name = endpoint(request)
+    labels = {"endpoint": name, "method": request.method, "status": response.status_code}
+
+    if response.streaming:
+        close = response.close
+
+        # counted once, however often the server closes it
+        def closed():
+            response.close = close
+            try:
+                close()
+            finally:
+                observe_latency(current, labels)
+
+        response.close = closed
+    else:
+        observe_latency(current, labels)
+
+    if metrics_settings().get("SERVER_TIMING", True):
+        response.headers["Server-Timing"] = current.server_timing()
+
+    if current.profiles:
+        response.headers["X-Profile-File"] = write_profile(name, current.profiles)
+    return response
+
+
+def observe_latency(current, labels):
+    metrics.observe("crowdview_request_duration_seconds", time.perf_counter() - current.start, **labels)
+
+
+_profile_count = 0
+_profile_lock = threading.Lock()
+
+
+def write_profile(name, profiles):
+    '''
+    Merge the cProfile runs of a request into one pstats file
+
+    the file goes to PROFILE_DIR (the temporary folder by default), read it
+    with "python -m pstats <file>" or snakeviz; returns its name
+    '''
+    global _profile_count
+    with _profile_lock:
+        _profile_count += 1
+        count = _profile_count
+    folder = metrics_settings().get("PROFILE_DIR") or tempfile.gettempdir()
+    os.makedirs(folder, exist_ok=True)
+    name = re.sub(r"[^\w.-]", "_", name)
+    file_name = f"crowdview-{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{count}.prof"
+
+    stats = pstats.Stats(profiles[0])
+    for profile in profiles[1:]:
+        stats.add(profile)
+    stats.dump_stats(os.path.join(folder, file_name))
+    return file_name
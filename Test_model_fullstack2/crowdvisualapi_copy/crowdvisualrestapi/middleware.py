@@ -1,12 +1,103 @@
+import re
 import logging
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+from .metrics import start_request, finish_request, current_request, start_profile, stop_profile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 logger = logging.getLogger(__name__)
 
+# brotli level for responses compressed as they are sent, higher levels cost
+# more time than they save on the size of the occupancy payloads
+BROTLI_QUALITY = 5
+
+re_accepts_brotli = re.compile(r"\bbr\b")
+
 class RequestLogMiddleware:
+    '''
+    Log every request and record its metrics (see metrics.py): latency per
+    endpoint, a Server-Timing header and, when the request sent the
+    X-Profile token, a cProfile of it
+
+    Works with both sync and async requests, so under ASGI the async views
+    are not pushed to a thread. Only the thread doing a request's work is
+    profiled: a sync view's under WSGI, here, and the pool threads an async
+    view hands its work to (metrics.call). The event loop thread is shared
+    with other requests, and under ASGI sync views run on another thread,
+    so those are not profiled.
+    '''
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        logger.info(f"Request path: {request.path}, method: {request.method}")
+        current, token = start_request(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            stop_profile(current, current.view_profile)
+            current.view_profile = None
+        return finish_request(request, response, current, token)
+
+    async def __acall__(self, request):
         logger.info(f"Request path: {request.path}, method: {request.method}")
-        response = self.get_response(request)
+        current, token = start_request(request)
+        response = await self.get_response(request)
+        return finish_request(request, response, current, token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # a sync view runs on this thread under WSGI, the work of an async
+        # one is profiled where it runs
+        current = current_request()
+        if current is None or current.profiles is None:
+            return None
+        if iscoroutinefunction(self) or iscoroutinefunction(view_func):
+            return None
+        current.view_profile = start_profile()
+        return None
+
+class CompressionMiddleware(GZipMiddleware):
+    '''
+    Compress responses with brotli when the client accepts it and the
+    brotli package is installed, with gzip otherwise
+
+    Server-Sent Events are left alone, every message has to reach the
+    client as soon as it is written.
+    '''
+
+    def process_response(self, request, response):
+        if response.get("Content-Type", "").startswith("text/event-stream"):
+            return response
+        if brotli is None or response.streaming:
+            return super().process_response(request, response)
+
+        if len(response.content) < 200 or response.has_header("Content-Encoding"):
+            return response
+        patch_vary_headers(response, ("Accept-Encoding",))
+        if not re_accepts_brotli.search(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+            return super().process_response(request, response)
+
+        compressed_content = brotli.compress(response.content, quality=BROTLI_QUALITY)
+        if len(compressed_content) >= len(response.content):
+            return response
+        response.content = compressed_content
+        response.headers["Content-Length"] = str(len(response.content))
+
+        # the body is no longer the same bytes, only a weak ETag still holds
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = "br"
         return response
@@ -0,0 +1,114 @@
+import asyncio
+import threading
+import contextvars
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import django
+from django.conf import settings
+from .metrics import call, collect, record_sections, current_request
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+# process pool workers need the app registry before they import the helpers
+def _setup_worker():
+    django.setup()
+
+
+def _make_pool(name):
+    if name == "occupancy":
+        workers = getattr(settings, "OCCUPANCY_WORKERS", 4)
+        if getattr(settings, "OCCUPANCY_POOL", "thread") == "process":
+            return ProcessPoolExecutor(workers, initializer=_setup_worker)
+        return ThreadPoolExecutor(workers, thread_name_prefix="occupancy")
+    # torch releases the GIL while it runs, and threads share one loaded model
+    return ThreadPoolExecutor(getattr(settings, "PREDICTION_WORKERS", 2), thread_name_prefix="prediction")
+
+
+def pool(name):
+    '''
+    Get the process wide "occupancy" or "prediction" executor
+
+    created on first use with the sizes in settings.py, so a burst of
+    requests queues up instead of starting more threads or processes
+    '''
+    with _pools_lock:
+        executor = _pools.get(name)
+        if executor is None:
+            executor = _pools[name] = _make_pool(name)
+        return executor
+
+
+class Coalescer:
+    '''
+    One computation per key for the callers that ask for it at the same time
+
+    The first caller submits the work to an executor, callers arriving while
+    it runs get the same future. The key is forgotten once the work is done,
+    so results are not cached here, later calls compute again.
+    '''
+
+    def __init__(self):
+        self.coalesced = 0
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def submit(self, executor, key, fn, *args, done=None):
+        '''
+        Future of fn(*args) for key, submitted unless it is already running
+
+        done is added as a done callback of a future submitted by this call,
+        ahead of the ones of the callers awaiting it
+        '''
+        with self._lock:
+            future = self._running.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = self._running[key] = executor.submit(fn, *args)
+        future.add_done_callback(lambda finished: self._forget(key, finished))
+        if done is not None:
+            future.add_done_callback(done)
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._running.get(key) is future:
+                del self._running[key]
+
+
+coalescer = Coalescer()
+
+
+# lists become tuples so the arguments can be part of a key
+def call_key(fn, args):
+    return (fn.__module__, fn.__qualname__) + tuple(tuple(a) if isinstance(a, list) else a for a in args)
+
+
+async def run_in_pool(name, fn, *args):
+    '''
+    Await fn(*args) run on a pool, sharing the run with concurrent calls
+    that have the same function and arguments
+
+    a caller that goes away (client disconnected) does not cancel the run
+    the others are waiting for. The first caller gets the timed sections of
+    the run in its Server-Timing. On threads the run sees the request's
+    metrics (see metrics.py) and a request being profiled gets a run of its
+    own; in worker processes only the timed sections come back (see
+    metrics.collect), the counters stay there and nothing is profiled
+    '''
+    executor = pool(name)
+    key = call_key(fn, args)
+    if isinstance(executor, ProcessPoolExecutor):
+        future = coalescer.submit(executor, key, collect, fn, *args,
+                                  done=partial(record_sections, current_request()))
+        result, sections = await asyncio.shield(asyncio.wrap_future(future))
+        return result
+
+    request = current_request()
+    if request is not None and request.profiles is not None:
+        key = object()
+    future = coalescer.submit(executor, key, contextvars.copy_context().run, call, fn, *args)
+    return await asyncio.shield(asyncio.wrap_future(future))
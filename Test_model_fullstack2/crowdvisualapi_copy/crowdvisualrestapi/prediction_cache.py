@@ -0,0 +1,131 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from django.core.cache import caches
+from .metrics import cache_lookup
+
+
+# fingerprint of the files a prediction depends on, changes when any of
+# them is replaced, resized or touched
+def file_fingerprint(paths, tag=""):
+    digest = hashlib.sha1(tag.encode())
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        except OSError:
+            digest.update(f"{path}:missing;".encode())
+    return digest.hexdigest()[:16]
+
+
+class PredictionCache:
+    '''
+    LRU cache of raw model outputs keyed by (building, date, minute)
+
+    Entries are kept per process up to size, and optionally in a Django
+    cache (backend is a CACHES alias) so several workers share hits.
+    Everything cached is dropped as soon as the fingerprint of the model
+    or scaler files (or the tag, e.g. the inference engine) changes.
+    '''
+
+    def __init__(self, paths, size=100000, backend=None, timeout=None, tag=""):
+        self.paths = list(paths)
+        self.tag = tag
+        self.size = size
+        self.backend = backend
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._fingerprint = file_fingerprint(self.paths, self.tag)
+
+    # clear the local entries when the model or scaler changed
+    def _check_fingerprint(self):
+        fingerprint = file_fingerprint(self.paths, self.tag)
+        if fingerprint != self._fingerprint:
+            self._entries.clear()
+            self._fingerprint = fingerprint
+        return fingerprint
+
+    # shared keys carry the fingerprint, so stale entries are never read
+    def _shared_key(self, fingerprint, key):
+        building, date, minute = key
+        return f"prediction:{fingerprint}:{building}:{date}:{minute}"
+
+    def get_many(self, keys):
+        '''
+        Look up many keys at once
+
+        returns a dict of the keys found and a list of the missing ones
+        '''
+        found = {}
+        missing = []
+        with self._lock:
+            fingerprint = self._check_fingerprint()
+            for key in keys:
+                value = self._entries.get(key)
+                if value is None:
+                    missing.append(key)
+                else:
+                    self._entries.move_to_end(key)
+                    found[key] = value
+
+        if missing and self.backend:
+            shared = caches[self.backend].get_many([self._shared_key(fingerprint, key) for key in missing])
+            if shared:
+                still_missing = []
+                for key in missing:
+                    value = shared.get(self._shared_key(fingerprint, key))
+                    if value is None:
+                        still_missing.append(key)
+                    else:
+                        found[key] = value
+                self._store({key: found[key] for key in missing if key in found}, fingerprint)
+                missing = still_missing
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(missing)
+        cache_lookup("prediction", hits=len(found), misses=len(missing))
+        return found, missing
+
+    def set_many(self, values):
+        with self._lock:
+            fingerprint = self._check_fingerprint()
+        self._store(values, fingerprint)
+
+        if values and self.backend:
+            caches[self.backend].set_many(
+                {self._shared_key(fingerprint, key): value for key, value in values.items()},
+                timeout=self.timeout
+            )
+
+    def _store(self, values, fingerprint):
+        with self._lock:
+            if fingerprint != self._fingerprint:
+                return
+            for key, value in values.items():
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "fingerprint": self._fingerprint,
+            }
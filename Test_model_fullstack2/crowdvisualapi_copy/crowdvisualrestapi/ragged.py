@@ -0,0 +1,134 @@
+import csv
+import numpy as np
+import pandas as pd
+from .metrics import csv_scanned
+
+
+# The session and trajectory CSVs keep one list per row in some columns,
+# written as Python lists: "['FILD', 'WHLR']", "[488, 557]", "[529.0, 601.0]".
+# A column of them is parsed at once into a ragged array: the values of all
+# rows in one flat array, and offsets where the list of row i is
+# values[offsets[i]:offsets[i + 1]].
+
+
+def read_columns(path, columns, where=None):
+    '''
+    Read some columns (by position) of a CSV with a header row, every field
+    as a string, in one pass of the pandas C parser
+
+    where (column, values) keeps only the rows whose field in that column is
+    one of values. Those are picked out by csv.reader as it goes instead,
+    which is cheaper than pandas making strings of every field of the
+    columns when few rows are kept (one building or one device).
+    returns one list of strings per column, in the order asked
+    '''
+    if where is not None:
+        column, values = where
+        values = set(values)
+        with open(path, "r", newline="") as file:
+            reader = csv.reader(file)
+            next(reader)  # Skip header
+            rows = [[row[i] for i in columns] for row in reader if row[column] in values]
+        csv_scanned(path, reader.line_num - 1)
+        return [list(fields) for fields in zip(*rows)] if rows else [[] for _ in columns]
+
+    frame = pd.read_csv(path, usecols=columns, dtype=object, na_filter=False)
+    csv_scanned(path, len(frame))
+    # pandas keeps the columns in file order
+    by_position = dict(zip(sorted(columns), frame.columns))
+    return [frame[by_position[column]].tolist() for column in columns]
+
+
+# "[" dropped, "]" ends an item like a comma does
+BRACKETS = str.maketrans({"[": None, "]": ","})
+
+
+def _join(column):
+    '''
+    Join every list of a column into one string of comma separated items
+
+    the offsets come from where the commas and closing brackets of the
+    joined column are, so no Python code runs per row or per value
+    returns (items as one string, offsets)
+    '''
+    joined = "".join(column)
+    marks = np.frombuffer(joined.encode(), dtype=np.uint8)
+    ends = np.flatnonzero(marks == ord("]"))
+    if len(ends) != len(column):
+        raise ValueError("Every field of a list column has to be one [...] list")
+
+    commas = np.cumsum(marks == ord(","))[ends]
+    empty = marks[ends - 1] == ord("[")
+    counts = np.where(empty, 0, np.diff(commas, prepend=0) + 1)
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    if empty.any():
+        joined = joined.replace("[]", "")
+    # "[a, b][c]" -> "a, b,c"
+    return joined.translate(BRACKETS)[:-1], offsets
+
+
+# an item with nothing in it ("[1, , 2]"), NumPy would read it as -1
+def _has_empty_item(items):
+    packed = items.replace(" ", "")
+    return not packed or ",," in packed or packed[0] == "," or packed[-1] == ","
+
+
+def number_lists(column, dtype=np.float64):
+    '''
+    Parse a column of number lists ("[488.0, 557.0]")
+
+    returns (values, offsets)
+    '''
+    items, offsets = _join(column)
+    if items and _has_empty_item(items):
+        raise ValueError("A number list has an empty item")
+    # parsed by NumPy in C, without a Python float per value
+    values = np.fromstring(items, dtype=np.float64, sep=",") if items else np.empty(0)
+    if len(values) != offsets[-1]:
+        raise ValueError("A number list has an item that is not a number")
+    return values.astype(dtype, copy=False), offsets
+
+
+def string_lists(column):
+    '''
+    Parse a column of string lists ("['FILD', 'WHLR']") into codes
+
+    returns (codes, table, offsets), the values are table[codes], without
+    their quotes, the table in order of first appearance
+    '''
+    items, offsets = _join(column)
+    items = items.split(",") if items else []
+    # only the distinct items are stripped of their quotes and spaces, then
+    # the variants of a value (first in its list or not) are merged
+    raw_codes, raw_table = pd.factorize(np.array(items, dtype=object))
+    codes, table = factorize([item.strip(" ' '") for item in raw_table.tolist()])
+    return codes[raw_codes] if len(items) else codes, table, offsets
+
+
+def _no_empty_lists(offsets):
+    if (np.diff(offsets) == 0).any():
+        raise ValueError("A list column has an empty list where a value is needed")
+
+
+# first value of every list, ValueError when a list is empty
+def firsts(values, offsets):
+    _no_empty_lists(offsets)
+    return values[offsets[:-1]]
+
+
+# last value of every list, ValueError when a list is empty
+def lasts(values, offsets):
+    _no_empty_lists(offsets)
+    return values[offsets[1:] - 1]
+
+
+def factorize(values):
+    '''
+    Codes of values into a table of the distinct ones, the table in order of
+    first appearance
+
+    returns (int32 codes, str array table)
+    '''
+    codes, table = pd.factorize(np.array(values, dtype=object))
+    return codes.astype(np.int32), np.array(table.tolist(), dtype=str)
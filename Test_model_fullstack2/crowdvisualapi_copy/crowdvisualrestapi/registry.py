@@ -0,0 +1,303 @@
+import logging
+import resource
+import threading
+import time
+import torch
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+from django.conf import settings
+from .consts import building_dict
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+
+# Define the EnhancedRNN model architecture
+class EnhancedRNN(torch.nn.Module):
+    def __init__(self, input_size, hidden_size, num_layers, output_size):
+        super(EnhancedRNN, self).__init__()
+        self.rnn = torch.nn.LSTM(input_size, hidden_size, num_layers, batch_first=True)
+        self.fc1 = torch.nn.Linear(hidden_size, hidden_size // 2)
+        self.relu1 = torch.nn.ReLU()
+        self.fc2 = torch.nn.Linear(hidden_size // 2, output_size)
+
+    def forward(self, x):
+        out, _ = self.rnn(x)
+        out = self.fc1(out[:, -1, :])
+        out = self.relu1(out)
+        out = self.fc2(out)
+        return out
+
+
+input_size = 213  # Adjust based on the actual input size used during training
+hidden_size = 128  # Same as used during training
+num_layers = 2  # Same as used during training
+output_size = 1  # Same as used during training
+
+# features: hour_of_day, day_of_week, minute_of_day, future_day, week_of_year, is_weekend, building_one_hot
+feature_count = 6 + len(building_dict)
+
+
+# build model input rows, one per (timestamp, building) pair of the two lists
+# features: hour_of_day, day_of_week, minute_of_day, future_day, week_of_year, is_weekend, building_one_hot
+def prediction_features(timestamps, future_day, buildings):
+    timestamps = np.asarray(timestamps)
+    day_of_week = (future_day % 7)
+
+    columns = {b: i for i, b in enumerate(building_dict)}
+    features = np.zeros((len(timestamps), 6 + len(columns)))
+    features[:, 0] = timestamps // 60
+    features[:, 1] = day_of_week
+    features[:, 2] = timestamps
+    features[:, 3] = future_day
+    features[:, 4] = (future_day // 7) + 1
+    features[:, 5] = 1 if day_of_week >= 5 else 0
+    features[np.arange(len(timestamps)), [6 + columns[b] for b in buildings]] = 1
+    return features
+
+
+# rows per forward pass, keeps memory flat for whole-day forecasts
+prediction_batch_size = 8192
+
+
+# scaler fitted on representative rows of the feature width, for benchmarks
+# and tests run with a model of that width (see ModelRegistry.use_scaler)
+def reference_scaler():
+    dummy_data = [
+        [10, 1, 600, 70, 10, 0] + [0] * len(building_dict),
+        [15, 2, 900, 71, 10, 0] + [0] * len(building_dict),
+        [20, 3, 1200, 72, 10, 0] + [0] * len(building_dict)
+    ]
+    scaler = StandardScaler()
+    scaler.fit(pd.DataFrame(dummy_data))
+    return scaler
+
+
+# inference engines selectable with PREDICTION_ENGINE
+ENGINES = ("eager", "torchscript", "quantized")
+
+
+def compile_engine(model, engine):
+    '''
+    Wrap the float model for serving
+
+    eager        the model as loaded
+    torchscript  the model compiled with TorchScript
+    quantized    LSTM and Linear weights dynamically quantized to int8, then
+                 compiled with TorchScript (fastest on CPU, least exact)
+    '''
+    if engine == "eager":
+        return model
+    if engine == "torchscript":
+        return torch.jit.script(model)
+    if engine == "quantized":
+        quantized = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8
+        )
+        return torch.jit.script(quantized)
+    raise ValueError(f"Unknown prediction engine {engine!r}, expected one of {', '.join(ENGINES)}")
+
+
+# peak resident memory of the process in bytes (Linux reports KiB)
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class ModelRegistry:
+    '''
+    Loads the prediction model and scaler on first use
+
+    Loading is thread safe and happens once per process; warm_up() does it
+    up front (see PREDICTION_WARMUP) and runs one prediction so the first
+    request does not pay for it. stats() reports load times and memory.
+    Predictions raise ValueError when the scaler, the model and the feature
+    rows do not have the same width.
+    '''
+
+    def __init__(self, model_path, scaler_path, engine="eager", num_threads=None):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown prediction engine {engine!r}, expected one of {', '.join(ENGINES)}")
+        self.model_path = str(model_path)
+        self.scaler_path = str(scaler_path)
+        self.engine = engine
+        self.num_threads = num_threads
+        self._model = None
+        self._float_model = None
+        self._scaler = None
+        self._checked = False
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @property
+    def paths(self):
+        return [self.model_path, self.scaler_path]
+
+    # the model served to the views, compiled for the configured engine
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._float_model = self._load_model()
+                    self._model = self._compile(self._float_model)
+        return self._model
+
+    # the float model as trained, the reference the engines are checked against
+    def float_model(self):
+        self.model()
+        return self._float_model
+
+    # serve an in-memory model instead of the file, e.g. an untrained
+    # EnhancedRNN of the feature width for benchmarks
+    def use_model(self, model):
+        with self._lock:
+            self._float_model = model.eval()
+            self._model = self._compile(self._float_model)
+            self._checked = False
+
+    # serve an in-memory scaler instead of the file, e.g. reference_scaler()
+    def use_scaler(self, scaler):
+        with self._lock:
+            self._scaler = scaler
+            self._checked = False
+
+    def scaler(self):
+        if self._scaler is None:
+            with self._lock:
+                if self._scaler is None:
+                    self._scaler = self._load_scaler()
+        return self._scaler
+
+    def _load_model(self):
+        # keep each worker to its share of the cores
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+
+        start = time.perf_counter()
+        rss = peak_rss()
+
+        model = EnhancedRNN(input_size, hidden_size, num_layers, output_size)
+        model.load_state_dict(torch.load(self.model_path, map_location=torch.device('cpu')))
+        model.eval()
+
+        self._stats["model_load_seconds"] = round(time.perf_counter() - start, 4)
+        self._stats["model_parameter_bytes"] = sum(p.numel() * p.element_size() for p in model.parameters())
+        self._stats["model_peak_rss_growth_bytes"] = peak_rss() - rss
+        logger.info(f"Loaded prediction model from {self.model_path} in {self._stats['model_load_seconds']}s")
+        return model
+
+    def _compile(self, model):
+        start = time.perf_counter()
+        compiled = compile_engine(model, self.engine)
+        self._stats["engine"] = self.engine
+        self._stats["engine_compile_seconds"] = round(time.perf_counter() - start, 4)
+        self._stats["num_threads"] = torch.get_num_threads()
+        return compiled
+
+    def _load_scaler(self):
+        start = time.perf_counter()
+
+        scaler = joblib.load(self.scaler_path)
+
+        self._stats["scaler_load_seconds"] = round(time.perf_counter() - start, 4)
+        self._stats["scaler_bytes"] = sum(
+            getattr(scaler, name).nbytes for name in ("mean_", "scale_", "var_")
+            if getattr(scaler, name, None) is not None
+        )
+        return scaler
+
+    # feature width of the rows the views build, the scaler and the model
+    def widths(self):
+        return {
+            "features": feature_count,
+            "scaler": getattr(self.scaler(), "n_features_in_", None),
+            "model": self.float_model().rnn.input_size,
+        }
+
+    def check_widths(self):
+        if self._checked:
+            return
+        widths = self.widths()
+        if len(set(widths.values())) != 1:
+            message = (
+                f"The views build {widths['features']} prediction features, the scaler "
+                f"{self.scaler_path} expects {widths['scaler']} and the model {self.model_path} "
+                f"takes {widths['model']}; retrain or replace them to match"
+            )
+            logger.error(message)
+            raise ValueError(message)
+        self._checked = True
+
+    def predict(self, features):
+        '''
+        Scale the feature rows (see prediction_features) and run them
+        through the model in batches of prediction_batch_size
+
+        returns a (rows, output_size) array
+        '''
+        self.check_widths()
+        if len(features) == 0:
+            return np.empty((0, output_size), dtype=np.float32)
+        model = self.model()
+        input_scaled = self.scaler().transform(features)
+        input_tensor = torch.tensor(input_scaled, dtype=torch.float32).unsqueeze(1)
+
+        with torch.no_grad(), timed("model"):
+            prediction = torch.cat([
+                model(batch) for batch in torch.split(input_tensor, prediction_batch_size)
+            ])
+        return prediction.numpy()
+
+    def warm_up(self):
+        start = time.perf_counter()
+        # one row through the path the views take, so a model or scaler
+        # that does not fit fails here instead of on every request
+        self.predict(prediction_features([600], 0, [next(iter(building_dict))]))
+
+        self._stats["warm_up_seconds"] = round(time.perf_counter() - start, 4)
+        logger.info(f"Prediction model warmed up in {self._stats['warm_up_seconds']}s")
+
+    def check_engine(self, inputs):
+        '''
+        Compare the served engine against the float model
+
+        inputs is a (rows, 1, input_size) tensor; returns the largest and mean
+        absolute difference between the two outputs and the time each took
+        '''
+        reference_model = self.float_model()
+        engine_model = self.model()
+
+        with torch.no_grad():
+            start = time.perf_counter()
+            reference = reference_model(inputs)
+            reference_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            served = engine_model(inputs)
+            engine_seconds = time.perf_counter() - start
+
+        deviation = (served - reference).abs()
+        return {
+            "engine": self.engine,
+            "rows": len(inputs),
+            "max_abs_deviation": float(deviation.max()) if len(inputs) else 0.0,
+            "mean_abs_deviation": float(deviation.mean()) if len(inputs) else 0.0,
+            "max_abs_output": float(reference.abs().max()) if len(inputs) else 0.0,
+            "float_seconds": round(reference_seconds, 4),
+            "engine_seconds": round(engine_seconds, 4),
+        }
+
+    def is_loaded(self):
+        return self._model is not None and self._scaler is not None
+
+    def stats(self):
+        return dict(self._stats, loaded=self.is_loaded(), peak_rss_bytes=peak_rss())
+
+
+registry = ModelRegistry(
+    getattr(settings, "PREDICTION_MODEL_PATH", "occupancy_model2.pth"),
+    getattr(settings, "PREDICTION_SCALER_PATH", "scaler.pkl"),
+    engine=getattr(settings, "PREDICTION_ENGINE", "eager"),
+    num_threads=getattr(settings, "PREDICTION_NUM_THREADS", None)
+)
@@ -0,0 +1,399 @@
+import os
+import threading
+from datetime import date
+import numpy as np
+from django.conf import settings
+from .consts import building_dict
+from .store import load_sessions, open_sessions
+from .cube import building_columns, hour_stats
+from .catalog import dataset_catalog
+from .metrics import cache_lookup
+
+
+# Every Sessions_Total day gets a small rollup file next to its CSV with the
+# hourly and daily stats of every building. The files of all days are
+# stacked into one in-memory table, so the week and month aggregates only
+# slice and sum arrays instead of reading sessions.
+
+# bump whenever the arrays below change meaning or layout,
+# rollups written with another version are ignored and rebuilt
+ROLLUP_VERSION = 1
+ROLLUP_EXT = ".rollup.npz"
+
+HOURS = 24
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+# arrays of a rollup with their shape before the building axis
+ARRAYS = {
+    "hour_devices": (HOURS,),
+    "hour_sessions": (HOURS,),
+    "hour_dwell": (HOURS,),
+    "day_devices": (),
+    "day_sessions": (),
+    "day_minutes": (),
+}
+
+_days = {}      # rollup path -> (mtime, arrays or None when not of this version)
+_table = None   # (key, RollupTable, {date: CSV} of rollups of another version)
+_building = set()
+_lock = threading.Lock()
+
+
+def rollup_path(csv_path):
+    return os.path.splitext(csv_path)[0] + ROLLUP_EXT
+
+
+def rollup_arrays(store):
+    '''
+    Hourly and daily stats of one day's sessions, columns follow building_dict order
+
+    the hour rows are the building view of the cube (hour_stats); over the
+    day a device counts once per building and a session for its whole length
+    '''
+    count = len(building_dict)
+    columns, rows = building_columns(store)
+    known = np.zeros(len(store), dtype=bool)
+    known[rows] = True
+
+    hour_devices = np.zeros((HOURS, count), dtype=np.int32)
+    hour_sessions = np.zeros((HOURS, count), dtype=np.int32)
+    hour_dwell = np.zeros((HOURS, count), dtype=np.float64)
+    for h in range(HOURS):
+        hour_stats(store, columns, known, h, hour_devices[h], hour_sessions[h], hour_dwell[h])
+
+    col = columns[store.building[rows]]
+    pairs = np.unique(col * len(store.devices) + store.device[rows])
+    return {
+        "hour_devices": hour_devices,
+        "hour_sessions": hour_sessions,
+        "hour_dwell": hour_dwell,
+        "day_devices": np.bincount(pairs // max(len(store.devices), 1), minlength=count).astype(np.int32),
+        "day_sessions": np.bincount(col, minlength=count).astype(np.int32),
+        "day_minutes": np.bincount(col, weights=store.end[rows] - store.start[rows], minlength=count),
+    }
+
+
+def build_rollup(csv_path, checksum=None):
+    '''
+    Build the rollup of a Sessions_Total CSV
+
+    uses the converted session store when there is one, the CSV otherwise;
+    checksum (of the CSV) is kept in the file when given. Returns the
+    number of sessions rolled up
+    '''
+    store = open_sessions(csv_path)
+    arrays = rollup_arrays(store)
+    arrays["version"] = np.array(ROLLUP_VERSION)
+    arrays["buildings"] = np.array(list(building_dict))
+    if checksum is not None:
+        arrays["checksum"] = np.array(checksum)
+
+    out = rollup_path(csv_path)
+    tmp = f"{out}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp, "wb") as file:
+        np.savez(file, **arrays)
+    os.replace(tmp, out)
+    return len(store)
+
+
+# rollup of this version over the current buildings
+def _is_current(data):
+    return (
+        "version" in data.files and int(data["version"]) == ROLLUP_VERSION
+        and data["buildings"].tolist() == list(building_dict)
+    )
+
+
+# True when the CSV has a rollup of the current version at least as new as itself
+def is_rolled_up(csv_path):
+    out = rollup_path(csv_path)
+    if not os.path.exists(out):
+        return False
+    if os.path.getmtime(out) < os.path.getmtime(csv_path):
+        return False
+    with np.load(out, allow_pickle=False) as data:
+        return _is_current(data)
+
+
+# checksum of the CSV a rollup of the current version was built from, None when not known
+def rollup_checksum(csv_path):
+    out = rollup_path(csv_path)
+    if not os.path.exists(out):
+        return None
+    with np.load(out, allow_pickle=False) as data:
+        if not _is_current(data) or "checksum" not in data.files:
+            return None
+        return str(data["checksum"])
+
+
+def build_in_background(csv_paths):
+    '''
+    Build missing rollups one after the other on a daemon thread
+
+    files already being built are left out; returns False when that is all of them
+    '''
+    with _lock:
+        paths = [path for path in csv_paths if path not in _building]
+        _building.update(paths)
+    if not paths:
+        return False
+
+    def run():
+        try:
+            for path in paths:
+                build_rollup(path)
+                with _lock:
+                    _building.discard(path)
+        finally:
+            with _lock:
+                _building.difference_update(paths)
+
+    threading.Thread(target=run, daemon=True).start()
+    return True
+
+
+def weekday(day):
+    return date(int(day[0:4]), int(day[4:6]), int(day[6:8])).weekday()
+
+
+class RollupTable:
+    '''
+    Rollups of every day that has one, stacked, columns follow building_dict order
+
+    dates[d]                day (YYYYMMDD) of row d, in order
+    weekdays[d]             its day of the week, 0 is Monday
+    hour_devices[d, h, b]   distinct devices in building b during hour h
+    hour_sessions[d, h, b]  sessions overlapping the hour, with the sum of
+    hour_dwell[d, h, b]     the minutes they spent inside it
+    day_devices[d, b]       distinct devices in building b over the day
+    day_sessions[d, b]      sessions of the day, with the sum of their
+    day_minutes[d, b]       lengths in minutes
+    '''
+
+    def __init__(self, dates, days):
+        self.dates = np.array(dates, dtype="U8")
+        self.weekdays = np.array([weekday(day) for day in dates], dtype=np.int8)
+        for name, shape in ARRAYS.items():
+            if days:
+                array = np.stack([day[name] for day in days])
+            else:
+                array = np.zeros((0,) + shape + (len(building_dict),))
+            setattr(self, name, array)
+
+    # rows of the days from first to last (YYYYMMDD, both included) on the given weekdays
+    def select(self, first, last, weekdays=None):
+        chosen = (self.dates >= first) & (self.dates <= last)
+        if weekdays is not None:
+            chosen &= np.isin(self.weekdays, weekdays)
+        return np.flatnonzero(chosen)
+
+
+def _read_day(out, mtime):
+    with _lock:
+        cached = _days.get(out)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+    with np.load(out, allow_pickle=False) as data:
+        day = {name: data[name] for name in ARRAYS} if _is_current(data) else None
+
+    with _lock:
+        _days[out] = (mtime, day)
+    return day
+
+
+def load_rollups():
+    '''
+    Table of every Sessions_Total day with an up to date rollup
+
+    The rollups are only stat-ed on each call; the table is stacked again
+    when one of them changed, reading the files of the days that did.
+    returns (RollupTable, {date: CSV} of the days without a current rollup)
+    '''
+    global _table
+    found = []
+    missing = {}
+    for day, csv_path in sorted(dataset_catalog().files("Total").items()):
+        out = rollup_path(csv_path)
+        try:
+            stat = os.stat(out)
+            current = stat.st_mtime >= os.path.getmtime(csv_path)
+        except OSError:
+            current = False
+        if current:
+            found.append((day, csv_path, out, stat.st_mtime_ns))
+        else:
+            missing[day] = csv_path
+
+    key = tuple((day, mtime) for day, _, _, mtime in found)
+    with _lock:
+        if _table is not None and _table[0] == key:
+            _, table, outdated = _table
+            return table, {**missing, **outdated}
+
+    dates = []
+    days = []
+    outdated = {}
+    for day, csv_path, out, mtime in found:
+        arrays = _read_day(out, mtime)
+        if arrays is None:
+            outdated[day] = csv_path
+            continue
+        dates.append(day)
+        days.append(arrays)
+
+    table = RollupTable(dates, days)
+    with _lock:
+        _table = (key, table, outdated)
+        # forget the days that are gone or were rebuilt
+        kept = {out for _, _, out, _ in found}
+        for out in [out for out in _days if out not in kept]:
+            del _days[out]
+    return table, {**missing, **outdated}
+
+
+def rollup_range(first, last, weekdays):
+    '''
+    Table of the rollups with the days from first to last that have none
+
+    the missing days that have a converted store get their rollup built in
+    the background when settings.ROLLUP_AUTOBUILD is on
+    returns (RollupTable, selected rows, sorted missing dates)
+    '''
+    table, missing = load_rollups()
+    days = table.select(first, last, weekdays)
+    missing = {
+        day: csv_path for day, csv_path in missing.items()
+        if first <= day <= last and (weekdays is None or weekday(day) in weekdays)
+    }
+    cache_lookup("rollup", hits=len(days), misses=len(missing))
+
+    if missing and getattr(settings, "ROLLUP_AUTOBUILD", False):
+        build_in_background([path for path in missing.values() if load_sessions(path) is not None])
+    return table, days, sorted(missing)
+
+
+def parse_selection(text, limit, names=()):
+    '''
+    Numbers 0 - limit-1 of a comma separated list of numbers, names (their
+    position in names) and inclusive ranges of either: "1-5", "mon-fri,sun"
+
+    returns the sorted numbers, ValueError when the text is not a valid list
+    '''
+    def number(item):
+        item = item.strip().lower()
+        if item in names:
+            return names.index(item)
+        value = int(item)
+        if not 0 <= value < limit:
+            raise ValueError(f"{value} is out of range")
+        return value
+
+    chosen = set()
+    for item in text.split(","):
+        low, _, high = item.partition("-")
+        low = number(low)
+        high = number(high) if high else low
+        if high < low:
+            raise ValueError(f"{item} is an empty range")
+        chosen.update(range(low, high + 1))
+    return sorted(chosen)
+
+
+def iso_date(day):
+    return f"{day[0:4]}-{day[4:6]}-{day[6:8]}"
+
+
+# period a day (YYYYMMDD) belongs to: the day, its ISO week or its month
+def period_of(day, group):
+    if group == "week":
+        year, week, _ = date(int(day[0:4]), int(day[4:6]), int(day[6:8])).isocalendar()
+        return f"{year}-W{week:02d}"
+    if group == "month":
+        return f"{day[0:4]}-{day[4:6]}"
+    return iso_date(day)
+
+
+def _averages(total, count):
+    return np.where(count > 0, np.round(total / np.maximum(count, 1), 2), None).tolist()
+
+
+def _header(first, last, table, days, missing, buildings):
+    return {
+        "from": iso_date(first),
+        "to": iso_date(last),
+        "dates": [iso_date(day) for day in table.dates[days].tolist()],
+        "missing_dates": [iso_date(day) for day in missing],
+        "buildings": buildings,
+        "building_lat": [building_dict[building][0] for building in buildings],
+        "building_long": [building_dict[building][1] for building in buildings],
+    }
+
+
+def hourly_profile(first, last, weekdays, hours, buildings):
+    '''
+    Typical day of the buildings over the days from first to last (YYYYMMDD)
+
+    weekdays (0 is Monday) and hours (0 - 23) keep some of them, None keeps
+    every weekday. For every hour and building: the average and peak of
+    distinct devices over the days, the sessions overlapping the hour and
+    the average minutes they spent inside it (None without sessions)
+    '''
+    table, days, missing = rollup_range(first, last, weekdays)
+    codes = {b: i for i, b in enumerate(building_dict)}
+    index = np.ix_(days, hours, [codes[building] for building in buildings])
+
+    devices = table.hour_devices[index]
+    sessions = table.hour_sessions[index].sum(axis=0)
+    dwell = table.hour_dwell[index].sum(axis=0)
+
+    response = _header(first, last, table, days, missing, buildings)
+    response.update({
+        "hours": list(hours),
+        "average_devices": np.round(devices.sum(axis=0) / max(len(days), 1), 2).tolist(),
+        "peak_devices": devices.max(axis=0, initial=0).tolist(),
+        "sessions": sessions.tolist(),
+        "average_dwell": _averages(dwell, sessions),
+    })
+    return response
+
+
+def daily_summary(first, last, weekdays, group, buildings):
+    '''
+    Daily stats of the buildings over the days from first to last
+    (YYYYMMDD), per day, ISO week or month (group)
+
+    weekdays (0 is Monday) keeps some of the days, None keeps them all.
+    For every period and building: the average of daily distinct devices,
+    the peak of hourly distinct devices, the sessions and their average
+    length in minutes (None without sessions)
+    '''
+    table, days, missing = rollup_range(first, last, weekdays)
+    codes = {b: i for i, b in enumerate(building_dict)}
+    cols = [codes[building] for building in buildings]
+
+    periods, inverse = np.unique([period_of(day, group) for day in table.dates[days].tolist()],
+                                 return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(periods))
+    shape = (len(periods), len(cols))
+
+    devices = np.zeros(shape, dtype=np.int64)
+    np.add.at(devices, inverse, table.day_devices[np.ix_(days, cols)])
+    peak = np.zeros(shape, dtype=np.int64)
+    np.maximum.at(peak, inverse, table.hour_devices[days][:, :, cols].max(axis=1, initial=0))
+    sessions = np.zeros(shape, dtype=np.int64)
+    np.add.at(sessions, inverse, table.day_sessions[np.ix_(days, cols)])
+    minutes = np.zeros(shape, dtype=np.float64)
+    np.add.at(minutes, inverse, table.day_minutes[np.ix_(days, cols)])
+
+    response = _header(first, last, table, days, missing, buildings)
+    response.update({
+        "group": group,
+        "periods": periods.tolist(),
+        "days": counts.tolist(),
+        "average_devices": np.round(devices / np.maximum(counts, 1)[:, None], 2).tolist(),
+        "peak_hour_devices": peak.tolist(),
+        "sessions": sessions.tolist(),
+        "average_dwell": _averages(minutes, sessions),
+    })
+    return response
@@ -0,0 +1,413 @@
+import os
+import csv
+import re
+import hashlib
+import threading
+from functools import cached_property, lru_cache
+import numpy as np
+from django.conf import settings
+from .consts import ap_dict
+from .intervals import IntervalIndex
+from .ragged import read_columns, number_lists, string_lists, factorize, firsts, lasts
+from .metrics import timed, rows_scanned, cache_lookup
+
+
+# converted session files sit next to their CSV with this extension
+STORE_EXT = ".npz"
+
+# columns in a *_sessions_final.csv, the helpers only read a few of them
+SESSION_COLUMNS = 38
+SESSION_HEADER = [f"column_{i}" for i in range(SESSION_COLUMNS)]
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+# root folder holding the Sessions_* and Trajectory folders
+def data_root():
+    return os.path.abspath(settings.CSV_DATA_DIR)
+
+
+def store_path(csv_path):
+    return os.path.splitext(csv_path)[0] + STORE_EXT
+
+
+FLOOR_PATTERN = re.compile(r'\d')
+
+
+# floor level of an access point, e.g. LGRC-A307-1 -> 3
+# returns -1 when the name does not carry a floor number
+@lru_cache(maxsize=65536)
+def ap_floor(ap):
+    ap_name = ap.split("-")
+    if len(ap_name) < 2:
+        return -1
+    level = FLOOR_PATTERN.search(ap_name[1])
+    if level is None:
+        return -1
+    return int(level.group(0))
+
+
+class SessionStore:
+    '''
+    Columnar view of one day's *_sessions_final.csv
+
+    One entry per session (csv row) in file order:
+        start, end      first connection start / last connection end in minutes
+        building        code into buildings
+        device          code into devices
+        date            code into dates (row[32][:10])
+    One entry per access point connection, grouped by session:
+        ap_offsets      connections of session i are ap_offsets[i]:ap_offsets[i+1]
+        ap, ap_start, ap_end
+    Access point metadata, one entry per name in aps (see ap_metadata):
+        ap_floor        floor parsed from the name, -1 if it has none
+        ap_building     building code of the first session using it
+        ap_lat, ap_long location from ap_dict, NaN when it is not mapped
+        building_aps    access points used by building b are
+                        building_aps[building_ap_offsets[b]:building_ap_offsets[b+1]]
+    '''
+
+    def __init__(self, arrays):
+        self.start = arrays["start"]
+        self.end = arrays["end"]
+        self.building = arrays["building"]
+        self.device = arrays["device"]
+        self.date = arrays["date"]
+        self.ap_offsets = arrays["ap_offsets"]
+        self.ap = arrays["ap"]
+        self.ap_start = arrays["ap_start"]
+        self.ap_end = arrays["ap_end"]
+        self.buildings = arrays["buildings"]
+        self.devices = arrays["devices"]
+        self.dates = arrays["dates"]
+        self.aps = arrays["aps"]
+
+        # stores converted before the metadata existed get it computed here
+        if "ap_floor" not in arrays:
+            arrays = dict(arrays, **ap_metadata(arrays))
+        self.ap_floors = arrays["ap_floor"]
+        self.ap_building = arrays["ap_building"]
+        self.ap_lat = arrays["ap_lat"]
+        self.ap_long = arrays["ap_long"]
+        self.building_ap_offsets = arrays["building_ap_offsets"]
+        self.building_aps = arrays["building_aps"]
+
+        self.building_codes = {b: i for i, b in enumerate(self.buildings.tolist())}
+        self.ap_session = np.repeat(np.arange(len(self.start)), np.diff(self.ap_offsets))
+
+    def __len__(self):
+        return len(self.start)
+
+    # interval index over whole sessions (first start to last end)
+    @cached_property
+    def session_index(self):
+        return IntervalIndex(self.start, self.end)
+
+    # interval index over single access point connections
+    @cached_property
+    def ap_index(self):
+        return IntervalIndex(self.ap_start, self.ap_end)
+
+    # sessions overlapping the minutes [lo, hi], in file order
+    def sessions_between(self, lo, hi):
+        rows = self.session_index.overlapping(lo, hi)
+        rows_scanned("store", len(rows))
+        return rows
+
+    # access point connections overlapping the minutes [lo, hi], in file order
+    def connections_between(self, lo, hi):
+        rows = self.ap_index.overlapping(lo, hi)
+        rows_scanned("store", len(rows))
+        return rows
+
+    # row indices (in file order) of sessions in a building
+    def building_rows(self, building):
+        code = self.building_codes.get(building)
+        if code is None:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(self.building == code)
+
+    # access point connection indices belonging to the given sessions
+    def ap_rows(self, rows):
+        mask = np.zeros(len(self.start), dtype=bool)
+        mask[rows] = True
+        return np.flatnonzero(mask[self.ap_session])
+
+    # access point codes used by the building's sessions
+    def building_access_points(self, building):
+        code = self.building_codes.get(building)
+        if code is None:
+            return np.empty(0, dtype=np.int64)
+        return self.building_aps[self.building_ap_offsets[code]:self.building_ap_offsets[code + 1]]
+
+    # highest floor of any access point used by the building's sessions
+    def max_floor(self, building):
+        return int(self.ap_floors[self.building_access_points(building)].max(initial=0))
+
+    # (floor, access points, access points mapped in ap_dict) per floor in use
+    def floors(self, building):
+        aps = self.building_access_points(building)
+        aps = aps[self.ap_floors[aps] >= 0]
+        floors = self.ap_floors[aps]
+        mapped = ~np.isnan(self.ap_lat[aps])
+
+        response = []
+        for floor in np.unique(floors).tolist():
+            on_floor = floors == floor
+            response.append((floor, int(on_floor.sum()), int((on_floor & mapped).sum())))
+        return response
+
+
+def ap_metadata(arrays):
+    '''
+    Access point table of a day: floor, building and location of every
+    access point name, and the access points each building uses
+    '''
+    aps = arrays["aps"].tolist()
+    buildings = arrays["buildings"].tolist()
+    ap_session = np.repeat(np.arange(len(arrays["start"])), np.diff(arrays["ap_offsets"]))
+    ap_building_of_conn = arrays["building"][ap_session]
+
+    # building of the first session using each access point
+    ap_building = np.full(len(aps), -1, dtype=np.int32)
+    codes, first = np.unique(arrays["ap"], return_index=True)
+    ap_building[codes] = ap_building_of_conn[first]
+
+    ap_lat = np.full(len(aps), np.nan)
+    ap_long = np.full(len(aps), np.nan)
+    for code, ap in enumerate(aps):
+        if ap_building[code] < 0:
+            continue
+        location = ap_dict.get(buildings[ap_building[code]], {}).get(ap)
+        if location is not None:
+            ap_lat[code], ap_long[code] = location
+
+    # distinct (building, access point) pairs, grouped by building
+    pairs = np.unique(ap_building_of_conn.astype(np.int64) * max(len(aps), 1) + arrays["ap"])
+    pair_building = pairs // max(len(aps), 1)
+    building_ap_offsets = np.searchsorted(pair_building, np.arange(len(buildings) + 1))
+
+    return {
+        "ap_floor": np.array([ap_floor(ap) for ap in aps], dtype=np.int32),
+        "ap_building": ap_building,
+        "ap_lat": ap_lat,
+        "ap_long": ap_long,
+        "building_ap_offsets": building_ap_offsets.astype(np.int64),
+        "building_aps": (pairs % max(len(aps), 1)).astype(np.int64),
+    }
+
+
+def _table(table):
+    return np.array(list(table), dtype=str)
+
+
+# csv fields of one session, date is a date or datetime
+def session_row(device, building, aps, starts, ends, date):
+    row = [""] * SESSION_COLUMNS
+    row[0] = str(len(aps))
+    row[1] = str(aps)
+    row[2] = str(starts)
+    row[3] = str(ends)
+    row[26] = device
+    row[32] = f"{date:%Y-%m-%d} 00:00:00"
+    row[36] = building
+    return row
+
+
+# parse a day's sessions CSV into the columnar arrays
+@timed("csv")
+def read_sessions_csv(path):
+    aps, starts, ends, devices, dates, buildings = read_columns(path, [1, 2, 3, 26, 32, 36])
+    return sessions_columns(aps, starts, ends, devices, dates, buildings)
+
+
+# columnar arrays of session rows (lists of csv fields)
+def sessions_arrays(rows):
+    rows = list(rows)
+    return sessions_columns(*([row[i] for row in rows] for i in (1, 2, 3, 26, 32, 36)))
+
+
+def sessions_columns(aps, starts, ends, devices, dates, buildings):
+    '''
+    Columnar arrays of sessions given as csv columns (lists of strings)
+
+    the access point, start and end lists are parsed in bulk (see ragged.py)
+    '''
+    ap, ap_table, ap_offsets = string_lists(aps)
+    ap_start, start_offsets = number_lists(starts)
+    ap_end, end_offsets = number_lists(ends)
+    if not np.array_equal(ap_offsets, start_offsets) or not np.array_equal(ap_offsets, end_offsets):
+        raise ValueError("A session has access point, start and end lists of different lengths")
+
+    building, building_table = factorize(buildings)
+    device, device_table = factorize(devices)
+    date, date_table = factorize([value[:10] for value in dates])
+    arrays = {
+        # first connection start and last connection end of every session
+        "start": firsts(ap_start, ap_offsets),
+        "end": lasts(ap_end, ap_offsets),
+        "building": building,
+        "device": device,
+        "date": date,
+        "ap_offsets": ap_offsets,
+        "ap": ap,
+        "ap_start": ap_start,
+        "ap_end": ap_end,
+        "buildings": building_table,
+        "devices": device_table,
+        "dates": date_table,
+        "aps": ap_table,
+    }
+    arrays.update(ap_metadata(arrays))
+    return arrays
+
+
+# checksum of a CSV, kept in the files built from it (see build_store)
+def file_checksum(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def convert_sessions(csv_path, checksum=None):
+    '''
+    Convert a sessions CSV into its columnar store file
+
+    checksum (of the CSV) is kept in the store when given;
+    returns the number of sessions converted
+    '''
+    arrays = read_sessions_csv(csv_path)
+    if checksum is not None:
+        arrays["checksum"] = np.array(checksum)
+    _write_store(store_path(csv_path), arrays)
+    return len(arrays["start"])
+
+
+# checksum of the CSV the store was converted from, None when not known
+def store_checksum(csv_path):
+    out = store_path(csv_path)
+    if not os.path.exists(out):
+        return None
+    with np.load(out, allow_pickle=False) as data:
+        return str(data["checksum"]) if "checksum" in data.files else None
+
+
+def _write_store(out, arrays):
+    tmp = f"{out}.tmp{os.getpid()}"
+    with open(tmp, "wb") as file:
+        np.savez(file, **arrays)
+    os.replace(tmp, out)
+
+
+def _merge_table(old, new):
+    table = {value: i for i, value in enumerate(old.tolist())}
+    codes = np.array([table.setdefault(value, len(table)) for value in new.tolist()], dtype=np.int32)
+    return _table(table), codes
+
+
+def merge_sessions(arrays, new):
+    '''
+    Columnar arrays of arrays followed by the sessions of new
+
+    codes of new are moved onto the tables of arrays, values arrays
+    has not seen are added at the end of its tables
+    '''
+    merged = {}
+    for column, table in (("building", "buildings"), ("device", "devices"), ("date", "dates"), ("ap", "aps")):
+        merged[table], codes = _merge_table(arrays[table], new[table])
+        merged[column] = np.concatenate((arrays[column], codes[new[column]])).astype(np.int32)
+
+    for column in ("start", "end", "ap_start", "ap_end"):
+        merged[column] = np.concatenate((arrays[column], new[column]))
+    merged["ap_offsets"] = np.concatenate((arrays["ap_offsets"], new["ap_offsets"][1:] + arrays["ap_offsets"][-1]))
+
+    merged.update(ap_metadata(merged))
+    return merged
+
+
+def append_sessions(csv_path, rows):
+    '''
+    Add session rows (see session_row) to a day's CSV and its store
+
+    the CSV is created when the day has none yet. An up to date store gets
+    the new rows merged in without reading the CSV again, otherwise the
+    whole CSV is converted. The store is written after the CSV, so it stays
+    at least as new as it.
+    '''
+    current = os.path.exists(csv_path) and is_converted(csv_path)
+    append_csv(csv_path, rows)
+    return update_store(csv_path, rows, current)
+
+
+# add session rows to a day's CSV only, creating it when the day has none yet
+def append_csv(csv_path, rows):
+    os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+    with open(csv_path, "a", newline="") as file:
+        writer = csv.writer(file)
+        if file.tell() == 0:
+            writer.writerow(SESSION_HEADER)
+        writer.writerows(rows)
+
+
+def update_store(csv_path, rows, current):
+    '''
+    Bring the store of a day up to date after rows were appended to its CSV
+
+    current tells whether the store was up to date before they were: the
+    rows are then merged in, otherwise the whole CSV is converted
+    '''
+    out = store_path(csv_path)
+    if not current:
+        convert_sessions(csv_path)
+        return out
+
+    with np.load(out, allow_pickle=False) as data:
+        arrays = {key: data[key] for key in data.files}
+    _write_store(out, merge_sessions(arrays, sessions_arrays(rows)))
+    return out
+
+
+# True when the CSV has a converted file at least as new as itself
+def is_converted(csv_path):
+    out = store_path(csv_path)
+    if not os.path.exists(out):
+        return False
+    return os.path.getmtime(out) >= os.path.getmtime(csv_path)
+
+
+def load_sessions(csv_path):
+    '''
+    Get the columnar store for a sessions CSV
+
+    returns None when the CSV has not been converted (or changed since),
+    callers then fall back to reading the CSV
+    '''
+    if not is_converted(csv_path):
+        cache_lookup("store", misses=1)
+        return None
+    cache_lookup("store", hits=1)
+
+    out = store_path(csv_path)
+    mtime = os.path.getmtime(out)
+    with _cache_lock:
+        cached = _cache.get(out)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+    with np.load(out, allow_pickle=False) as data:
+        store = SessionStore({key: data[key] for key in data.files})
+
+    with _cache_lock:
+        _cache[out] = (mtime, store)
+    return store
+
+
+# converted store when there is one, otherwise parse the CSV in memory
+def open_sessions(csv_path):
+    store = load_sessions(csv_path)
+    if store is None:
+        store = SessionStore(read_sessions_csv(csv_path))
+    return store
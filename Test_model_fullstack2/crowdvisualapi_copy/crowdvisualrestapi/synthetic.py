@@ -0,0 +1,103 @@
+import os
+import csv
+import random
+from datetime import datetime, timedelta
+from .consts import building_dict, ap_dict
+from .store import session_row, SESSION_HEADER
+
+
+TRAJECTORY_HEADER = ["device_id", "building", "start_time", "end_time", "total_time"]
+
+
+def access_points(building, rnd, count):
+    '''
+    Access point names for a session, the mapped ones from ap_dict when the
+    building has them, otherwise names in the BLDG-<floor><room>-1 pattern
+    '''
+    if building in ap_dict:
+        return [rnd.choice(list(ap_dict[building])) for _ in range(count)]
+    return [f"{building}-{rnd.randint(0, 6)}{rnd.randint(10, 99)}-1" for _ in range(count)]
+
+
+def day_sessions(devices, sessions, rnd):
+    '''
+    Sessions of one day as (device, building, aps, starts, ends)
+
+    a few busy buildings get most of the traffic, like the real campus
+    '''
+    buildings = list(building_dict)
+    weights = [20 if b in ap_dict else rnd.choice([1, 1, 2, 5]) for b in buildings]
+
+    rows = []
+    for _ in range(sessions):
+        device = f"#syn{rnd.randrange(devices):08d}#"
+        building = rnd.choices(buildings, weights)[0]
+        count = rnd.randint(1, 4)
+
+        # starts are whole minutes and ends floats, as in the real exports
+        t = rnd.randint(0, 1380)
+        starts, ends = [], []
+        for _ in range(count):
+            starts.append(t)
+            t = min(t + rnd.choice([0, rnd.randint(1, 90)]), 1440)
+            ends.append(float(t))
+            t = min(t + rnd.randint(0, 20), 1440)
+
+        rows.append((device, building, access_points(building, rnd, count), starts, ends))
+    return rows
+
+
+def write_csv(path, header, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def generate_dataset(root, start_date="2021-03-01", days=1, devices=5000, sessions=20000, seed=0):
+    '''
+    Write a synthetic csv_data folder under root
+
+    every day gets a Sessions_Total file, one Sessions_<building> file per
+    building with sessions, and a Trajectory file with every device's stays
+    in time order; returns the dates written (YYYYMMDD)
+    '''
+    rnd = random.Random(seed)
+    data = os.path.join(root, "csv_data")
+    first_day = datetime.strptime(start_date, "%Y-%m-%d")
+
+    written = []
+    for day in range(days):
+        date = first_day + timedelta(days=day)
+        name = f"{date:%Y%m%d}"
+        rows = day_sessions(devices, sessions, rnd)
+
+        total = []
+        by_building = {}
+        for device, building, aps, starts, ends in rows:
+            row = session_row(device, building, aps, starts, ends, date)
+            total.append(row)
+            by_building.setdefault(building, []).append(row)
+
+        write_csv(os.path.join(data, "Sessions_Total", f"{name}_sessions_final.csv"), SESSION_HEADER, total)
+        for building, building_rows in by_building.items():
+            write_csv(os.path.join(data, f"Sessions_{building}", f"{name}_sessions_final.csv"), SESSION_HEADER, building_rows)
+
+        stays = {}
+        for device, building, aps, starts, ends in rows:
+            stays.setdefault(device, []).append((float(starts[0]), ends[-1], building))
+        trajectories = []
+        for device, device_stays in stays.items():
+            device_stays.sort()
+            trajectories.append([
+                device,
+                str([s[2] for s in device_stays]),
+                str([s[0] for s in device_stays]),
+                str([s[1] for s in device_stays]),
+                str([s[1] - s[0] for s in device_stays]),
+            ])
+        write_csv(os.path.join(data, "Trajectory", f"{name}_finaltraj.csv"), TRAJECTORY_HEADER, trajectories)
+
+        written.append(name)
+    return written
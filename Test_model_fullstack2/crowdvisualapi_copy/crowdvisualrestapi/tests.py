@@ -1,3 +1,1133 @@
-from django.test import TestCase
+import os
+import csv
+import json
+import asyncio
+import threading
+import pstats
+import cProfile
+import random
+import shutil
+import tempfile
+import warnings
+from datetime import date, datetime, timedelta
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from unittest import mock, skipIf
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+from django.conf import settings
+from django.core.management import call_command
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from .synthetic import day_sessions, write_csv, TRAJECTORY_HEADER
+from .consts import building_dict, ap_dict
+from .intervals import IntervalIndex
+from .ragged import read_columns, number_lists, string_lists, firsts, lasts
+from .store import session_row, convert_sessions, load_sessions, ap_floor, SESSION_HEADER
+from .ingest import save_checkpoint, sessions_csv, SessionWriter
+from . import ingest
+from .cube import build_cube, load_cube, cube_path
+from .rollup import build_rollup, is_rolled_up, hourly_profile, daily_summary
+from .catalog import DatasetCatalog, dataset_catalog
+from .metrics import metrics, timed, RequestMetrics
+from . import pools
+from .pools import run_in_pool
+from .http_cache import source_validators
+from .compact import msgpack
+from .live import LiveOccupancy, live_stream
+from .prediction_cache import PredictionCache
+from . import registry as registry_module
+from .registry import (ModelRegistry, EnhancedRNN, reference_scaler, prediction_features, feature_count,
+                       hidden_size, num_layers, output_size)
+from .trajectory import build_trajectory_index, load_trajectory_index, trajectory_index_path
+from .helper import campus_occupancy_csv, ap_occupancy_csv, campus_occupancy, campus_timeline, building_occupancy, buildings_occupancy, ap_occupancy, device_traj, device_traj_csv
 
-# Create your tests here.
+
+def write_sessions(folder, day, sessions=600, devices=120, seed=0, extra=()):
+    '''
+    Write a synthetic Sessions_Total CSV of a day (YYYY-MM-DD) under folder
+
+    extra (device, building, aps, starts, ends) sessions are added after the
+    synthetic ones; returns the CSV path
+    '''
+    when = date.fromisoformat(day)
+    rows = [session_row(*session, when) for session in day_sessions(devices, sessions, random.Random(seed))]
+    rows += [session_row(*session, when) for session in extra]
+    path = os.path.join(folder, "Sessions_Total", day.replace("-", "") + "_sessions_final.csv")
+    write_csv(path, SESSION_HEADER, rows)
+    return path
+
+
+# sessions the synthetic days do not have
+EDGE_SESSIONS = [
+    # access points without a floor number, ap_floor gives -1
+    ("#edge0001#", "LGRC", ["LGRC-LOBBY", "LGRCAP", "LGRC-A307-1"], [600, 610, 630], [605.0, 625.0, 700.0]),
+    # a building missing from building_dict
+    ("#edge0002#", "ZZZZ", ["ZZZZ-101-1"], [600], [700.0]),
+    # a connection with no length, and a device seen in two buildings
+    ("#edge0003#", "KNWL", ["KNWL-E220-1"], [720], [720.0]),
+    ("#edge0003#", "LSL", ["LSL-N101-1"], [721], [780.0]),
+]
+
+
+class DataTestCase(TestCase):
+    '''
+    TestCase with an empty csv_data folder (self.data) as CSV_DATA_DIR and
+    nothing built in the background
+    '''
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.data = os.path.join(root, "csv_data")
+        os.makedirs(self.data)
+        overridden = override_settings(
+            CSV_DATA_DIR=self.data,
+            OCCUPANCY_CUBE_AUTOBUILD=False,
+            TRAJECTORY_INDEX_AUTOBUILD=False,
+            ROLLUP_AUTOBUILD=False,
+        )
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+
+class DatasetCatalogTests(DataTestCase):
+
+    # a folder's listing is trusted while its mtime stays the same
+    def touch(self, folder, seconds):
+        stat = os.stat(folder)
+        os.utime(folder, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10 ** 9))
+
+    def available(self):
+        response = self.client.get(reverse("datasets-api"))
+        self.assertEqual(response.status_code, 200)
+        return response.json()["data"]
+
+    def test_new_files_and_folders_show_up(self):
+        folder = os.path.dirname(write_sessions(self.data, "2021-03-01"))
+        self.assertEqual(self.available(), {"campus": ["2021-03-01"], "trajectory": [], "buildings": {}})
+
+        write_sessions(self.data, "2021-03-02")
+        self.touch(folder, 1)
+        self.assertEqual(self.available()["campus"], ["2021-03-01", "2021-03-02"])
+        self.assertIsNotNone(dataset_catalog().path("Total", "20210302"))
+
+        building = os.path.join(self.data, "Sessions_LGRC")
+        write_csv(os.path.join(building, "20210301_sessions_final.csv"), SESSION_HEADER, [])
+        self.touch(self.data, 1)
+        self.assertEqual(self.available()["buildings"], {"LGRC": ["2021-03-01"]})
+
+        os.remove(os.path.join(folder, "20210301_sessions_final.csv"))
+        self.touch(folder, 2)
+        self.assertEqual(self.available()["campus"], ["2021-03-02"])
+        self.assertIsNone(dataset_catalog().path("Total", "20210301"))
+
+    def test_unchanged_folder_not_listed_again(self):
+        write_sessions(self.data, "2021-03-01")
+        catalog = dataset_catalog()
+        with mock.patch.object(DatasetCatalog, "_scan_folder", autospec=True,
+                               side_effect=DatasetCatalog._scan_folder) as scan:
+            for _ in range(3):
+                self.assertEqual(catalog.dates("Total"), ["20210301"])
+            self.assertEqual(scan.call_count, 1)
+            self.touch(os.path.join(self.data, "Sessions_Total"), 1)
+            catalog.dates("Total")
+            self.assertEqual(scan.call_count, 2)
+
+
+class CampusTimelineTests(DataTestCase):
+
+    def assert_matches_campus(self, path, times):
+        timeline = campus_timeline(path, "2021-03-01", times[0], times[-1], times[1] - times[0], True)
+        self.assertEqual(timeline["times"], times)
+        for time, counts in zip(times, timeline["connection_count"]):
+            got = {b: c for b, c in zip(timeline["buildings"], counts) if c}
+            expected = {e["building"]: e["connection_count"] for e in campus_occupancy(path, time, True)}
+            self.assertEqual(got, expected, f"minute {time}")
+
+    # every 13 minutes: whole hours (0 and 780) and windows between them
+    def test_hour_timeline_matches_campus_occupancy(self):
+        path = write_sessions(self.data, "2021-03-01")
+        times = list(range(0, 1441, 13))
+
+        self.assert_matches_campus(path, times)   # CSV
+        convert_sessions(path)
+        self.assert_matches_campus(path, times)   # store
+        build_cube(path)
+        self.assert_matches_campus(path, times)   # cube for whole hours, store otherwise
+
+
+class SessionStoreTests(DataTestCase):
+    TIMES = [0, 1, 359, 600, 601, 610, 625, 720, 721, 1000, 1439, 1440]
+    BUILDINGS = ["KNWL", "LGRC", "LSL"] + list(building_dict)[:5]
+
+    # every helper answer of the day, at minute and hour granularity
+    def answers(self, path):
+        answers = []
+        for time in self.TIMES:
+            for hour in (False, True):
+                answers.append(campus_occupancy(path, time, hour))
+                answers += [building_occupancy(path, building, time, hour) for building in self.BUILDINGS]
+                answers += [ap_occupancy(path, "LGRC", time, floor, hour) for floor in range(-1, 7)]
+        return answers
+
+    def test_store_matches_csv(self):
+        path = write_sessions(self.data, "2021-03-01", extra=EDGE_SESSIONS)
+        expected = self.answers(path)
+        self.assertIsNone(load_sessions(path))
+
+        convert_sessions(path)
+        self.assertIsNotNone(load_sessions(path))
+        self.assertEqual(self.answers(path), expected)
+
+    def test_access_points_without_floor(self):
+        self.assertEqual(ap_floor("LGRC-A307-1"), 3)
+        self.assertEqual(ap_floor("LGRC-LOBBY"), -1)
+        self.assertEqual(ap_floor("LGRCAP"), -1)
+
+        path = write_sessions(self.data, "2021-03-01", sessions=0, extra=EDGE_SESSIONS)
+        csv_answer = ap_occupancy(path, "LGRC", 600, -1)
+        convert_sessions(path)
+        self.assertEqual(ap_occupancy(path, "LGRC", 600, -1), csv_answer)
+        self.assertEqual([(e["access_point"], e["connection_count"]) for e in csv_answer], [("LGRC-LOBBY", 1)])
+        # in an hour the device only counts for the first access point it is seen on
+        self.assertEqual([e["access_point"] for e in ap_occupancy(path, "LGRC", 600, -1, True)], ["LGRC-LOBBY"])
+        self.assertEqual([e["access_point"] for e in ap_occupancy(path, "LGRC", 610, -1, True)], ["LGRCAP"])
+
+
+# campus_occupancy of the CSV, row by row as it was first written
+def reference_campus(path, time, hour):
+    response = {}
+    seen = set()
+    with open(path, newline="") as file:
+        reader = csv.reader(file)
+        next(reader)
+        for row in reader:
+            start = float(row[2].strip("[]").split(",")[0])
+            end = float(row[3].strip("[]").split(",")[-1])
+            if row[36] not in building_dict:
+                continue
+            low, high = (time, time) if not hour else (time, time + 59)
+            if start > high or end <= low or (hour and row[26] in seen):
+                continue
+            seen.add(row[26])
+            entry = response.setdefault(row[36], {
+                "date": row[32][:10], "building": row[36],
+                "building_lat": building_dict[row[36]][0], "building_long": building_dict[row[36]][1],
+                "connection_count": 0,
+            })
+            entry["connection_count"] += 1
+    return list(response.values())
+
+
+# ap_occupancy of the CSV, row by row as it was first written
+def reference_ap(path, building, time, floor, hour):
+    response = {}
+    seen = set()
+    with open(path, newline="") as file:
+        reader = csv.reader(file)
+        next(reader)
+        for row in reader:
+            if row[36] != building:
+                continue
+            aps = [ap.strip(" '") for ap in row[1].strip("[]").split(",")]
+            starts = row[2].strip("[]").split(",")
+            ends = row[3].strip("[]").split(",")
+            for ap, start, end in zip(aps, starts, ends):
+                low, high = (time, time) if not hour else (time, time + 59)
+                if float(start) > high or float(end) <= low or (hour and row[26] in seen):
+                    continue
+                if ap_floor(ap) != floor:
+                    continue
+                seen.add(row[26])
+                lat, long = ap_dict[building].get(ap, (0, 0))
+                entry = response.setdefault(ap, {
+                    "date": row[32][:10], "access_point": ap, "connection_count": 0,
+                    "building_lat": lat, "building_long": long,
+                })
+                entry["connection_count"] += 1
+    return list(response.values())
+
+
+class CsvFallbackTests(DataTestCase):
+
+    def test_matches_row_by_row_count(self):
+        path = write_sessions(self.data, "2021-03-01", sessions=1000, devices=150, extra=EDGE_SESSIONS)
+        counted = 0
+        for time in list(range(420, 1200, 130)) + [600, 610, 720]:
+            for hour in (False, True):
+                answer = campus_occupancy_csv(path, time, hour)
+                self.assertEqual(answer, reference_campus(path, time, hour), f"campus {time} {hour}")
+                counted += len(answer)
+                for floor in (-1, 1, 2, 3):
+                    answer = ap_occupancy_csv(path, "LGRC", time, floor, hour)
+                    self.assertEqual(answer, reference_ap(path, "LGRC", time, floor, hour), f"LGRC {floor} {time} {hour}")
+                    counted += len(answer)
+        self.assertGreater(counted, 100)
+
+
+class IntervalIndexTests(SimpleTestCase):
+
+    def assert_matches_filter(self, start, end, queries):
+        index = IntervalIndex(start, end)
+        for lo, hi in queries:
+            expected = np.flatnonzero((start <= hi) & (end > lo))
+            np.testing.assert_array_equal(index.overlapping(lo, hi), expected, f"[{lo}, {hi}]")
+
+    def test_matches_brute_force(self):
+        rnd = np.random.default_rng(0)
+        # sizes around the leaf size, so both leaves and inner nodes answer
+        for size in (0, 1, 31, 32, 33, 200, 3000):
+            # whole minutes, so many intervals share endpoints with each other
+            # and with the queries, a fifth of them zero-length
+            start = rnd.integers(0, 1441, size).astype(np.float64)
+            length = rnd.integers(0, 120, size) * (rnd.random(size) > 0.2)
+            end = np.minimum(start + length, 1440.0)
+            end[rnd.random(size) < 0.3] += 0.5  # float ends, as in the exports
+
+            queries = [(m, m) for m in range(0, 1441, 7)]
+            queries += [(float(h * 60), h * 60 + 59.0) for h in range(25)]
+            # queries at the exact endpoints of some intervals
+            for i in rnd.integers(0, size, 50) if size else []:
+                queries += [(start[i], start[i]), (end[i], end[i]), (start[i] - 59, start[i]), (end[i], end[i] + 59)]
+            self.assert_matches_filter(start, end, queries)
+
+    def test_edges(self):
+        start = np.array([10.0, 10.0, 20.0, 5.0] + [0.0] * 40)
+        end = np.array([10.0, 20.0, 30.0, 10.0] + [1440.0] * 40)
+        index = IntervalIndex(start, end)
+        # a zero-length interval matches no single minute, [10, 20) ends before 20
+        self.assertNotIn(0, index.overlapping(10, 10))
+        self.assertIn(1, index.overlapping(10, 10))
+        self.assertNotIn(1, index.overlapping(20, 20))
+        self.assertIn(2, index.overlapping(20, 20))
+        self.assertNotIn(3, index.overlapping(10, 10))
+        # a window starting before it takes the zero-length one in (10 > 9.5)
+        self.assertIn(0, index.overlapping(9.5, 10))
+        self.assertEqual(len(IntervalIndex([], []).overlapping(0, 1440)), 0)
+
+
+class OccupancyCubeTests(DataTestCase):
+    MINUTES = [0, 1, 59, 60, 359, 600, 601, 610, 625, 720, 721, 1000, 1439, 1440]
+    HOURS = list(range(0, 1441, 60))
+    BUILDINGS = ["KNWL", "LGRC", "LSL"] + list(building_dict)[:5]
+
+    def answers(self, path):
+        answers = []
+        for times, hour in ((self.MINUTES, False), (self.HOURS, True)):
+            for time in times:
+                answers.append(campus_occupancy(path, time, hour))
+                answers += [building_occupancy(path, building, time, hour) for building in self.BUILDINGS]
+        return answers
+
+    def test_cube_matches_store(self):
+        path = write_sessions(self.data, "2021-03-01", extra=EDGE_SESSIONS)
+        convert_sessions(path)
+        expected = self.answers(path)
+
+        build_cube(path)
+        self.assertIsNotNone(load_cube(path))
+        self.assertEqual(self.answers(path), expected)
+
+    def test_rebuild_keeps_loaded_cube_readable(self):
+        path = write_sessions(self.data, "2021-03-01")
+        build_cube(path)
+        old = load_cube(path)
+        counts = np.array(old.minute_count)
+
+        build_cube(path)
+        np.testing.assert_array_equal(old.minute_count, counts)
+        self.assertIsNotNone(load_cube(path))
+        # only the CSV and the new cube are left
+        folder = os.path.dirname(path)
+        self.assertEqual(sorted(os.listdir(folder)), sorted([os.path.basename(path), os.path.basename(cube_path(path))]))
+
+
+class BuildingStatsTests(DataTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = write_sessions(self.data, "2021-03-01", extra=EDGE_SESSIONS)
+        # busy, quiet and unused buildings
+        self.buildings = list(building_dict)
+
+    def assert_bulk_matches(self, source):
+        for time in (0, 600, 630, 1380):
+            for hour in (False, True):
+                bulk = buildings_occupancy(self.path, self.buildings, time, hour)
+                self.assertEqual(list(bulk), self.buildings)
+                for building in self.buildings:
+                    self.assertEqual(bulk[building], building_occupancy(self.path, building, time, hour),
+                                     f"{source} {building} minute {time} hour {hour}")
+
+    def test_bulk_matches_building_occupancy(self):
+        self.assert_bulk_matches("csv")
+        convert_sessions(self.path)
+        self.assert_bulk_matches("store")
+        build_cube(self.path)
+        self.assert_bulk_matches("cube")
+
+    def test_buildings_view_matches_building_view(self):
+        response = self.client.get(reverse("buildings-api", args=["2021-03-01T10:00"]), {"buildings": "LGRC,LSL"})
+        self.assertEqual(response.status_code, 200)
+        bulk = response.json()["data"]
+        self.assertEqual(list(bulk), ["LGRC", "LSL"])
+        for building in bulk:
+            single = self.client.get(reverse("building-api", args=[building, "2021-03-01T10:00"]))
+            self.assertEqual(bulk[building], single.json()["data"])
+
+    # floor -> (access points, access points in ap_dict) of a building, from the
+    # CSV; access points without a floor number (LGRC-LOBBY) are left out
+    def reference_floors(self, building):
+        aps = set()
+        with open(self.path, newline="") as file:
+            reader = csv.reader(file)
+            next(reader)
+            for row in reader:
+                if row[36] == building:
+                    aps.update(ap.strip(" '") for ap in row[1].strip("[]").split(","))
+        floors = {}
+        for ap in aps:
+            floor = ap_floor(ap)
+            if floor >= 0:
+                count, mapped = floors.get(floor, (0, 0))
+                floors[floor] = (count + 1, mapped + (ap in ap_dict.get(building, {})))
+        return floors
+
+    def test_floors_list_only_floors_with_access_points(self):
+        convert_sessions(self.path)
+        for building in ("LGRC", "LSL", list(building_dict)[-1]):
+            response = self.client.get(reverse("floors-api", args=[building]), {"date": "2021-03-01"})
+            self.assertEqual(response.status_code, 200)
+            data = response.json()["data"]
+            expected = self.reference_floors(building)
+            self.assertEqual({f["floor"]: (f["access_points"], f["mapped_access_points"]) for f in data["floors"]},
+                             expected, building)
+            self.assertEqual([f["floor"] for f in data["floors"]], sorted(expected))
+            self.assertEqual(data["no_floors"], max(expected, default=0))
+            self.assertTrue(all(f["access_points"] > 0 for f in data["floors"]))
+
+        response = self.client.get(reverse("floors-api", args=["ZZZZ"]), {"date": "2021-03-01"})
+        self.assertEqual(response.status_code, 400)
+
+
+class TrajectoryIndexTests(DataTestCase):
+
+    # trajectory rows of 60 devices, a device's rows spread over the file, with
+    # stays in unmapped buildings ("UNKN", "ZZZZ") and stays under a minute
+    def write_trajectories(self):
+        rnd = random.Random(0)
+        buildings = ["KNWL", "LGRC", "LSL", "UNKN", "ZZZZ"] + list(building_dict)[:5]
+        rows = []
+        for d in range(60):
+            for _ in range(rnd.randint(1, 3)):
+                stays = []
+                t = rnd.uniform(0, 1200)
+                for _ in range(rnd.randint(1, 5)):
+                    end = t + rnd.choice([0.0, 0.5, rnd.uniform(1, 90)])
+                    stays.append((rnd.choice(buildings), round(t, 1), round(end, 1)))
+                    t = end + rnd.uniform(0, 30)
+                rows.append([
+                    f"#traj{d:04d}#",
+                    str([s[0] for s in stays]),
+                    str([s[1] for s in stays]),
+                    str([s[2] for s in stays]),
+                    str([s[2] - s[1] for s in stays]),
+                ])
+        rnd.shuffle(rows)
+        # a device that was only ever in unmapped buildings
+        rows.append(["#trajunmapped#", "['ZZZZ', 'UNKN']", "[10.0, 50.0]", "[40.0, 90.0]", "[30.0, 40.0]"])
+        path = os.path.join(self.data, "Trajectory", "20210301_finaltraj.csv")
+        write_csv(path, TRAJECTORY_HEADER, rows)
+        return path
+
+    def test_index_matches_csv(self):
+        path = self.write_trajectories()
+        devices = [f"#traj{d:04d}#" for d in range(60)] + ["#trajunmapped#", "#nobody#"]
+        expected = {device: device_traj_csv(path, device) for device in devices}
+        self.assertEqual(expected["#trajunmapped#"], [[]])
+        self.assertEqual(expected["#nobody#"], [])
+
+        build_trajectory_index(path)
+        self.assertIsNotNone(load_trajectory_index(path))
+        for device in devices:
+            self.assertEqual(device_traj(path, device), expected[device], device)
+
+        # a rebuild swaps the folder in and leaves nothing else behind
+        build_trajectory_index(path)
+        self.assertEqual(device_traj(path, devices[0]), expected[devices[0]])
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))),
+                         sorted([os.path.basename(path), os.path.basename(trajectory_index_path(path))]))
+
+
+    @override_settings(TRAJECTORY_MAX_DAYS=3)
+    def test_range_longer_than_max_days_rejected(self):
+        self.write_trajectories()
+        url = reverse("trajectory-range-api", args=["traj0000", "2021-02-28", "2021-03-02"])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual([line["date"] for line in lines], ["2021-03-01"])
+
+        response = self.client.get(reverse("trajectory-range-api", args=["traj0000", "2021-02-28", "2021-03-03"]))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "Date range must not be longer than 3 days"})
+
+class IngestSyslogTests(DataTestCase):
+
+    # association events of 30 devices moving between access points and buildings
+    def write_syslog(self):
+        rnd = random.Random(0)
+        aps = ["LGRC-A307-1", "LGRC-A301-1", "KNWL-E220-1", "LSL-N101-1"]
+        when = datetime(2021, 3, 1, 8, 0)
+        lines = []
+        for _ in range(600):
+            when += timedelta(seconds=rnd.randint(1, 40))
+            device = f"3c:22:fb:00:00:{rnd.randrange(30):02x}"
+            event = rnd.choice(["associated", "associated", "disassociated"])
+            direction = "from" if event == "disassociated" else "to"
+            lines.append(f"{when:%Y-%m-%d %H:%M:%S} wlc1 stm[2211]: Station {device} {event} {direction} AP {rnd.choice(aps)}\n")
+        path = os.path.join(os.path.dirname(self.data), "syslog")
+        with open(path, "w") as file:
+            file.writelines(lines)
+        return path
+
+    def ingest(self, syslog):
+        call_command("ingest_syslog", syslog, "--chunk", "100", "--close", stdout=StringIO())
+        store = load_sessions(sessions_csv("2021-03-01"))
+        return sorted(zip(store.devices[store.device].tolist(), store.buildings[store.building].tolist(),
+                          store.start.tolist(), store.end.tolist()))
+
+    def test_resumed_ingest_does_not_duplicate(self):
+        syslog = self.write_syslog()
+        expected = self.ingest(syslog)
+        self.assertGreater(len(expected), 30)
+
+        # start over, and stop after the third chunk is written but before its checkpoint
+        os.remove(os.path.join(self.data, "syslog_checkpoint.json"))
+        os.remove(sessions_csv("2021-03-01"))
+        saves = []
+
+        def stopped(*args):
+            saves.append(args)
+            if len(saves) == 3:
+                raise RuntimeError("stopped")
+            save_checkpoint(*args)
+
+        with mock.patch("crowdvisualrestapi.management.commands.ingest_syslog.save_checkpoint", stopped):
+            with self.assertRaisesMessage(RuntimeError, "stopped"):
+                self.ingest(syslog)
+
+        self.assertEqual(self.ingest(syslog), expected)
+
+    def test_store_and_rollup_refreshed_once_per_run(self):
+        syslog = self.write_syslog()
+        with mock.patch.object(ingest, "update_store", wraps=ingest.update_store) as update_store, \
+                mock.patch.object(ingest, "build_rollup", wraps=ingest.build_rollup) as build_rollup:
+            sessions = self.ingest(syslog)
+            # six chunks written to the CSV, the day's store and rollup redone once
+            self.assertEqual(update_store.call_count, 1)
+            self.assertEqual(build_rollup.call_count, 1)
+            self.assertTrue(is_rolled_up(sessions_csv("2021-03-01")))
+
+            # nothing new: no file is touched
+            self.assertEqual(self.ingest(syslog), sessions)
+            self.assertEqual(update_store.call_count, 1)
+            self.assertEqual(build_rollup.call_count, 1)
+
+        writer = SessionWriter()
+        self.assertEqual(writer.write([]), 0)
+        self.assertEqual(writer.refresh(), [])
+
+
+@override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "default"},
+    "shared": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "shared-predictions"},
+})
+class PredictionCacheTests(DataTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.files = []
+        for name in ("model.pth", "scaler.pkl"):
+            path = os.path.join(self.data, name)
+            with open(path, "wb") as file:
+                file.write(b"v1")
+            self.files.append(path)
+
+        self.addCleanup(caches["shared"].clear)
+
+    def cache(self, **kwargs):
+        return PredictionCache(self.files, **kwargs)
+
+    def test_least_recently_used_are_evicted(self):
+        cache = self.cache(size=3)
+        keys = [("LGRC", "20210301", minute) for minute in range(4)]
+        cache.set_many({key: [float(i)] for i, key in enumerate(keys[:3])})
+        # the first key is used, so the second is the least recently used one
+        self.assertEqual(cache.get_many(keys[:1]), ({keys[0]: [0.0]}, []))
+        cache.set_many({keys[3]: [3.0]})
+
+        found, missing = cache.get_many(keys)
+        self.assertEqual(found, {keys[0]: [0.0], keys[2]: [2.0], keys[3]: [3.0]})
+        self.assertEqual(missing, [keys[1]])
+        self.assertEqual(cache.stats()["size"], 3)
+
+    def test_changed_files_drop_the_entries(self):
+        cache = self.cache()
+        key = ("LGRC", "20210301", 600)
+        cache.set_many({key: [1.0]})
+        self.assertEqual(cache.get_many([key])[0], {key: [1.0]})
+
+        # same size, newer file
+        stat = os.stat(self.files[0])
+        os.utime(self.files[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(cache.get_many([key]), ({}, [key]))
+
+        cache.set_many({key: [2.0]})
+        with open(self.files[1], "ab") as file:
+            file.write(b"2")
+        self.assertEqual(cache.get_many([key]), ({}, [key]))
+
+        # the engine is part of the fingerprint too
+        self.assertNotEqual(self.cache(tag="eager").stats()["fingerprint"],
+                            self.cache(tag="quantized").stats()["fingerprint"])
+
+    def test_workers_share_the_django_cache(self):
+        first, second = self.cache(backend="shared"), self.cache(backend="shared")
+        keys = [("LGRC", "20210301", 600), ("KNWL", "20210301", 600)]
+        first.set_many({keys[0]: [1.5]})
+
+        self.assertEqual(second.get_many(keys), ({keys[0]: [1.5]}, [keys[1]]))
+        # the shared hit is kept locally
+        self.assertEqual(second.stats()["size"], 1)
+        caches["shared"].clear()
+        self.assertEqual(second.get_many(keys[:1])[0], {keys[0]: [1.5]})
+
+        # entries of other model files are never read
+        first.set_many({keys[1]: [2.5]})
+        with open(self.files[0], "ab") as file:
+            file.write(b"2")
+        self.assertEqual(self.cache(backend="shared").get_many(keys), ({}, keys))
+        self.assertEqual(second.get_many(keys), ({}, keys))
+
+
+class RollupTests(DataTestCase):
+    # two Mondays and the Tuesday between them; 2021-03-03 has no rollup
+    DAYS = {"2021-03-01": 0, "2021-03-02": 1, "2021-03-08": 2}
+    BUILDINGS = ["LGRC", "KNWL", "LSL", list(building_dict)[0]]
+
+    def setUp(self):
+        super().setUp()
+        self.stats = {}
+        for day, seed in self.DAYS.items():
+            path = write_sessions(self.data, day, seed=seed, extra=EDGE_SESSIONS if seed == 1 else ())
+            convert_sessions(path)
+            build_rollup(path)
+            self.stats[day.replace("-", "")] = self.direct_stats(path)
+        convert_sessions(write_sessions(self.data, "2021-03-03", seed=3))
+
+    def direct_stats(self, path):
+        '''
+        Stats of a day, session by session: per (hour, building) the devices,
+        sessions and minutes inside the hour of those overlapping it, per
+        building the devices, sessions and minutes of the day
+        '''
+        store = load_sessions(path)
+        hours = {}
+        day = {}
+        for i in range(len(store)):
+            device = store.devices[store.device[i]]
+            building = store.buildings[store.building[i]]
+            start, end = float(store.start[i]), float(store.end[i])
+            if building not in building_dict:
+                continue
+
+            devices, sessions, minutes = day.setdefault(building, (set(), [], []))
+            devices.add(device)
+            sessions.append(i)
+            minutes.append(end - start)
+
+            for h in range(24):
+                lo, hi = h * 60.0, h * 60.0 + 59
+                if not (start <= hi and end > lo):
+                    continue
+                if start < lo and end > hi:
+                    inside = 60.0
+                elif start < lo:
+                    inside = end - lo
+                elif end > hi:
+                    inside = hi - start
+                else:
+                    inside = end - start
+                devices, sessions, minutes = hours.setdefault((h, building), (set(), [], []))
+                devices.add(device)
+                sessions.append(i)
+                minutes.append(inside)
+        return hours, day
+
+    def test_hourly_profile_matches_sessions(self):
+        for weekdays in (None, [0]):
+            days = [day for day in sorted(self.stats) if weekdays is None or day != "20210302"]
+            hours = [0, 8, 10, 11, 12, 13, 23]
+            profile = hourly_profile("20210301", "20210308", weekdays, hours, self.BUILDINGS)
+            self.assertEqual(profile["dates"], [f"{d[0:4]}-{d[4:6]}-{d[6:8]}" for d in days])
+            self.assertEqual(profile["missing_dates"], ["2021-03-03"] if weekdays is None else [])
+
+            for i, h in enumerate(hours):
+                for j, building in enumerate(self.BUILDINGS):
+                    cells = [self.stats[day][0].get((h, building), (set(), [], [])) for day in days]
+                    devices = [len(cell[0]) for cell in cells]
+                    sessions = sum(len(cell[1]) for cell in cells)
+                    minutes = sum(sum(cell[2]) for cell in cells)
+                    where = f"{weekdays} hour {h} {building}"
+                    self.assertAlmostEqual(profile["average_devices"][i][j], sum(devices) / len(days), 2, where)
+                    self.assertEqual(profile["peak_devices"][i][j], max(devices), where)
+                    self.assertEqual(profile["sessions"][i][j], sessions, where)
+                    if sessions:
+                        self.assertAlmostEqual(profile["average_dwell"][i][j], minutes / sessions, 2, where)
+                    else:
+                        self.assertIsNone(profile["average_dwell"][i][j], where)
+        # the edge sessions of 2021-03-02 are there
+        self.assertGreater(profile["sessions"][hours.index(12)][self.BUILDINGS.index("KNWL")], 0)
+
+    def test_daily_summary_matches_sessions(self):
+        groups = {
+            "day": {day: [day] for day in self.stats},
+            "week": {"2021-W09": ["20210301", "20210302"], "2021-W10": ["20210308"]},
+            "month": {"2021-03": sorted(self.stats)},
+        }
+        for group, periods in groups.items():
+            summary = daily_summary("20210301", "20210331", None, group, self.BUILDINGS)
+            if group == "day":
+                self.assertEqual(summary["periods"], ["2021-03-01", "2021-03-02", "2021-03-08"])
+            else:
+                self.assertEqual(summary["periods"], sorted(periods))
+            self.assertEqual(summary["missing_dates"], ["2021-03-03"])
+
+            for i, days in enumerate(periods[period] for period in sorted(periods)):
+                self.assertEqual(summary["days"][i], len(days))
+                for j, building in enumerate(self.BUILDINGS):
+                    cells = [self.stats[day][1].get(building, (set(), [], [])) for day in days]
+                    sessions = sum(len(cell[1]) for cell in cells)
+                    minutes = sum(sum(cell[2]) for cell in cells)
+                    peak = max(len(self.stats[day][0].get((h, building), (set(),))[0])
+                               for day in days for h in range(24))
+                    where = f"{group} {days} {building}"
+                    self.assertAlmostEqual(summary["average_devices"][i][j],
+                                           sum(len(cell[0]) for cell in cells) / len(days), 2, where)
+                    self.assertEqual(summary["peak_hour_devices"][i][j], peak, where)
+                    self.assertEqual(summary["sessions"][i][j], sessions, where)
+                    if sessions:
+                        self.assertAlmostEqual(summary["average_dwell"][i][j], minutes / sessions, 2, where)
+                    else:
+                        self.assertIsNone(summary["average_dwell"][i][j], where)
+
+
+class OneProfiler(cProfile.Profile):
+    '''
+    cProfile as it is from Python 3.12, where only one can be on in the
+    process at a time
+    '''
+    on = False
+
+    def enable(self, *args, **kwargs):
+        if OneProfiler.on:
+            raise ValueError("Another profiling tool is already active")
+        OneProfiler.on = True
+        super().enable(*args, **kwargs)
+
+    def disable(self):
+        super().disable()
+        OneProfiler.on = False
+
+
+class MetricsTests(DataTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.profiles = os.path.join(os.path.dirname(self.data), "profiles")
+        overridden = override_settings(METRICS={"SERVER_TIMING": True, "PROFILE_TOKEN": "secret",
+                                                "PROFILE_DIR": self.profiles})
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        patched = mock.patch("crowdvisualrestapi.metrics.cProfile.Profile", OneProfiler)
+        patched.start()
+        self.addCleanup(patched.stop)
+        OneProfiler.on = False
+        write_sessions(self.data, "2021-03-01")
+
+    def latency_count(self, endpoint):
+        prefix = f'crowdview_request_duration_seconds_count{{endpoint="{endpoint}"'
+        return sum(int(line.split()[-1]) for line in metrics.render().splitlines() if line.startswith(prefix))
+
+    def profiled_functions(self, url):
+        response = self.client.get(url, HTTP_X_PROFILE="secret")
+        self.assertEqual(response.status_code, 200, url)
+        self.assertFalse(OneProfiler.on)
+        stats = pstats.Stats(os.path.join(self.profiles, response["X-Profile-File"]))
+        return {function for _, _, function in stats.stats}
+
+    def test_profile_async_and_sync_views(self):
+        # the async view's work, profiled on the pool thread it ran on
+        self.assertIn("campus_occupancy", self.profiled_functions(reverse("campus-api", args=["2021-03-01T10:00"])))
+        # the sync view, profiled on the request thread
+        self.assertIn("get", self.profiled_functions(reverse("datasets-api")))
+
+    def test_profiler_already_on(self):
+        OneProfiler.on = True
+        response = self.client.get(reverse("campus-api", args=["2021-03-01T10:00"]), HTTP_X_PROFILE="secret")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("X-Profile-File", response)
+        OneProfiler.on = False
+        # and ours are not left waiting for one another
+        response = self.client.get(reverse("datasets-api"), HTTP_X_PROFILE="secret")
+        self.assertIn("X-Profile-File", response)
+
+    def test_streamed_latency_recorded_on_close(self):
+        before = self.latency_count("trajectory-range-api")
+        response = self.client.get(reverse("trajectory-range-api", args=["x", "2021-03-01", "2021-03-03"]))
+        self.assertTrue(response.streaming)
+        self.assertEqual(self.latency_count("trajectory-range-api"), before)
+        b"".join(response.streaming_content)
+        self.assertEqual(self.latency_count("trajectory-range-api"), before + 1)
+        response.close()
+        self.assertEqual(self.latency_count("trajectory-range-api"), before + 1)
+
+        before = self.latency_count("datasets-api")
+        self.client.get(reverse("datasets-api"))
+        self.assertEqual(self.latency_count("datasets-api"), before + 1)
+
+
+class ConditionalGetTests(DataTestCase):
+
+    def setUp(self):
+        super().setUp()
+        write_sessions(self.data, "2021-03-01")
+        self.url = reverse("campus-api", args=["2021-03-01T10:00"])
+
+    def test_matching_etag_gets_empty_304(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.assertTrue(first.content)
+        with mock.patch("crowdvisualrestapi.views.campus_occupancy") as occupancy:
+            again = self.client.get(self.url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b"")
+        self.assertEqual(again["ETag"], first["ETag"])
+        occupancy.assert_not_called()
+
+    def test_other_etag_gets_200(self):
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content)
+
+    # the stat and the catalog lookup of async views run in a thread
+    def test_validators_computed_off_the_event_loop(self):
+        loops = []
+
+        def validators(*args):
+            try:
+                loops.append(asyncio.get_running_loop())
+            except RuntimeError:
+                loops.append(None)
+            return source_validators(*args)
+
+        with mock.patch("crowdvisualrestapi.http_cache.source_validators", validators):
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertEqual(loops, [None])
+
+
+class LiveOccupancyTests(DataTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = write_sessions(self.data, "2021-03-01")
+        # no ticks, the tests refresh the keys themselves
+        self.hub = LiveOccupancy(interval=3600)
+
+    def rewrite(self, seed):
+        write_sessions(self.data, "2021-03-01", seed=seed)
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def message(self, text):
+        event, data = text.strip().split("\n")
+        return event.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+    def test_snapshot_then_deltas(self):
+        key = ("20210301", 600, True)
+        stream = live_stream(key, self.hub)
+        self.addCleanup(stream.close)
+
+        event, data = self.message(next(stream))
+        self.assertEqual(event, "snapshot")
+        self.assertEqual(data["time"], "10:00")
+        before = campus_occupancy(self.path, 600, True)
+        self.assertEqual(data["data"], before)
+
+        self.rewrite(seed=1)
+        self.assertTrue(self.hub.refresh(key))
+        self.assertFalse(self.hub.refresh(key))   # same files and minute
+        event, data = self.message(next(stream))
+        self.assertEqual(event, "delta")
+        after = campus_occupancy(self.path, 600, True)
+        self.assertEqual(data["changed"], [row for row in after if row not in before])
+        gone = {row["building"] for row in before} - {row["building"] for row in after}
+        self.assertEqual(sorted(data["removed"]), sorted(gone))
+        self.assertTrue(data["changed"] or data["removed"])
+
+    # a new snapshot of a key wakes the streams of that key, not the others
+    def test_refresh_wakes_only_its_key(self):
+        ten, eleven = ("20210301", 600, True), ("20210301", 660, True)
+        for key in (ten, eleven):
+            self.hub.subscribe(key)
+            self.addCleanup(self.hub.unsubscribe, key)
+        versions = {key: self.hub.snapshot(key)[0] for key in (ten, eleven)}
+
+        async def scenario():
+            woken = asyncio.ensure_future(self.hub.wait_async(ten, versions[ten], 5))
+            other = asyncio.ensure_future(self.hub.wait_async(eleven, versions[eleven], 5))
+            await asyncio.sleep(0)
+            self.rewrite(seed=1)
+            self.assertTrue(await asyncio.to_thread(self.hub.refresh, ten))
+            await asyncio.wait_for(woken, 1)
+            await asyncio.sleep(0.05)
+            self.assertFalse(other.done())
+            other.cancel()
+
+        asyncio.run(scenario())
+        self.assertEqual(self.hub.snapshot(eleven)[0], versions[eleven])
+
+
+class CompactFormatTests(DataTestCase):
+    '''
+    The compact forms rebuilt the way occupancy.js does it give back the
+    records of the default JSON
+    '''
+
+    def setUp(self):
+        super().setUp()
+        write_sessions(self.data, "2021-03-01")
+        self.table = self.client.get(reverse("building-table-api")).json()["data"]
+
+    def rebuild(self, data):
+        table = self.table
+        return [{
+            "date": data["dates"][data["date"][i]],
+            "building": table["building"][b],
+            "building_lat": table["building_lat"][b],
+            "building_long": table["building_long"][b],
+            "connection_count": data["connection_count"][i],
+        } for i, b in enumerate(data["building"])]
+
+    def records(self, rows):
+        return [{key: row[key] for key in ("date", "building", "building_lat", "building_long", "connection_count")}
+                for row in rows]
+
+    def campus(self, granularity, format=None):
+        query = {"granularity": granularity}
+        if format:
+            query["format"] = format
+        response = self.client.get(reverse("campus-api", args=["2021-03-01T10:30"]), query)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_compact_json_rebuilds_default_records(self):
+        for granularity in ("hour", "minute"):
+            rows = self.campus(granularity).json()["data"]
+            self.assertTrue(rows)
+            compact = self.campus(granularity, "compact")
+            self.assertEqual(compact["Content-Type"], "application/vnd.crowdview.compact+json")
+            self.assertEqual(self.rebuild(compact.json()["data"]), self.records(rows), granularity)
+
+    @skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack_rebuilds_default_records(self):
+        for granularity in ("hour", "minute"):
+            rows = self.campus(granularity).json()["data"]
+            packed = self.campus(granularity, "msgpack")
+            self.assertEqual(packed["Content-Type"], "application/msgpack")
+            data = msgpack.unpackb(packed.content, raw=False)["data"]
+            self.assertEqual(self.rebuild(data), self.records(rows), granularity)
+
+
+# module level so a worker process can unpickle it
+def timed_double(value):
+    with timed("pool-test"):
+        return value * 2
+
+
+class PoolTests(SimpleTestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+        executor = ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        patched = mock.patch.dict(pools._pools, {"occupancy": executor})
+        patched.start()
+        self.addCleanup(patched.stop)
+
+    def square(self, value):
+        self.calls.append(value)
+        self.release.wait(5)
+        return value * value
+
+    def test_concurrent_calls_share_one_run(self):
+        coalesced = pools.coalescer.coalesced
+
+        async def scenario():
+            waiters = [asyncio.ensure_future(run_in_pool("occupancy", self.square, 7)) for _ in range(3)]
+            await asyncio.sleep(0)
+            self.release.set()
+            return await asyncio.gather(*waiters)
+
+        self.assertEqual(asyncio.run(scenario()), [49, 49, 49])
+        self.assertEqual(self.calls, [7])
+        self.assertEqual(pools.coalescer.coalesced, coalesced + 2)
+
+        # nothing is kept once the run is over
+        self.assertEqual(asyncio.run(run_in_pool("occupancy", self.square, 7)), 49)
+        self.assertEqual(self.calls, [7, 7])
+
+    def test_cancelled_waiter_leaves_shared_run(self):
+        async def scenario():
+            first = asyncio.ensure_future(run_in_pool("occupancy", self.square, 8))
+            second = asyncio.ensure_future(run_in_pool("occupancy", self.square, 8))
+            await asyncio.sleep(0)
+            first.cancel()
+            await asyncio.sleep(0)
+            self.release.set()
+            return first, await second
+
+        first, result = asyncio.run(scenario())
+        self.assertTrue(first.cancelled())
+        self.assertEqual(result, 64)
+        self.assertEqual(self.calls, [8])
+
+    def test_process_sections_recorded_in_parent(self):
+        executor = ProcessPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        current = RequestMetrics()
+        count = 'crowdview_section_duration_seconds_count{section="pool-test"}'
+
+        def recorded():
+            return sum(int(line.split()[-1]) for line in metrics.render().splitlines() if line.startswith(count))
+
+        before = recorded()
+        with mock.patch.dict(pools._pools, {"occupancy": executor}), \
+                mock.patch("crowdvisualrestapi.pools.current_request", return_value=current):
+            self.assertEqual(asyncio.run(run_in_pool("occupancy", timed_double, 21)), 42)
+        self.assertEqual(recorded(), before + 1)
+        self.assertIn("pool-test", current.sections)
+
+
+class RaggedTests(SimpleTestCase):
+
+    def test_number_lists(self):
+        values, offsets = number_lists(["[488, 557]", "[]", "[529.0, 601.5]", "[7]"])
+        np.testing.assert_array_equal(values, [488, 557, 529, 601.5, 7])
+        np.testing.assert_array_equal(offsets, [0, 2, 2, 4, 5])
+        values, offsets = number_lists(["[]", "[]"])
+        self.assertEqual(len(values), 0)
+        np.testing.assert_array_equal(offsets, [0, 0, 0])
+
+    def test_number_lists_reject_bad_items(self):
+        with warnings.catch_warnings():
+            # NumPy warns before giving up on an item that is not a number
+            warnings.simplefilter("ignore", DeprecationWarning)
+            for column in (["[1, x]"], ["[1, 2]", "['a']"], ["[1, , 2]"], ["[, 1]"], ["[1,]", "[2]"], ["[ ]"]):
+                with self.assertRaises(ValueError, msg=column):
+                    number_lists(column)
+        # a field that is not one [...] list
+        with self.assertRaises(ValueError):
+            number_lists(["1, 2"])
+        with self.assertRaises(ValueError):
+            number_lists(["[1, 2][3]"])
+
+    def test_string_lists(self):
+        codes, table, offsets = string_lists(["['FILD', 'WHLR']", "[]", "['WHLR', 'LGRC-A307-1']", "['FILD']"])
+        self.assertEqual(table[codes].tolist(), ["FILD", "WHLR", "WHLR", "LGRC-A307-1", "FILD"])
+        self.assertEqual(table.tolist(), ["FILD", "WHLR", "LGRC-A307-1"])
+        np.testing.assert_array_equal(offsets, [0, 2, 2, 4, 5])
+        # quotes and spaces around a value do not make it another one
+        codes, table, _ = string_lists(["[ 'A B' ,'A B']", "['A B']"])
+        self.assertEqual(table.tolist(), ["A B"])
+        self.assertEqual(codes.tolist(), [0, 0, 0])
+
+    def test_firsts_and_lasts(self):
+        values, offsets = number_lists(["[1, 2]", "[3]", "[4, 5, 6]"])
+        np.testing.assert_array_equal(firsts(values, offsets), [1, 3, 4])
+        np.testing.assert_array_equal(lasts(values, offsets), [2, 3, 6])
+        for column in (["[1, 2]", "[]", "[3]"], ["[]", "[3]"], ["[3]", "[]"]):
+            values, offsets = number_lists(column)
+            with self.assertRaises(ValueError):
+                firsts(values, offsets)
+            with self.assertRaises(ValueError):
+                lasts(values, offsets)
+
+    def test_read_columns(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder, ignore_errors=True)
+        path = os.path.join(folder, "rows.csv")
+        write_csv(path, ["a", "b", "c"], [["1", "['X', 'Y']", "K"], ["", "[]", "L"], ["3", "['Z']", "K"]])
+        self.assertEqual(read_columns(path, [2, 0]), [["K", "L", "K"], ["1", "", "3"]])
+        self.assertEqual(read_columns(path, [1, 0], where=(2, ["K"])), [["['X', 'Y']", "['Z']"], ["1", "3"]])
+        self.assertEqual(read_columns(path, [1], where=(2, ["M"])), [[]])
+
+
+# registry serving an untrained model and the reference scaler, both of the feature width
+def fitting_registry():
+    registry = ModelRegistry(settings.PREDICTION_MODEL_PATH, settings.PREDICTION_SCALER_PATH)
+    registry.use_model(EnhancedRNN(feature_count, hidden_size, num_layers, output_size))
+    registry.use_scaler(reference_scaler())
+    return registry
+
+
+class ModelRegistryTests(SimpleTestCase):
+
+    def test_warm_up_runs_a_prediction(self):
+        registry = fitting_registry()
+        registry.warm_up()
+        self.assertIn("warm_up_seconds", registry.stats())
+        buildings = list(building_dict)[:3]
+        self.assertEqual(registry.predict(prediction_features([600] * 3, 4, buildings)).shape, (3, output_size))
+
+    def test_widths_that_do_not_match_raise(self):
+        registry = fitting_registry()
+        registry.use_scaler(StandardScaler().fit(np.zeros((3, feature_count - 1))))
+        with self.assertLogs("crowdvisualrestapi.registry", "ERROR"):
+            with self.assertRaisesMessage(ValueError, f"expects {feature_count - 1}"):
+                registry.warm_up()
+
+        registry.use_scaler(reference_scaler())
+        registry.use_model(EnhancedRNN(feature_count + 1, hidden_size, num_layers, output_size))
+        with self.assertLogs("crowdvisualrestapi.registry", "ERROR"):
+            with self.assertRaisesMessage(ValueError, f"takes {feature_count + 1}"):
+                registry.predict(prediction_features([600], 4, list(building_dict)[:1]))
+
+    def test_shipped_files_are_checked(self):
+        if not (os.path.exists(settings.PREDICTION_MODEL_PATH) and os.path.exists(settings.PREDICTION_SCALER_PATH)):
+            self.skipTest("no model or scaler file")
+        registry = ModelRegistry(settings.PREDICTION_MODEL_PATH, settings.PREDICTION_SCALER_PATH)
+        widths = registry.widths()
+        if len(set(widths.values())) == 1:
+            registry.warm_up()
+            return
+        with self.assertLogs("crowdvisualrestapi.registry", "ERROR"), self.assertRaises(ValueError):
+            registry.warm_up()
+
+    def test_batches_match_one_row_at_a_time(self):
+        registry = fitting_registry()
+        buildings = list(building_dict)
+        # 3 timestamps of every building, more rows than a batch and not a multiple of it
+        timestamps = np.repeat([480, 725, 1439], len(buildings))
+        features = prediction_features(timestamps, 9, buildings * 3)
+        one_by_one = np.concatenate([registry.predict(row[None, :]) for row in features])
+
+        for batch_size in (len(features) + 1, len(features), 100, 7, 1):
+            with mock.patch.object(registry_module, "prediction_batch_size", batch_size):
+                np.testing.assert_allclose(registry.predict(features), one_by_one, rtol=0, atol=1e-6,
+                                           err_msg=f"batches of {batch_size}")
+        self.assertEqual(registry.predict(features[:0]).shape, (0, output_size))
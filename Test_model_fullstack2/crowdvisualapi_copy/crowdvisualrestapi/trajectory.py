@@ -0,0 +1,218 @@
+import os
+import json
+import threading
+import numpy as np
+import pandas as pd
+from .consts import building_dict
+from .metrics import cache_lookup
+from .cube import swap_directory
+from .ragged import read_columns, number_lists, string_lists
+
+
+# bump whenever the arrays below change meaning or layout,
+# indexes written with another version are ignored and rebuilt
+TRAJECTORY_VERSION = 1
+TRAJECTORY_EXT = ".trajidx"
+
+_cache = {}
+_cache_lock = threading.Lock()
+_building = set()
+
+
+def trajectory_index_path(csv_path):
+    return os.path.splitext(csv_path)[0] + TRAJECTORY_EXT
+
+
+class TrajectoryIndex:
+    '''
+    Per-device index of one day's *_finaltraj.csv
+
+    devices                 every device id, sorted
+    row_offsets             csv rows of device i are rows row_offsets[i]:row_offsets[i+1]
+                            (rows are grouped by device, file order within a device)
+    stay_offsets            stays of row r are stay_offsets[r]:stay_offsets[r+1]
+    stay_building           code into buildings
+    stay_start, stay_end    minutes of every stay
+
+    Only the stays device_traj reports are kept: a minute or longer, in a
+    known building. Arrays are memory-mapped on first access, and a device
+    is found with a binary search over the sorted ids, so no worker has to
+    hold a table of every device.
+    '''
+
+    ARRAYS = (
+        "devices", "row_offsets", "stay_offsets",
+        "stay_building", "stay_start", "stay_end", "buildings",
+    )
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self._arrays = {}
+
+    def __getattr__(self, name):
+        if name not in TrajectoryIndex.ARRAYS:
+            raise AttributeError(name)
+        array = self._arrays.get(name)
+        if array is None:
+            array = np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+            self._arrays[name] = array
+        return array
+
+    def __len__(self):
+        return len(self.devices)
+
+    def trajectories(self, device):
+        '''
+        Stays of a device as one list of (building, start, end) per csv row
+
+        returns an empty list when the device is not in the file
+        '''
+        i = int(np.searchsorted(self.devices, device))
+        if i == len(self.devices) or self.devices[i] != device:
+            return []
+
+        response = []
+        for row in range(self.row_offsets[i], self.row_offsets[i + 1]):
+            stays = slice(self.stay_offsets[row], self.stay_offsets[row + 1])
+            response.append(list(zip(
+                self.buildings[self.stay_building[stays]].tolist(),
+                self.stay_start[stays].tolist(),
+                self.stay_end[stays].tolist()
+            )))
+        return response
+
+
+# parse a day's trajectory CSV into the index arrays
+def read_trajectory_csv(path):
+    row_device, traj, starts, ends = read_columns(path, [0, 1, 2, 3])
+
+    building, names, offsets = string_lists(traj)
+    start, start_offsets = number_lists(starts)
+    end, end_offsets = number_lists(ends)
+    if not (np.array_equal(offsets, start_offsets) and np.array_equal(offsets, end_offsets)):
+        raise ValueError(f"{path}: every stay needs a building, a start and an end")
+
+    # the stays device_traj reports: a minute or longer, in a known building
+    known = np.array([name != "UNKN" and name in building_dict for name in names.tolist()], dtype=bool)
+    keep = ~(end - start < 1) & known[building]
+
+    devices, inverse = np.unique(np.array(row_device, dtype=str), return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    row_offsets = np.concatenate(([0], np.cumsum(np.bincount(inverse, minlength=len(devices)))))
+
+    # kept stays with rows grouped by device, file order within a row
+    kept = np.flatnonzero(keep)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    stay_row = np.repeat(np.arange(len(order)), np.diff(offsets))
+    kept = kept[np.argsort(rank[stay_row[kept]], kind="stable")]
+    kept_per_row = np.bincount(stay_row[keep], minlength=len(order))
+
+    # buildings coded in order of first appearance
+    stay_building, used = pd.factorize(building[kept])
+
+    return {
+        "devices": devices,
+        "row_offsets": row_offsets.astype(np.int64),
+        "stay_offsets": np.concatenate(([0], np.cumsum(kept_per_row[order]))).astype(np.int64),
+        "stay_building": stay_building.astype(np.int32),
+        "stay_start": start[kept],
+        "stay_end": end[kept],
+        "buildings": np.array(names[used].tolist(), dtype=str),
+    }
+
+
+# checksum (of the CSV) is kept in meta.json when given, returns the rows indexed
+def build_trajectory_index(csv_path, checksum=None):
+    arrays = read_trajectory_csv(csv_path)
+
+    out = trajectory_index_path(csv_path)
+    tmp = f"{out}.tmp{os.getpid()}.{threading.get_ident()}"
+    os.makedirs(tmp)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), array)
+
+    meta = {
+        "version": TRAJECTORY_VERSION,
+        "devices": len(arrays["devices"]),
+        "rows": len(arrays["stay_offsets"]) - 1,
+        "stays": len(arrays["stay_start"]),
+    }
+    if checksum is not None:
+        meta["checksum"] = checksum
+    with open(os.path.join(tmp, "meta.json"), "w") as file:
+        json.dump(meta, file)
+
+    swap_directory(tmp, out)
+    return meta["rows"]
+
+
+# True when the CSV has an index of the current version at least as new as itself
+def is_indexed(csv_path):
+    meta_path = os.path.join(trajectory_index_path(csv_path), "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    if os.path.getmtime(meta_path) < os.path.getmtime(csv_path):
+        return False
+    with open(meta_path) as file:
+        return json.load(file).get("version") == TRAJECTORY_VERSION
+
+
+# checksum of the CSV an index of the current version was built from, None when not known
+def index_checksum(csv_path):
+    meta_path = os.path.join(trajectory_index_path(csv_path), "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as file:
+        meta = json.load(file)
+    return meta.get("checksum") if meta.get("version") == TRAJECTORY_VERSION else None
+
+
+def load_trajectory_index(csv_path):
+    '''
+    Get the device index of a trajectory CSV
+
+    returns None when there is no up to date index, callers then scan the CSV
+    '''
+    if not is_indexed(csv_path):
+        cache_lookup("trajectory_index", misses=1)
+        return None
+    cache_lookup("trajectory_index", hits=1)
+
+    out = trajectory_index_path(csv_path)
+    meta_path = os.path.join(out, "meta.json")
+    mtime = os.path.getmtime(meta_path)
+    with _cache_lock:
+        cached = _cache.get(out)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+    with open(meta_path) as file:
+        index = TrajectoryIndex(out, json.load(file))
+
+    with _cache_lock:
+        _cache[out] = (mtime, index)
+    return index
+
+
+def index_in_background(csv_path):
+    '''
+    Build a missing index on a daemon thread
+
+    returns False when a build for the file is already running
+    '''
+    with _cache_lock:
+        if csv_path in _building:
+            return False
+        _building.add(csv_path)
+
+    def run():
+        try:
+            build_trajectory_index(csv_path)
+        finally:
+            with _cache_lock:
+                _building.discard(csv_path)
+
+    threading.Thread(target=run, daemon=True).start()
+    return True
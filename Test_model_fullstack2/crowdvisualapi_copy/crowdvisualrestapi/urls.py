@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import CampusAPI, BuildingAPI, AccessPointAPI, RouteAPI, PredictionAPI, CampusPredictionAPI
+from .views import DatasetsAPI, BuildingTableAPI, CampusAPI, LiveCampusAPI, CampusTimelineAPI, CampusHourlyAggregateAPI, CampusDailyAggregateAPI, BuildingAPI, BuildingsAPI, FloorsAPI, AccessPointAPI, RouteAPI, TrajectoryRangeAPI, PredictionAPI, CampusPredictionAPI, ForecastAPI
 from django.http import JsonResponse
 
 # Function-Based View for Testing
@@ -9,11 +9,21 @@ def simple_predict_view(request, datetime_str):
     return JsonResponse({"error": "Method not allowed"}, status=405)
 
 urlpatterns = [
+    path("datasets/", DatasetsAPI.as_view(), name="datasets-api"),
+    path("campus/buildings/", BuildingTableAPI.as_view(), name="building-table-api"),
     path("campus/datetime/<str:datetime_str>/", CampusAPI.as_view(), name="campus-api"),
+    path("campus/live/", LiveCampusAPI.as_view(), name="campus-live-api"),
+    path("campus/date/<str:date_str>/timeline/", CampusTimelineAPI.as_view(), name="campus-timeline-api"),
+    path("campus/aggregate/hourly/from/<str:from_str>/to/<str:to_str>/", CampusHourlyAggregateAPI.as_view(), name="campus-hourly-aggregate-api"),
+    path("campus/aggregate/daily/from/<str:from_str>/to/<str:to_str>/", CampusDailyAggregateAPI.as_view(), name="campus-daily-aggregate-api"),
     path("building/<str:building>/datetime/<str:datetime_str>/", BuildingAPI.as_view(), name="building-api"),
+    path("building/<str:building>/floors/", FloorsAPI.as_view(), name="floors-api"),
+    path("buildings/datetime/<str:datetime_str>/", BuildingsAPI.as_view(), name="buildings-api"),
     path("building/<str:building>/datetime/<str:datetime_str>/access_point/", AccessPointAPI.as_view(), name="access-poiont-api"),
     path("trajectory/<str:device_id>/date/<str:date_str>/", RouteAPI.as_view(), name="route-api"),
+    path("trajectory/<str:device_id>/from/<str:from_str>/to/<str:to_str>/", TrajectoryRangeAPI.as_view(), name="trajectory-range-api"),
     path('predict/datetime/<str:datetime_str>/', PredictionAPI.as_view(), name='prediction-api'),
     path("predict/campus/datetime/<str:datetime_str>/", CampusPredictionAPI.as_view(), name="campus-prediction-api"),
+    path("predict/forecast/date/<str:date_str>/", ForecastAPI.as_view(), name="forecast-api"),
 ]
 
@@ -1,67 +1,170 @@
-import torch
-import pandas as pd
-import joblib
-from sklearn.preprocessing import StandardScaler
+import json
+import asyncio
+import numpy as np
+from django.conf import settings
 from django.shortcuts import render
+from django.http import HttpResponse, StreamingHttpResponse
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.utils import timezone
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.views import APIView
-from .helper import campus_occupancy, get_csv, ap_occupancy, building_occupancy, time_and_date, trajectory_csv_data, device_traj
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from .helper import campus_occupancy, campus_timeline, get_csv, ap_occupancy, building_occupancy, buildings_occupancy, building_floors, time_and_date, trajectory_csv_data, device_traj, device_traj_days
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
-from datetime import datetime
-import os
+from datetime import datetime, timedelta
 from .consts import building_dict  # Import the building dictionary
-
-# Define the EnhancedRNN model architecture
-class EnhancedRNN(torch.nn.Module):
-    def __init__(self, input_size, hidden_size, num_layers, output_size):
-        super(EnhancedRNN, self).__init__()
-        self.rnn = torch.nn.LSTM(input_size, hidden_size, num_layers, batch_first=True)
-        self.fc1 = torch.nn.Linear(hidden_size, hidden_size // 2)
-        self.relu1 = torch.nn.ReLU()
-        self.fc2 = torch.nn.Linear(hidden_size // 2, output_size)
-
-    def forward(self, x):
-        out, _ = self.rnn(x)
-        out = self.fc1(out[:, -1, :])
-        out = self.relu1(out)
-        out = self.fc2(out)
-        return out
-
-# Load the model
-model_path = '/path_to_your/occupancy_model2.pth'
-
-input_size = 213  # Adjust based on the actual input size used during training
-hidden_size = 128  # Same as used during training
-num_layers = 2  # Same as used during training
-output_size = 1  # Same as used during training
-
-model = EnhancedRNN(input_size, hidden_size, num_layers, output_size)
-model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
-model.eval()
-
-#load scaler
-scaler_path = '/path_to_your/scaler.pkl'
-scaler = joblib.load(scaler_path)
-# Dummy data to fit the scaler (use representative data from training)
-# Example features: hour_of_day, day_of_week, minute_of_day, future_day, week_of_year, is_weekend, building_one_hot
-dummy_data = [
-    [10, 1, 600, 70, 10, 0] + [0] * len(building_dict),
-    [15, 2, 900, 71, 10, 0] + [0] * len(building_dict),
-    [20, 3, 1200, 72, 10, 0] + [0] * len(building_dict)
-    # Add more rows as needed
-]
-
-# Convert to DataFrame and fit the scaler
-dummy_df = pd.DataFrame(dummy_data)
-scaler = StandardScaler()
-scaler.fit(dummy_df)
+from .prediction_cache import PredictionCache
+from .catalog import dataset_catalog
+from .registry import registry, prediction_features
+from .live import live_stream, live_stream_async
+from .pools import run_in_pool
+from .http_cache import conditional
+from .metrics import metrics, timed
+from .rollup import hourly_profile, daily_summary, parse_selection, WEEKDAYS
+from .compact import compact_renderers, wants_compact, building_table, compact_occupancy, compact_predictions
+from . import consts
+
+# scale the feature rows and run them through the model in batches
+def predict(features):
+    return registry.predict(features)
+
+# results shared by both prediction views, dropped when the model or scaler file changes
+cache_settings = getattr(settings, "PREDICTION_CACHE", {})
+prediction_cache = PredictionCache(
+    registry.paths,
+    size=cache_settings.get("SIZE", 100000),
+    backend=cache_settings.get("BACKEND"),
+    timeout=cache_settings.get("TIMEOUT"),
+    tag=registry.engine
+)
+
+# raw model outputs for the buildings at a date (YYYYMMDD) and minute,
+# only the buildings missing from the cache go through the model
+def predict_buildings(date_str, timestamp, future_day, buildings):
+    keys = [(building, date_str, timestamp) for building in buildings]
+    found, missing = prediction_cache.get_many(keys)
+
+    if missing:
+        values = predict(prediction_features([timestamp] * len(missing), future_day, [key[0] for key in missing]))
+        computed = dict(zip(missing, values.tolist()))
+        prediction_cache.set_many(computed)
+        found.update(computed)
+
+    return [found[key] for key in keys]
+
+# [time x building] model outputs for one day, computed as one batched inference
+def forecast_grid(timestamps, future_day, buildings):
+    features = prediction_features(np.repeat(timestamps, len(buildings)), future_day, list(buildings) * len(timestamps))
+    return predict(features)[:, 0].reshape(len(timestamps), len(buildings))
+
+class AsyncAPIView(APIView):
+    '''
+    APIView with coroutine handlers
+
+    The DRF checks (authentication, permissions, throttling) may use the
+    database, so they run on a thread, then the handler is awaited. The
+    occupancy and prediction views await their work on the pools of
+    pools.py, so under ASGI a request waiting on a file or the model does
+    not hold a thread. Under WSGI Django runs the coroutine to completion
+    for each request.
+    '''
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+# data file and date a datetime_str request is answered from, for the HTTP cache headers
+def occupancy_source(request, datetime_str, **kwargs):
+    if time_and_date(datetime_str) == "Invalid timestamp format":
+        return None
+    date = time_and_date(datetime_str)[0]
+    file = get_csv(date)
+    return None if file == "error" else (file, date)
+
+def trajectory_source(request, date_str, **kwargs):
+    if time_and_date(date_str) == "Invalid timestamp format":
+        return None
+    date = time_and_date(date_str)[0]
+    file = trajectory_csv_data(date)
+    return None if file == "error" else (file, date)
+
+# the building table only changes with consts.py, like a past day's file
+def building_table_source(request, **kwargs):
+    return consts.__file__, ""
 
 def index(request):
     return render(request, 'crowdvisualrestapi/index.html')
 
-class CampusAPI(APIView):
+# metrics of this server process for Prometheus to scrape
+def prometheus_metrics(request):
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+class DatasetsAPI(APIView):
+    @swagger_auto_schema(
+        operation_id='datasets',
+        operation_summary='Available Dates',
+        operation_description="""Dates (YYYY-MM-DD) that have data: "campus" for the campus and building
+        views, "buildings" per Sessions_<building> folder, "trajectory" for the trajectory views""",
+        tags=['Datasets'],
+        responses={
+            200: 'HTTP 200 OK',
+        }
+    )
+    def get(self, request, *args, **kwargs):
+        def iso(dates):
+            return [f"{date[0:4]}-{date[4:6]}-{date[6:8]}" for date in dates]
+
+        datasets = dataset_catalog().datasets()
+        response = {
+            "data": {
+                "campus": iso(datasets.pop("Total", [])),
+                "trajectory": iso(datasets.pop("Trajectory", [])),
+                "buildings": {building: iso(dates) for building, dates in datasets.items()},
+            }
+        }
+        return Response(response, status=status.HTTP_200_OK)
+
+class BuildingTableAPI(APIView):
+    @swagger_auto_schema(
+        operation_id='building_table',
+        operation_summary='Building Table',
+        operation_description="""Every building with its coordinates as parallel arrays. The compact
+        responses (?format=compact or ?format=msgpack) give buildings as positions in these arrays""",
+        tags=['Campus'],
+        responses={
+            200: 'HTTP 200 OK',
+        }
+    )
+    @conditional(building_table_source)
+    def get(self, request, *args, **kwargs):
+        return Response({"data": building_table()}, status=status.HTTP_200_OK)
+
+class CampusAPI(AsyncAPIView):
+    renderer_classes = compact_renderers()
+
     @swagger_auto_schema(
         operation_id='campus_occupancy',
         operation_summary='Campus View',
@@ -75,13 +178,18 @@ class CampusAPI(APIView):
             description="""Time Granularity (minute or hour) 
             If parameter is not specified, default is hour granularity""", 
             type=openapi.TYPE_STRING),
+            openapi.Parameter('format', openapi.IN_QUERY, 
+            description="""compact for parallel arrays indexed against the building table,
+            msgpack for the same as MessagePack (when available)""", 
+            type=openapi.TYPE_STRING),
         ],
         responses={
             200: 'HTTP 200 OK',
             400: 'HTTP 400 Bad Request',
         }
     )
-    def get(self, request, datetime_str, *args, **kwargs):
+    @conditional(occupancy_source)
+    async def get(self, request, datetime_str, *args, **kwargs):
         if time_and_date(datetime_str) == "Invalid timestamp format":
             return Response({"error": "Invalid timestamp format"}, status=status.HTTP_400_BAD_REQUEST)
         date, timestamp = time_and_date(datetime_str)
@@ -96,12 +204,12 @@ class CampusAPI(APIView):
         granularity = request.query_params.get('granularity')
 
         if not granularity or granularity == "hour":
-            campus_data = campus_occupancy(file, timestamp, True)
+            campus_data = await run_in_pool("occupancy", campus_occupancy, file, timestamp, True)
             response = {
                 "data": campus_data
             }
         elif granularity == "minute":
-            campus_data = campus_occupancy(file, timestamp)
+            campus_data = await run_in_pool("occupancy", campus_occupancy, file, timestamp)
             response = {
                 "data": campus_data
             }
@@ -110,11 +218,267 @@ class CampusAPI(APIView):
                 "data": "Data Unavailable"
             }
 
+        if wants_compact(request) and isinstance(response["data"], list):
+            response["data"] = compact_occupancy(response["data"])
+
+        return Response(response, status=status.HTTP_200_OK)
+
+
+# lets EventSource clients (Accept: text/event-stream) through content
+# negotiation, error responses are still JSON
+class EventStreamRenderer(BaseRenderer):
+    media_type = "text/event-stream"
+    format = "event-stream"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode()
+
+class LiveCampusAPI(APIView):
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
+
+    @swagger_auto_schema(
+        operation_id='campus_occupancy_live',
+        operation_summary='Live Campus View',
+        operation_description="""Server-Sent Events stream (text/event-stream). The first "snapshot" event
+        holds {"time": "HH:MM", "data": [...]} with the rows of the campus view, then a "delta" event
+        {"time": "HH:MM", "changed": [...], "removed": ["BLDG", ...]} is sent whenever the counts change,
+        e.g. while syslogs are ingested. Without datetime the stream follows the current time""",
+        tags=['Campus'],
+        manual_parameters=[
+            openapi.Parameter('datetime', openapi.IN_QUERY, 
+            description="""Date in simplified ISO 8601 date and time format 
+            e.g. 2021-03-01T10:30 = March 1st, 2021 10:30 a.m.""", 
+            type=openapi.TYPE_STRING),
+            openapi.Parameter('date', openapi.IN_QUERY, 
+            description="""Date in simplified ISO 8601 date format, followed at the current time 
+            If neither date nor datetime is specified, default is today""", 
+            type=openapi.TYPE_STRING),
+            openapi.Parameter('granularity', openapi.IN_QUERY, 
+            description="""Time Granularity (minute or hour) 
+            If parameter is not specified, default is hour granularity""", 
+            type=openapi.TYPE_STRING),
+        ],
+        responses={
+            200: 'HTTP 200 OK',
+            400: 'HTTP 400 Bad Request',
+        }
+    )
+    def get(self, request, *args, **kwargs):
+        datetime_str = request.query_params.get('datetime')
+        if datetime_str:
+            if time_and_date(datetime_str) == "Invalid timestamp format":
+                return Response({"error": "Invalid timestamp format"}, status=status.HTTP_400_BAD_REQUEST)
+            date, timestamp = time_and_date(datetime_str)
+            if timestamp > 1440 or timestamp < 0:
+                return Response({"error": "Invalid timestamp"}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            date_str = request.query_params.get('date') or f"{timezone.localdate():%Y-%m-%d}"
+            if time_and_date(date_str) == "Invalid timestamp format":
+                return Response({"error": "Invalid timestamp format"}, status=status.HTTP_400_BAD_REQUEST)
+            date, timestamp = time_and_date(date_str)[0], None
+
+        granularity = request.query_params.get('granularity')
+        if granularity not in (None, "", "minute", "hour"):
+            return Response({"error": "Invalid granularity"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # a day without data yet streams an empty snapshot until its file shows up
+        key = (date, timestamp, granularity != "minute")
+        if isinstance(request._request, ASGIRequest):
+            stream = live_stream_async(key)
+        else:
+            stream = live_stream(key)
+
+        response = StreamingHttpResponse(stream, content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+class CampusTimelineAPI(AsyncAPIView):
+    @swagger_auto_schema(
+        operation_id='campus_timeline',
+        operation_summary='Campus Timeline',
+        tags=['Campus'],
+        manual_parameters=[
+            openapi.Parameter('date_str', openapi.IN_PATH, 
+            description="""Date in simplified ISO 8601 date format 
+            e.g. 2021-03-01 = March 1st, 2021""", 
+            type=openapi.TYPE_STRING),
+            openapi.Parameter('start', openapi.IN_QUERY, 
+            description="""First minute of the day to include (0 - 1440)
+            If parameter is not specified, default is 0""", 
+            type=openapi.TYPE_INTEGER),
+            openapi.Parameter('end', openapi.IN_QUERY, 
+            description="""Last minute of the day to include (0 - 1440)
+            If parameter is not specified, default is 1439""", 
+            type=openapi.TYPE_INTEGER),
+            openapi.Parameter('step', openapi.IN_QUERY, 
+            description="""Minutes between two samples
+            If parameter is not specified, default is 1 (60 for hour granularity)""", 
+            type=openapi.TYPE_INTEGER),
+            openapi.Parameter('granularity', openapi.IN_QUERY, 
+            description="""Time Granularity (minute or hour) 
+            If parameter is not specified, default is minute granularity""", 
+            type=openapi.TYPE_STRING),
+        ],
+        responses={
+            200: 'HTTP 200 OK',
+            400: 'HTTP 400 Bad Request',
+        }
+    )
+    async def get(self, request, date_str, *args, **kwargs):
+        if time_and_date(date_str) == "Invalid timestamp format":
+            return Response({"error": "Invalid timestamp format"}, status=status.HTTP_400_BAD_REQUEST)
+        date, timestamp = time_and_date(date_str)
+
+        file = get_csv(date)
+        if file == "error":
+            return Response({"error": "Invalid Date"}, status=status.HTTP_400_BAD_REQUEST)
+
+        granularity = request.query_params.get('granularity')
+        if granularity not in (None, "", "minute", "hour"):
+            return Response({"error": "Invalid granularity"}, status=status.HTTP_400_BAD_REQUEST)
+        hour = granularity == "hour"
+
+        try:
+            start = int(request.query_params.get('start', 0))
+            end = int(request.query_params.get('end', 1439))
+            step = int(request.query_params.get('step', 60 if hour else 1))
+        except ValueError:
+            return Response({"error": "start, end and step must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if start < 0 or end > 1440 or start > end:
+            return Response({"error": "Invalid time range"}, status=status.HTTP_400_BAD_REQUEST)
+        if step < 1:
+            return Response({"error": "Invalid step"}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = {
+            "data": await run_in_pool("occupancy", campus_timeline, file, f"{date[0:4]}-{date[4:6]}-{date[6:8]}", start, end, step, hour)
+        }
+
+        return Response(response, status=status.HTTP_200_OK)
+
+
+# date range, weekdays and buildings of an aggregate request,
+# returns ((first, last, weekdays, buildings), None) or (None, error message)
+def aggregate_filters(request, from_str, to_str):
+    if time_and_date(from_str) == "Invalid timestamp format" or time_and_date(to_str) == "Invalid timestamp format":
+        return None, "Invalid timestamp format"
+    first = time_and_date(from_str)[0]
+    last = time_and_date(to_str)[0]
+    if last < first:
+        return None, "End date must not be before start date"
+
+    weekdays = request.query_params.get('weekdays')
+    if weekdays:
+        try:
+            weekdays = parse_selection(weekdays, 7, WEEKDAYS)
+        except ValueError:
+            return None, "Invalid weekdays"
+    else:
+        weekdays = None
+
+    buildings = request.query_params.get('buildings')
+    if buildings:
+        buildings = buildings.split(',')
+        if any(building not in building_dict for building in buildings):
+            return None, "Invalid building name"
+    else:
+        buildings = list(building_dict)
+    return (first, last, weekdays, buildings), None
+
+aggregate_parameters = [
+    openapi.Parameter('from_str', openapi.IN_PATH, 
+    description="""First date in simplified ISO 8601 date format 
+    e.g. 2021-03-01 = March 1st, 2021""", 
+    type=openapi.TYPE_STRING),
+    openapi.Parameter('to_str', openapi.IN_PATH, 
+    description="""Last date (included) in simplified ISO 8601 date format 
+    e.g. 2021-03-31 = March 31st, 2021""", 
+    type=openapi.TYPE_STRING),
+    openapi.Parameter('weekdays', openapi.IN_QUERY, 
+    description="""Days of the week to include, comma separated numbers (0 = Monday) or names 
+    with ranges, e.g. mon-fri or 5,6
+    If parameter is not specified, every day is included""", 
+    type=openapi.TYPE_STRING),
+    openapi.Parameter('buildings', openapi.IN_QUERY, 
+    description="""Comma separated building names, e.g. KNWL,LGRC
+    If parameter is not specified, every building is returned""", 
+    type=openapi.TYPE_STRING),
+]
+
+class CampusHourlyAggregateAPI(AsyncAPIView):
+    @swagger_auto_schema(
+        operation_id='campus_hourly_aggregate',
+        operation_summary='Campus Hourly Aggregate',
+        operation_description="""Typical day of every building over a date range, from the daily rollups:
+        per hour and building the average and peak distinct devices, the sessions and their average
+        minutes inside the hour. Days without a rollup yet are listed in missing_dates""",
+        tags=['Campus'],
+        manual_parameters=aggregate_parameters + [
+            openapi.Parameter('hours', openapi.IN_QUERY, 
+            description="""Hours of the day to include (0 - 23), comma separated with ranges, e.g. 8-17
+            If parameter is not specified, every hour is included""", 
+            type=openapi.TYPE_STRING),
+        ],
+        responses={
+            200: 'HTTP 200 OK',
+            400: 'HTTP 400 Bad Request',
+        }
+    )
+    async def get(self, request, from_str, to_str, *args, **kwargs):
+        filters, error = aggregate_filters(request, from_str, to_str)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+        first, last, weekdays, buildings = filters
+
+        hours = request.query_params.get('hours')
+        try:
+            hours = parse_selection(hours, 24) if hours else list(range(24))
+        except ValueError:
+            return Response({"error": "Invalid hours"}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = {
+            "data": await run_in_pool("occupancy", hourly_profile, first, last, weekdays, hours, buildings)
+        }
+
         return Response(response, status=status.HTTP_200_OK)
 
+class CampusDailyAggregateAPI(AsyncAPIView):
+    @swagger_auto_schema(
+        operation_id='campus_daily_aggregate',
+        operation_summary='Campus Daily Aggregate',
+        operation_description="""Daily stats of every building over a date range per day, week or month,
+        from the daily rollups: average daily distinct devices, peak hourly distinct devices, sessions
+        and their average length in minutes. Days without a rollup yet are listed in missing_dates""",
+        tags=['Campus'],
+        manual_parameters=aggregate_parameters + [
+            openapi.Parameter('group', openapi.IN_QUERY, 
+            description="""Period the days are grouped by (day, week or month), weeks are ISO weeks
+            If parameter is not specified, default is week""", 
+            type=openapi.TYPE_STRING),
+        ],
+        responses={
+            200: 'HTTP 200 OK',
+            400: 'HTTP 400 Bad Request',
+        }
+    )
+    async def get(self, request, from_str, to_str, *args, **kwargs):
+        filters, error = aggregate_filters(request, from_str, to_str)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+        first, last, weekdays, buildings = filters
+
+        group = request.query_params.get('group') or "week"
+        if group not in ("day", "week", "month"):
+            return Response({"error": "Invalid group"}, status=status.HTTP_400_BAD_REQUEST)
 
+        response = {
+            "data": await run_in_pool("occupancy", daily_summary, first, last, weekdays, group, buildings)
+        }
+
+        return Response(response, status=status.HTTP_200_OK)
           
-class BuildingAPI(APIView):
+class BuildingAPI(AsyncAPIView):
     @swagger_auto_schema(
         operation_id='building_occupancy',
         operation_summary='Building View',
@@ -139,7 +503,8 @@ class BuildingAPI(APIView):
             400: 'HTTP 400 Bad Request',
         }
     )
-    def get(self, request, building, datetime_str, *args, **kwargs):
+    @conditional(occupancy_source)
+    async def get(self, request, building, datetime_str, *args, **kwargs):
         if time_and_date(datetime_str) == "Invalid timestamp format":
             return Response({"error": "Invalid timestamp format"}, status=status.HTTP_400_BAD_REQUEST)
         date, timestamp = time_and_date(datetime_str)
@@ -155,12 +520,12 @@ class BuildingAPI(APIView):
         granularity = request.query_params.get('granularity')
 
         if not granularity or granularity == "hour":
-            campus_data = building_occupancy(file, building, timestamp, True)
+            campus_data = await run_in_pool("occupancy", building_occupancy, file, building, timestamp, True)
             response = {
                 "data": campus_data
             }
         elif granularity == "minute":
-            campus_data = building_occupancy(file, building, timestamp)
+            campus_data = await run_in_pool("occupancy", building_occupancy, file, building, timestamp)
             response = {
                 "data": campus_data
             }
@@ -171,7 +536,111 @@ class BuildingAPI(APIView):
 
         return Response(response, status=status.HTTP_200_OK)
 
-class AccessPointAPI(APIView):
+class BuildingsAPI(AsyncAPIView):
+    @swagger_auto_schema(
+        operation_id='buildings_occupancy',
+        operation_summary='Multi-Building View',
+        operation_description="""Building View stats of several buildings computed in one pass,
+        returned as a dict keyed by building""",
+        tags=['Building'],
+        manual_parameters=[
+            openapi.Parameter('datetime_str', openapi.IN_PATH, 
+            description="""Date in simplified ISO 8601 date and time format 
+            e.g. 2021-03-01T10:30 = March 1st, 2021 10:30 a.m.""", 
+            type=openapi.TYPE_STRING),
+            openapi.Parameter('buildings', openapi.IN_QUERY, 
+            description="""Comma separated building names, e.g. KNWL,LGRC
+            If parameter is not specified, every building is returned""", 
+            type=openapi.TYPE_STRING),
+            openapi.Parameter('granularity', openapi.IN_QUERY, 
+            description="""Time Granularity (minute or hour) 
+            If parameter is not specified, default is hour granularity""", 
+            type=openapi.TYPE_STRING),
+        ],
+        responses={
+            200: 'HTTP 200 OK',
+            400: 'HTTP 400 Bad Request',
+        }
+    )
+    async def get(self, request, datetime_str, *args, **kwargs):
+        if time_and_date(datetime_str) == "Invalid timestamp format":
+            return Response({"error": "Invalid timestamp format"}, status=status.HTTP_400_BAD_REQUEST)
+        date, timestamp = time_and_date(datetime_str)
+
+        file = get_csv(date)
+        if file == "error":
+            return Response({"error": "Invalid Date"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if timestamp > 1440 or timestamp < 0:
+            return Response({"error": "Invalid timestamp"}, status=status.HTTP_400_BAD_REQUEST)
+
+        buildings = request.query_params.get('buildings')
+        if buildings:
+            buildings = buildings.split(',')
+            if any(building not in building_dict for building in buildings):
+                return Response({"error": "Invalid building name"}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            buildings = list(building_dict)
+
+        granularity = request.query_params.get('granularity')
+
+        if not granularity or granularity == "hour":
+            response = {
+                "data": await run_in_pool("occupancy", buildings_occupancy, file, buildings, timestamp, True)
+            }
+        elif granularity == "minute":
+            response = {
+                "data": await run_in_pool("occupancy", buildings_occupancy, file, buildings, timestamp)
+            }
+        else:
+            response = {
+                "data": "Data Unavailable"
+            }
+
+        return Response(response, status=status.HTTP_200_OK)
+
+class FloorsAPI(AsyncAPIView):
+    @swagger_auto_schema(
+        operation_id='building_floors',
+        operation_summary='Building Floors',
+        tags=['Building'],
+        manual_parameters=[
+            openapi.Parameter('building', openapi.IN_PATH, 
+            description="""Building on UMass Amherst Campus, in abbreviated form
+            e.g. KNWL = Knowlton Hall""",
+            type=openapi.TYPE_STRING),
+            openapi.Parameter('date', openapi.IN_QUERY, 
+            description="""Date in simplified ISO 8601 date format, e.g. 2021-03-01
+            If parameter is not specified, the latest day with data is used""", 
+            type=openapi.TYPE_STRING),
+        ],
+        responses={
+            200: 'HTTP 200 OK',
+            400: 'HTTP 400 Bad Request',
+        }
+    )
+    async def get(self, request, building, *args, **kwargs):
+        if building not in building_dict:
+            return Response({"error": "Invalid building name"}, status=status.HTTP_400_BAD_REQUEST)
+
+        date_str = request.query_params.get('date')
+        if date_str:
+            if time_and_date(date_str) == "Invalid timestamp format":
+                return Response({"error": "Invalid timestamp format"}, status=status.HTTP_400_BAD_REQUEST)
+            date = time_and_date(date_str)[0]
+        else:
+            dates = dataset_catalog().dates("Total")
+            if not dates:
+                return Response({"error": "Invalid Date"}, status=status.HTTP_400_BAD_REQUEST)
+            date = dates[-1]
+
+        file = get_csv(date)
+        if file == "error":
+            return Response({"error": "Invalid Date"}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({"data": await run_in_pool("occupancy", building_floors, file, building)}, status=status.HTTP_200_OK)
+
+class AccessPointAPI(AsyncAPIView):
     @swagger_auto_schema(
         operation_id='access_point_occupancy',
         operation_summary='Access Point View',
@@ -198,8 +667,8 @@ class AccessPointAPI(APIView):
             400: 'HTTP 400 Bad Request',
         }
     )
-
-    def get(self, request, datetime_str, building, *args, **kwargs):
+    @conditional(occupancy_source)
+    async def get(self, request, datetime_str, building, *args, **kwargs):
         if time_and_date(datetime_str) == "Invalid timestamp format":
             return Response({"error": "Invalid timestamp format"}, status=status.HTTP_400_BAD_REQUEST)
         date, timestamp = time_and_date(datetime_str)
@@ -218,15 +687,15 @@ class AccessPointAPI(APIView):
 
         if not level:
             if not granularity or granularity == "hour":
-                data = ap_occupancy(file, building, timestamp, 1, True)
+                data = await run_in_pool("occupancy", ap_occupancy, file, building, timestamp, 1, True)
             else:
-                data = ap_occupancy(file, building, timestamp, 1)
+                data = await run_in_pool("occupancy", ap_occupancy, file, building, timestamp, 1)
         else:
             floor = int(level)
             if not granularity or granularity == "hour":
-                data = ap_occupancy(file, building, timestamp, floor, True)
+                data = await run_in_pool("occupancy", ap_occupancy, file, building, timestamp, floor, True)
             else:
-                data = ap_occupancy(file, building, timestamp, floor)
+                data = await run_in_pool("occupancy", ap_occupancy, file, building, timestamp, floor)
 
         if data == "building_error":
             return Response({"error": "Invalid building name"}, status=status.HTTP_400_BAD_REQUEST)
@@ -257,7 +726,7 @@ class RouteAPI(APIView):
             400: 'HTTP 400 Bad Request',
         }
     )
-
+    @conditional(trajectory_source)
     def get(self, request, device_id, date_str, *args, **kwargs):
         if time_and_date(date_str) == "Invalid timestamp format":
             return Response({"error": "Invalid timestamp format"}, status=status.HTTP_400_BAD_REQUEST)
@@ -265,6 +734,8 @@ class RouteAPI(APIView):
 
 
         file = trajectory_csv_data(date)
+        if file == "error":
+            return Response({"error": "Invalid Date"}, status=status.HTTP_400_BAD_REQUEST)
 
         real_device_id = "#" + device_id + "#"
         response = {
@@ -273,7 +744,56 @@ class RouteAPI(APIView):
 
         return Response(response, status=status.HTTP_200_OK)
 
-class PredictionAPI(APIView):
+class TrajectoryRangeAPI(APIView):
+    @swagger_auto_schema(
+        operation_id='user_trajectory_range',
+        operation_summary='Trajectory Data over a Date Range',
+        operation_description="""Streams newline-delimited JSON, one line per day with a trajectory file:
+        {"date": "2013-11-29", "data": [...]} where data is what the single day endpoint returns.
+        The range may cover at most TRAJECTORY_MAX_DAYS days (366 by default)""",
+        tags=['Trajectory'],
+        manual_parameters=[
+            openapi.Parameter('device_id', openapi.IN_PATH, 
+            description="""Device id as read from csv file without "#" at the beginning and end
+            e.g. Y4kGl.FiowcKk0z8xyTEjU instead of #Y4kGl.FiowcKk0z8xyTEjU#""", 
+            type=openapi.TYPE_STRING),
+            openapi.Parameter('from_str', openapi.IN_PATH, 
+            description="""First date in simplified ISO 8601 date format 
+            e.g. 2013-11-29 = November 29th, 2013""", 
+            type=openapi.TYPE_STRING),
+            openapi.Parameter('to_str', openapi.IN_PATH, 
+            description="""Last date (included) in simplified ISO 8601 date format 
+            e.g. 2013-12-06 = December 6th, 2013""", 
+            type=openapi.TYPE_STRING),
+        ],
+        responses={
+            200: 'HTTP 200 OK',
+            400: 'HTTP 400 Bad Request',
+        }
+    )
+    def get(self, request, device_id, from_str, to_str, *args, **kwargs):
+        if time_and_date(from_str) == "Invalid timestamp format" or time_and_date(to_str) == "Invalid timestamp format":
+            return Response({"error": "Invalid timestamp format"}, status=status.HTTP_400_BAD_REQUEST)
+        first = datetime.strptime(time_and_date(from_str)[0], '%Y%m%d')
+        last = datetime.strptime(time_and_date(to_str)[0], '%Y%m%d')
+
+        if last < first:
+            return Response({"error": "End date must not be before start date"}, status=status.HTTP_400_BAD_REQUEST)
+
+        max_days = getattr(settings, "TRAJECTORY_MAX_DAYS", 366)
+        if (last - first).days + 1 > max_days:
+            return Response({"error": f"Date range must not be longer than {max_days} days"}, status=status.HTTP_400_BAD_REQUEST)
+
+        dates = (f"{first + timedelta(days=n):%Y%m%d}" for n in range((last - first).days + 1))
+        real_device_id = "#" + device_id + "#"
+
+        def lines():
+            for date, data in device_traj_days(real_device_id, dates):
+                yield json.dumps({"date": f"{date[0:4]}-{date[4:6]}-{date[6:8]}", "data": data}) + "\n"
+
+        return StreamingHttpResponse(lines(), content_type="application/x-ndjson")
+
+class PredictionAPI(AsyncAPIView):
     @swagger_auto_schema(
         operation_id='predict_occupancy',
         operation_summary='Predict Occupancy',
@@ -292,7 +812,7 @@ class PredictionAPI(APIView):
             400: 'HTTP 400 Bad Request',
         }
     )
-    def get(self, request, datetime_str, *args, **kwargs):
+    async def get(self, request, datetime_str, *args, **kwargs):
         result = time_and_date(datetime_str)
         if result == "Invalid timestamp format":
             return Response({"error": "Invalid timestamp format"}, status=status.HTTP_400_BAD_REQUEST)
@@ -309,40 +829,16 @@ class PredictionAPI(APIView):
         if future_day < 0:
             return Response({"error": "Date must be on or after March 9, 2021"}, status=status.HTTP_400_BAD_REQUEST)
 
-        hour_of_day = timestamp // 60
-        day_of_week = (future_day % 7)
-        minute_of_day = timestamp
-        week_of_year = (future_day // 7) + 1
-        is_weekend = 1 if day_of_week >= 5 else 0
-
-        building_one_hot = [1 if building == b else 0 for b in building_dict]
-        input_features = [
-            hour_of_day,
-            day_of_week,
-            minute_of_day,
-            future_day,
-            week_of_year,
-            is_weekend,
-            *building_one_hot
-        ]
-
-        # Convert to DataFrame for scaling
-        input_df = pd.DataFrame([input_features])
-
-        # Scale the features
-        input_scaled = scaler.transform(input_df)
-        input_tensor = torch.tensor(input_scaled, dtype=torch.float32).unsqueeze(0)
-
-        with torch.no_grad():
-            prediction = model(input_tensor)
-        prediction_value = prediction.numpy().tolist()
+        prediction_value = await run_in_pool("prediction", predict_buildings, date_str, timestamp, future_day, [building])
 
         # Round the prediction value to one decimal place
         prediction_value = [[round(val, 1) for val in sublist] for sublist in prediction_value]
 
         return Response({'prediction': prediction_value}, status=status.HTTP_200_OK)
 
-class CampusPredictionAPI(APIView):
+class CampusPredictionAPI(AsyncAPIView):
+    renderer_classes = compact_renderers()
+
     @swagger_auto_schema(
         operation_id='predict_campus_occupancy',
         operation_summary='Predict Campus Occupancy',
@@ -352,13 +848,17 @@ class CampusPredictionAPI(APIView):
             description="""Date in simplified ISO 8601 date and time format 
             e.g. 2021-03-01T10:30 = March 1st, 2021 10:30 a.m.""", 
             type=openapi.TYPE_STRING),
+            openapi.Parameter('format', openapi.IN_QUERY, 
+            description="""compact for one flat array in the order of the building table,
+            msgpack for the same as MessagePack (when available)""", 
+            type=openapi.TYPE_STRING),
         ],
         responses={
             200: 'HTTP 200 OK',
             400: 'HTTP 400 Bad Request',
         }
     )
-    def get(self, request, datetime_str, *args, **kwargs):
+    async def get(self, request, datetime_str, *args, **kwargs):
         result = time_and_date(datetime_str)
         if result == "Invalid timestamp format":
             return Response({"error": "Invalid timestamp format"}, status=status.HTTP_400_BAD_REQUEST)
@@ -371,35 +871,19 @@ class CampusPredictionAPI(APIView):
         if future_day < 0:
             return Response({"error": "Date must be on or after March 9, 2021"}, status=status.HTTP_400_BAD_REQUEST)
 
-        hour_of_day = timestamp // 60
-        day_of_week = (future_day % 7)
-        minute_of_day = timestamp
-        week_of_year = (future_day // 7) + 1
-        is_weekend = 1 if day_of_week >= 5 else 0
+        # every building goes through the model in one batch
+        buildings = list(building_dict)
+        values = await run_in_pool("prediction", predict_buildings, date_str, timestamp, future_day, buildings)
+
+        if wants_compact(request):
+            return Response({'predictions': compact_predictions(values)}, status=status.HTTP_200_OK)
 
         predictions = {}
-        for building, (lat, long) in building_dict.items():
-            building_one_hot = [1 if building == b else 0 for b in building_dict]
-            input_features = [
-                hour_of_day,
-                day_of_week,
-                minute_of_day,
-                future_day,
-                week_of_year,
-                is_weekend,
-                *building_one_hot
-            ]
-
-            input_df = pd.DataFrame([input_features])
-            input_scaled = scaler.transform(input_df)
-            input_tensor = torch.tensor(input_scaled, dtype=torch.float32).unsqueeze(0)
-
-            with torch.no_grad():
-                prediction = model(input_tensor)
-            prediction_value = prediction.numpy().tolist()
+        for i, building in enumerate(buildings):
+            lat, long = building_dict[building]
 
             # Round the prediction value to two decimal place
-            prediction_value = [[round(val, 2) for val in sublist] for sublist in prediction_value]
+            prediction_value = [[round(val, 2) for val in values[i]]]
 
             predictions[building] = {
                 'lat': lat,
@@ -407,6 +891,70 @@ class CampusPredictionAPI(APIView):
                 'predicted_occupancy': prediction_value
             }
 
+        return Response({'predictions': predictions}, status=status.HTTP_200_OK)
+
+class ForecastAPI(AsyncAPIView):
+    @swagger_auto_schema(
+        operation_id='forecast_occupancy',
+        operation_summary='Forecast Occupancy',
+        tags=['Prediction'],
+        manual_parameters=[
+            openapi.Parameter('date_str', openapi.IN_PATH, 
+            description="""Date in simplified ISO 8601 date format 
+            e.g. 2021-03-10 = March 10th, 2021""", 
+            type=openapi.TYPE_STRING),
+            openapi.Parameter('step', openapi.IN_QUERY, 
+            description="""Minutes between two predictions
+            If parameter is not specified, default is 15""", 
+            type=openapi.TYPE_INTEGER),
+            openapi.Parameter('buildings', openapi.IN_QUERY, 
+            description="""Comma separated building names, e.g. KNWL,LGRC
+            If parameter is not specified, every building is predicted""", 
+            type=openapi.TYPE_STRING),
+        ],
+        responses={
+            200: 'HTTP 200 OK',
+            400: 'HTTP 400 Bad Request',
+        }
+    )
+    async def get(self, request, date_str, *args, **kwargs):
+        result = time_and_date(date_str)
+        if result == "Invalid timestamp format":
+            return Response({"error": "Invalid timestamp format"}, status=status.HTTP_400_BAD_REQUEST)
+        date = datetime.strptime(result[0], '%Y%m%d')
+
+        prediction_start_date = datetime(2021, 3, 9)
+        future_day = (date - prediction_start_date).days
 
+        if future_day < 0:
+            return Response({"error": "Date must be on or after March 9, 2021"}, status=status.HTTP_400_BAD_REQUEST)
 
-        return Response({'predictions': predictions}, status=status.HTTP_200_OK)
+        try:
+            step = int(request.query_params.get('step', 15))
+        except ValueError:
+            return Response({"error": "step must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+        if step < 1 or step > 1440:
+            return Response({"error": "Invalid step"}, status=status.HTTP_400_BAD_REQUEST)
+
+        buildings = request.query_params.get('buildings')
+        if buildings:
+            buildings = buildings.split(',')
+            if any(building not in building_dict for building in buildings):
+                return Response({"error": "Invalid building name"}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            buildings = list(building_dict)
+
+        timestamps = list(range(0, 1440, step))
+        grid = await run_in_pool("prediction", forecast_grid, timestamps, future_day, buildings)
+
+        forecast = {
+            'date': date.strftime('%Y-%m-%d'),
+            'times': timestamps,
+            'buildings': buildings,
+            'building_lat': [building_dict[building][0] for building in buildings],
+            'building_long': [building_dict[building][1] for building in buildings],
+            # Round the prediction values to two decimal places
+            'predicted_occupancy': [[round(val, 2) for val in row] for row in grid.tolist()]
+        }
+
+        return Response({'forecast': forecast}, status=status.HTTP_200_OK)